@@ -0,0 +1,983 @@
+"""
+dalion_api_async_client.py
+
+asyncio client exposing the operations of the DALION API scripts:
+get_device, set_device, set_colour and action=get for control devices.
+Requests to many DALIONs run concurrently, bounded per DALION and
+globally, over persistent HTTP/1.1 connections.
+
+The limit of each DALION adapts to the load it sustains (AIMD): it grows
+by one request per window of requests while the latency stays close to
+the baseline, and is cut by the backoff factor on a timeout, a connection
+error, a 503 or a latency spike. metrics() reports the current limits and
+latency estimates.
+
+Every operation carries a deadline budget, timeout seconds (the client
+timeout by default), covering the wait for a free slot and the request;
+TimeoutError is raised when it runs out. Idempotent reads (get_device,
+get_record, get, get_snapshot) are hedged: a duplicate is sent when the
+first request is slower than the p95 latency of the DALION, the first
+response wins. A circuit breaker per DALION fails fast with
+CircuitOpenError after consecutive failures and lets a probe through
+after reset_timeout. The bulk operations (sweep, set_colour_batch) return
+the partial results on schedule, with a TimeoutError per unfinished request.
+
+Usage
+import asyncio
+import dalion_api_async_client
+
+async def run():
+    async with dalion_api_async_client.AsyncClient() as client:
+        level = await client.get_device("192.168.0.210", 1, 1, 0, "dval")
+        await client.set_device("192.168.0.210", 1, 3, -1, "dval", 50)
+
+asyncio.run(run())
+
+Usage - Command line arguments
+dalion_api_async_client.py ip [ip ...]
+
+Reads the control devices of the 4 channels of every DALION concurrently.
+
+Examples:
+Sweep two DALIONs.
+dalion_api_async_client.py 192.168.0.210 192.168.0.211
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import collections
+import urllib.error
+import urllib.parse
+
+import dalion_api_get_control_device
+import dalion_api_get_device
+import dalion_api_metrics
+import dalion_api_set_colour
+import dalion_api_set_device
+import dalion_api_tracing
+import device_variables
+
+
+DEF_GATEWAY_CONCURRENCY = 4
+
+"""
+"" Default initial number of concurrent requests per DALION.
+"""
+
+DEF_MIN_GATEWAY_CONCURRENCY = 1
+
+"""
+"" Minimum number of concurrent requests per DALION.
+"""
+
+DEF_MAX_GATEWAY_CONCURRENCY = 32
+
+"""
+"" Default maximum number of concurrent requests per DALION.
+"""
+
+DEF_BACKOFF = 0.75
+
+"""
+"" Default factor applied to the limit of a DALION on congestion.
+"""
+
+DEF_TOLERANCE = 2.0
+
+"""
+"" Default latency spike threshold, as a multiple of the baseline latency.
+"""
+
+DEF_LATENCY_SLACK = 0.005
+
+"""
+"" Latency in seconds above the baseline always tolerated, so that the
+"" jitter of a fast DALION is not taken for a spike.
+"""
+
+DEF_LATENCY_SMOOTHING = 0.2
+
+"""
+"" Weight of a new sample in the smoothed latency.
+"""
+
+DEF_BASELINE_DRIFT = 0.001
+
+"""
+"" Weight of a slower sample in the baseline latency, so that the baseline
+"" follows a lasting change of the network latency.
+"""
+
+DEF_TIMEOUT = 10.0
+
+"""
+"" Default deadline budget in seconds of an operation, None to wait forever.
+"""
+
+DEF_HEDGE_PERCENTILE = 95
+
+"""
+"" Latency percentile of a DALION after which a read is hedged.
+"""
+
+DEF_HEDGE_MIN_SAMPLES = 20
+
+"""
+"" Latency samples of a DALION needed before its reads are hedged.
+"""
+
+DEF_LATENCY_WINDOW = 256
+
+"""
+"" Latency samples kept per DALION for the hedge delay.
+"""
+
+DEF_BREAKER_THRESHOLD = 5
+
+"""
+"" Default consecutive failures of a DALION that open its circuit breaker.
+"""
+
+DEF_BREAKER_RESET = 5.0
+
+"""
+"" Default seconds an open circuit breaker fails fast before letting a probe through.
+"""
+
+DEF_MAX_CONCURRENCY = 64
+
+"""
+"" Default maximum number of concurrent requests over all DALIONs.
+"""
+
+DEF_IDLE_TIMEOUT = 30.0
+
+"""
+"" Default idle time in seconds before a pooled connection is closed.
+"""
+
+DEF_CHANNELS = (1, 2, 3, 4)
+
+"""
+"" Channels of a DALION.
+"""
+
+DEF_CVALUE_FIELDS = ("xx", "xy", "tc", "p0", "p1", "p2", "p3", "p4", "p5",
+    "rr", "rg", "rb", "rw", "ra", "rf")
+
+"""
+"" cvalue fields in the order of the dalion_api_set_colour.prepare_url arguments.
+"""
+
+_logger = logging.getLogger(__name__)
+
+"""
+"" Logger of the write listener errors.
+"""
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised without sending the request while the circuit breaker of a DALION is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one DALION: closed, open after threshold consecutive
+    failures, half-open after reset_timeout seconds to let one probe
+    through at a time, closed again by a success.
+    """
+
+    def __init__(self, threshold=DEF_BREAKER_THRESHOLD, reset_timeout=DEF_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+
+    def allow(self):
+        """
+        Whether a request may be sent.
+        """
+
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half-open"
+        # A single probe at a time, another one if the last probe was lost
+        if now - self._probe_at < self.reset_timeout:
+            self.rejected += 1
+            return False
+        self._probe_at = now
+        return True
+
+    def success(self):
+        """
+        Record a response.
+        """
+
+        self.failures = 0
+        self.state = "closed"
+
+    def failure(self):
+        """
+        Record a timeout or a connection error.
+        """
+
+        self.failures += 1
+        if (self.state != "closed") | (self.failures >= self.threshold):
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self._probe_at = 0.0
+
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit of one DALION.
+    Congestion signals of requests started before the last decrease are
+    ignored, so that the limit is cut at most once per window.
+    """
+
+    def __init__(self, initial=DEF_GATEWAY_CONCURRENCY, minimum=DEF_MIN_GATEWAY_CONCURRENCY,
+            maximum=DEF_MAX_GATEWAY_CONCURRENCY, backoff=DEF_BACKOFF, tolerance=DEF_TOLERANCE):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self.requests = 0
+        self.congestions = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._waiters = collections.deque()
+
+    def try_acquire(self):
+        """
+        Take a free slot without waiting, False if there is none.
+        """
+
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    async def acquire(self):
+        """
+        Wait for a free slot below the limit.
+        """
+
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Pass a wake-up on to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self):
+        """
+        Free a slot.
+        """
+
+        self.in_flight -= 1
+        self._wake()
+
+    def sample(self, start, latency, congested):
+        """
+        Adapt the limit to a request started at start (time.monotonic())
+        that took latency seconds, None if it failed without a response.
+        congested is True on a timeout, a connection error or a 503.
+        """
+
+        self.requests += 1
+        spike = False
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+                self.baseline = latency
+            else:
+                self.latency += (latency - self.latency) * DEF_LATENCY_SMOOTHING
+                if latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += (latency - self.baseline) * DEF_BASELINE_DRIFT
+            spike = latency > max(self.baseline * self.tolerance, self.baseline + DEF_LATENCY_SLACK)
+
+        if congested | spike:
+            self.congestions += 1
+            if (start > self._last_decrease) & (self.limit > self.minimum):
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._last_decrease = time.monotonic()
+                self.decreases += 1
+        elif (self.in_flight >= int(self.limit)) & (self.limit < self.maximum):
+            # Only grow a limit in use, by 1 per limit requests
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.increases += 1
+        self._wake()
+
+    def metrics(self):
+        """
+        Current limit, requests in flight, latency estimates in ms and counters.
+        """
+
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "latency_ms": self.latency * 1000 if self.latency is not None else None,
+            "baseline_ms": self.baseline * 1000 if self.baseline is not None else None,
+            "requests": self.requests,
+            "congestions": self.congestions,
+            "increases": self.increases,
+            "decreases": self.decreases
+        }
+
+    def _wake(self):
+        """
+        Wake the waiters that fit below the limit.
+        """
+
+        free = int(self.limit) - self.in_flight
+        for waiter in self._waiters:
+            if free <= 0:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class _GatewayPool:
+    """
+    Persistent connections, adaptive concurrency limit, circuit breaker
+    and latency window of one DALION.
+    """
+
+    def __init__(self, host, port, limit, idle_timeout, breaker):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.limit = limit
+        self.breaker = breaker
+        self.latencies = collections.deque(maxlen=DEF_LATENCY_WINDOW)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._hedge_delay = None
+        self._idle = collections.deque()
+
+    def record(self, latency):
+        """
+        Add a latency sample.
+        """
+
+        self.latencies.append(latency)
+        self._hedge_delay = None
+
+    def hedge_delay(self):
+        """
+        Delay in seconds after which a read is hedged, the p95 latency,
+        None while there are too few samples.
+        """
+
+        if self._hedge_delay is None:
+            if len(self.latencies) < DEF_HEDGE_MIN_SAMPLES:
+                return None
+            values = sorted(self.latencies)
+            self._hedge_delay = values[min(len(values) - 1,
+                len(values) * DEF_HEDGE_PERCENTILE // 100)]
+        return self._hedge_delay
+
+    async def fetch(self, request, url):
+        """
+        Send an encoded HTTP GET request and return the response body.
+        """
+
+        while True:
+            reused = bool(self._evict())
+            if reused:
+                reader, writer, _ = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                writer.write(request)
+                status, reason, headers, body, will_close = await _read_response(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+                # A reused connection may have been closed by the DALION
+                # while idle, retry once on a new connection.
+                if reused:
+                    dalion_api_metrics.increment("dalion_retries_total",
+                        dalion_api_metrics.url_labels(url))
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if will_close:
+                writer.close()
+            else:
+                self._idle.append((reader, writer, time.monotonic()))
+            break
+
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, headers, None)
+
+        return body
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+
+        while self._idle:
+            _, writer, _ = self._idle.popleft()
+            writer.close()
+
+    def _evict(self):
+        """
+        Close the connections idle for longer than idle_timeout.
+        Returns the number of idle connections left.
+        """
+
+        limit = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][2] < limit:
+            _, writer, _ = self._idle.popleft()
+            writer.close()
+        return len(self._idle)
+
+
+async def _read_response(reader):
+    """
+    Read an HTTP/1.1 response.
+    Returns the status, reason, headers, body and whether the connection closes.
+    """
+
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError("Connection closed by the DALION.")
+    parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    version = parts[0]
+    status = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ""
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get("connection", "").lower()
+    will_close = (connection == "close") | ((version == "HTTP/1.0") & (connection != "keep-alive"))
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Trailer
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        will_close = True
+
+    return status, reason, headers, body, will_close
+
+
+async def _within(awaitable, deadline):
+    """
+    Await within a deadline (time.monotonic()), None for no deadline.
+    """
+
+    if deadline is None:
+        return await awaitable
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        awaitable.close()
+        raise TimeoutError("Deadline exceeded")
+    return await asyncio.wait_for(awaitable, remaining)
+
+
+def cvalue_arguments(valcvalue):
+    """
+    Convert a dict of cvalue fields to the cvalue arguments of
+    dalion_api_set_colour.prepare_url, the other fields keep their default.
+    """
+
+    defaults = dalion_api_set_colour.DEF_DEFAULT_CVALUE['value']
+    return [valcvalue.get(key, defaults[key]) for key in DEF_CVALUE_FIELDS]
+
+
+def encode_request(host, port, path):
+    """
+    Encode the HTTP GET request of a path.
+    """
+
+    hostname = host if port == 80 else host + ":" + str(port)
+    return ("GET " + path + " HTTP/1.1\r\nHost: " + hostname + "\r\n\r\n").encode("latin-1")
+
+
+def split_url(url):
+    """
+    Split a URL into host, port and path with query.
+    """
+
+    split = urllib.parse.urlsplit(url)
+    path = split.path
+    if split.query:
+        path += "?" + split.query
+    return split.hostname, split.port or 80, path
+
+
+class AsyncClient:
+    """
+    asyncio client for one or many DALIONs.
+    An optional dalion_api_cache.DeviceCache serves get_device reads and is
+    invalidated by the set_device and set_colour writes.
+    gateway_concurrency is the initial limit of each DALION, adapted between
+    1 and max_gateway_concurrency; set both equal for a fixed limit.
+    timeout is the default deadline budget of an operation, hedge enables
+    the hedged reads.
+    """
+
+    def __init__(self, gateway_concurrency=DEF_GATEWAY_CONCURRENCY,
+            max_concurrency=DEF_MAX_CONCURRENCY, idle_timeout=DEF_IDLE_TIMEOUT, cache=None,
+            max_gateway_concurrency=DEF_MAX_GATEWAY_CONCURRENCY, timeout=DEF_TIMEOUT,
+            hedge=True, breaker_threshold=DEF_BREAKER_THRESHOLD, breaker_reset=DEF_BREAKER_RESET):
+        self.gateway_concurrency = gateway_concurrency
+        self.max_gateway_concurrency = max(gateway_concurrency, max_gateway_concurrency)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.hedge = hedge
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.cache = cache
+        self._write_listeners = []
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pools = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """
+        Close every pooled connection.
+        """
+
+        for pool in self._pools.values():
+            pool.close()
+        self._pools.clear()
+
+    def _pool(self, host, port):
+        """
+        Get the connection pool of a DALION.
+        """
+
+        key = (host, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            minimum = DEF_MIN_GATEWAY_CONCURRENCY
+            if self.max_gateway_concurrency == self.gateway_concurrency:
+                minimum = self.gateway_concurrency
+            limit = AdaptiveLimit(self.gateway_concurrency, minimum, self.max_gateway_concurrency)
+            breaker = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            pool = _GatewayPool(host, port, limit, self.idle_timeout, breaker)
+            self._pools[key] = pool
+        return pool
+
+    def metrics(self):
+        """
+        Concurrency limit, latency estimates, hedges and circuit breaker
+        state of every DALION, a dict {"host:port": metrics}.
+        """
+
+        metrics = {}
+        for (host, port), pool in self._pools.items():
+            values = pool.limit.metrics()
+            delay = pool.hedge_delay()
+            values["hedge_delay_ms"] = delay * 1000 if delay is not None else None
+            values["hedges"] = pool.hedges
+            values["hedge_wins"] = pool.hedge_wins
+            values["breaker"] = pool.breaker.state
+            values["breaker_opened"] = pool.breaker.opened
+            values["breaker_rejected"] = pool.breaker.rejected
+            metrics[host + ":" + str(port)] = values
+        return metrics
+
+    def deadline(self, timeout=None):
+        """
+        Deadline (time.monotonic()) of an operation of timeout seconds,
+        the client timeout by default, None for no deadline.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def budget(self, deadline):
+        """
+        Timeout of a request of a bulk operation ending at deadline
+        (time.monotonic()), at most the client timeout.
+        """
+
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if self.timeout is None:
+            return remaining
+        return min(remaining, self.timeout)
+
+    async def send_request(self, url, timeout=None):
+        """
+        Send the HTTP GET request and return the response body.
+        """
+
+        host, port, path = split_url(url)
+        return await self._send(self._pool(host, port), encode_request(host, port, path), url,
+            self.deadline(timeout))
+
+    async def send_prepared(self, host, port, request, url="", timeout=None):
+        """
+        Send a request encoded once by encode_request and return the response body.
+        """
+
+        return await self._send(self._pool(host, port), request, url, self.deadline(timeout))
+
+    async def _read(self, url, timeout=None):
+        """
+        Send an idempotent HTTP GET request and return the response body.
+        A duplicate is sent if the request is slower than the hedge delay
+        of the DALION, the first response wins.
+        """
+
+        host, port, path = split_url(url)
+        pool = self._pool(host, port)
+        request = encode_request(host, port, path)
+        deadline = self.deadline(timeout)
+        delay = pool.hedge_delay() if self.hedge else None
+        if delay is None:
+            return await self._send(pool, request, url, deadline)
+
+        primary = asyncio.ensure_future(self._send(pool, request, url, deadline))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # A duplicate waiting for a slot would only add load
+            if (not done) & (pool.breaker.state == "closed") & (
+                    pool.limit.in_flight < int(pool.limit.limit)):
+                pool.hedges += 1
+                tasks.add(asyncio.ensure_future(self._send(pool, request, url, deadline)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            pool.hedge_wins += 1
+                        return task.result()
+                    if (error is None) | (task is primary):
+                        error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @dalion_api_tracing.traced("send_request")
+    async def _send(self, pool, request, url, deadline=None):
+        """
+        Send an encoded request within the concurrency limits and the
+        deadline (time.monotonic()), recording its metrics.
+        """
+
+        labels = dalion_api_metrics.url_labels(url)
+        try:
+            body = await self._send_limited(pool, request, url, deadline, labels)
+        except Exception as exc:
+            dalion_api_metrics.error(labels, exc)
+            raise
+        dalion_api_metrics.observe("dalion_response_bytes", labels, len(body))
+        return body
+
+    async def _send_limited(self, pool, request, url, deadline, labels):
+        """
+        Send an encoded request within the concurrency limits and the deadline.
+        """
+
+        if not pool.breaker.allow():
+            raise CircuitOpenError("Circuit breaker open: " + pool.host + ":" + str(pool.port))
+
+        # Wait for the DALION first so that a busy DALION does not hold
+        # global slots needed by the others.
+        limit = pool.limit
+        if not limit.try_acquire():
+            await _within(limit.acquire(), deadline)
+        try:
+            if self._semaphore.locked():
+                await _within(self._semaphore.acquire(), deadline)
+            else:
+                await self._semaphore.acquire()
+            try:
+                start = time.monotonic()
+                if (deadline is not None) and (start >= deadline):
+                    raise TimeoutError("Deadline exceeded")
+                try:
+                    body = await _within(pool.fetch(request, url), deadline)
+                except urllib.error.HTTPError as exc:
+                    limit.sample(start, time.monotonic() - start, exc.code == 503)
+                    if exc.code == 503:
+                        pool.breaker.failure()
+                    else:
+                        pool.breaker.success()
+                    raise
+                except (OSError, EOFError):
+                    # Timeouts and connection errors
+                    limit.sample(start, None, True)
+                    pool.breaker.failure()
+                    raise
+                latency = time.monotonic() - start
+                limit.sample(start, latency, False)
+                pool.breaker.success()
+                pool.record(latency)
+                dalion_api_metrics.observe("dalion_request_seconds", labels, latency)
+                return body
+            finally:
+                self._semaphore.release()
+        finally:
+            limit.release()
+
+    async def get_device(self, valip, valch, valc, valii, valid, timeout=None):
+        """
+        Get a variable of a lamp, group or channel.
+        """
+
+        if self.cache is not None:
+            hit, value = self.cache.get(valip, valch, valc, valii, valid)
+            if hit:
+                return value
+
+        url = dalion_api_get_device.prepare_url(valip, str(valch), valc, str(valii))
+        generation = self.cache.generation(valip, valch) if self.cache is not None else None
+        response = await self._read(url, timeout)
+        with dalion_api_tracing.span("parse_response"):
+            response = dalion_api_metrics.loads(response, dalion_api_metrics.url_labels(url))
+            if self.cache is not None:
+                self.cache.put_response(valip, valch, valc, valii, response, generation)
+            return dalion_api_get_device.parse_response(response, valid)
+
+    async def get_record(self, valip, valch, valc, valii, timeout=None):
+        """
+        Get every variable of a lamp, group or channel with a single request.
+        Returns a dalion_api_get_device.DeviceRecord.
+        """
+
+        url = dalion_api_get_device.prepare_url(valip, str(valch), valc, str(valii))
+        generation = self.cache.generation(valip, valch) if self.cache is not None else None
+        response = await self._read(url, timeout)
+        with dalion_api_tracing.span("parse_response"):
+            response = dalion_api_metrics.loads(response, dalion_api_metrics.url_labels(url))
+            if self.cache is not None:
+                self.cache.put_response(valip, valch, valc, valii, response, generation)
+            return dalion_api_get_device.DeviceRecord(response)
+
+    def add_write_listener(self, callback):
+        """
+        Call callback(valip, valch, valc, valii, valid, valv) after every
+        successful set_device, e.g. dalion_api_groups.GroupIndex.on_write.
+        An exception of a listener is logged, the write still succeeds.
+        """
+
+        self._write_listeners.append(callback)
+
+    def remove_write_listener(self, callback):
+        """
+        Stop calling callback.
+        """
+
+        self._write_listeners.remove(callback)
+
+    def written(self, valip, valch, valc, valii, valid=None, valv=None):
+        """
+        Run the hooks of a write sent to a lamp, group or channel: invalidate
+        its cache entries and, for a variable write, call the write listeners.
+        valid None is a colour write, every variable of the target is invalidated.
+        """
+
+        if self.cache is not None:
+            self.cache.invalidate(valip, valch, valc, valii, valid)
+        if valid is not None:
+            for listener in self._write_listeners:
+                try:
+                    listener(valip, valch, valc, valii, valid, valv)
+                except Exception:
+                    # The write was applied
+                    _logger.exception("Write listener %r failed", listener)
+
+    async def set_device(self, valip, valch, valc, valii, valid, valv, timeout=None):
+        """
+        Set a variable of a lamp, group or channel.
+        """
+
+        variable = device_variables.find_variable(valid)
+        url = dalion_api_set_device.prepare_url(valip, str(valch), valc, str(valii), valv, variable)
+        response = await self.send_request(url, timeout)
+        self.written(valip, valch, valc, valii, valid, valv)
+        return response
+
+    async def set_variables(self, valip, valch, valc, valii, values, timeout=None):
+        """
+        Set many variables of a lamp, group or channel with a single request.
+        values is a dict id -> value.
+        """
+
+        for valid in values:
+            device_variables.find_variable(valid)
+        url = dalion_api_set_device.prepare_variables_url(valip, str(valch), valc, str(valii), values)
+        response = await self.send_request(url, timeout)
+        for valid, valv in values.items():
+            self.written(valip, valch, valc, valii, valid, valv)
+        return response
+
+    async def set_colour(self, valip, valch, valc, valii, valcid, valctype, valcvalue, timeout=None):
+        """
+        Set the colour of a lamp, group or channel.
+        valcvalue is a dict of the cvalue fields to set, e.g. {"tc": 250}.
+        """
+
+        url = dalion_api_set_colour.prepare_url(valip, str(valch), valc, valii,
+            valcid, valctype, *cvalue_arguments(valcvalue))
+        response = await self.send_request(url, timeout)
+        self.written(valip, valch, valc, valii)
+        return response
+
+    async def set_colour_batch(self, valip, valch, valc, valiis, valcid, valctype, valcvalue,
+            max_url_length=dalion_api_set_colour.DEF_MAX_URL_LENGTH, timeout=None):
+        """
+        Set the same colour on many lamps or groups of a channel
+        with as few requests as max_url_length allows.
+        Returns the list of responses or exceptions, a TimeoutError for
+        the requests unfinished at the deadline.
+        """
+
+        urls = dalion_api_set_colour.prepare_batch_urls(valip, str(valch), valc, valiis,
+            valcid, valctype, *cvalue_arguments(valcvalue), max_url_length=max_url_length)
+        responses = await asyncio.gather(*[self.send_request(url, timeout) for url in urls],
+            return_exceptions=True)
+        for valii in valiis:
+            self.written(valip, valch, valc, valii)
+        return responses
+
+    async def get(self, valip, valch, timeout=None):
+        """
+        Get the control devices of a channel (action=get).
+        Returns the decoded JSON response.
+        """
+
+        url = dalion_api_get_control_device.prepare_url(valip, str(valch))
+        response = await self._read(url, timeout)
+        with dalion_api_tracing.span("parse_response"):
+            return dalion_api_metrics.loads(response, dalion_api_metrics.url_labels(url))
+
+    async def get_snapshot(self, valip, valch, timeout=None):
+        """
+        Get every control device of a channel with a single request.
+        Returns a dalion_api_get_control_device.ControlDeviceSnapshot.
+        """
+
+        url = dalion_api_get_control_device.prepare_url(valip, str(valch))
+        response = await self._read(url, timeout)
+        with dalion_api_tracing.span("parse_response"):
+            return dalion_api_get_control_device.ControlDeviceSnapshot(
+                dalion_api_metrics.loads(response, dalion_api_metrics.url_labels(url)))
+
+    async def get_control_device(self, valip, valch, valii, valid, timeout=None):
+        """
+        Get a variable of a control device.
+        """
+
+        snapshot = await self.get_snapshot(valip, valch, timeout)
+        return snapshot.get(valii, valid)
+
+    async def sweep(self, valips, channels=DEF_CHANNELS, timeout=None):
+        """
+        Get the control devices of every channel of every DALION concurrently.
+        Returns a dict {(ip, channel): response or exception} once every
+        request completed or the deadline passed.
+        """
+
+        keys = [(valip, valch) for valip in valips for valch in channels]
+        results = await asyncio.gather(*[self.get(valip, valch, timeout) for valip, valch in keys],
+            return_exceptions=True)
+        return dict(zip(keys, results))
+
+
+async def run_sweep(valips):
+    """
+    Sweep the DALIONs and print the result of each channel.
+    """
+
+    async with AsyncClient() as client:
+        start = time.perf_counter()
+        results = await client.sweep(valips)
+        elapsed = time.perf_counter() - start
+        metrics = client.metrics()
+
+    for (valip, valch), result in results.items():
+        if isinstance(result, BaseException):
+            print(valip, valch, "error:", result)
+        else:
+            devices = result['data']['control_devices']['devices']
+            print(valip, valch, len(devices), "control devices")
+    print("")
+    print("{} requests in {:.3f} s".format(len(results), elapsed))
+    for gateway, values in metrics.items():
+        print(gateway, "limit", values["limit"], "latency", values["latency_ms"], "ms")
+
+
+def main():
+    """
+    main
+    """
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit()
+
+    asyncio.run(run_sweep(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
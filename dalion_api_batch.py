@@ -0,0 +1,226 @@
+"""
+dalion_api_batch.py
+
+Runs many set_device commands from a single process.
+The commands are read as JSON lines from a file or stdin, validated with
+dalion_api_set_device.valid_arguments and sent concurrently per DALION.
+A JSON line with the result and timing of every command is written to
+stdout as soon as the command completes, a summary is written to stderr.
+
+Usage - Command line arguments
+dalion_api_batch.py [file]
+dalion_api_set_device.py --batch [file]
+dalion_api_set_level.py --batch [file]
+
+file: JSON lines file of commands, stdin if missing or -.
+
+A command is an object
+{"ip": "192.168.0.210", "channel": 1, "destination": 1, "index": 0, "id": "dval", "value": 50}
+or an array in the same order
+["192.168.0.210", 1, 1, 0, "dval", 50]
+id defaults to dval, the light intensity in percent.
+
+Examples:
+Set the lamps of commands.jsonl and keep the results.
+dalion_api_batch.py commands.jsonl > results.jsonl
+
+Set the lamps from a generator.
+generate_commands | dalion_api_set_device.py --batch
+"""
+
+import io
+import sys
+import json
+import time
+import asyncio
+
+import dalion_api_async_client
+import dalion_api_set_device
+import dalion_api_tracing
+import device_variables
+
+
+DEF_FIELDS = ("ip", "channel", "destination", "index", "id", "value")
+
+"""
+"" Fields of a command.
+"""
+
+DEF_MAX_PENDING = 1024
+
+"""
+"" Maximum number of commands read ahead of the completed ones.
+"""
+
+
+def parse_command(line):
+    """
+    Parse a JSON line command into a dict of DEF_FIELDS.
+    """
+
+    command = json.loads(line)
+    if isinstance(command, list):
+        command = dict(zip(DEF_FIELDS, command))
+    if not isinstance(command, dict):
+        raise ValueError("A command is a JSON object or list")
+    command.setdefault("id", "dval")
+    return command
+
+
+def validate_command(command):
+    """
+    Valid a command with dalion_api_set_device.valid_arguments.
+    Returns the arguments of the request and the error messages.
+    """
+
+    try:
+        valip = str(command["ip"])
+        valch = str(command["channel"])
+        valc = int(command["destination"])
+        valii = str(command.get("index", -1))
+        valid = command["id"]
+        valv = str(command["value"])
+        variable = device_variables.find_variable(valid)
+    except (KeyError, TypeError, ValueError) as exc:
+        return None, "Invalid command: " + str(exc)
+
+    messages = io.StringIO()
+    try:
+        bvalid = dalion_api_set_device.valid_arguments(valip, valch, valc, valii,
+            valid, valv, variable, out=messages)
+    except (TypeError, ValueError) as exc:
+        return None, "Invalid command: " + str(exc)
+    if bvalid is False:
+        return None, " ".join(messages.getvalue().split("\n")).strip()
+
+    return (valip, valch, valc, valii, valid, valv), None
+
+
+async def run_command(client, number, command, out):
+    """
+    Send a command and write its result.
+    Returns True on success.
+    """
+
+    result = {"line": number}
+    result.update(command)
+
+    start = time.perf_counter()
+    arguments, error = validate_command(command)
+    if arguments is not None:
+        try:
+            response = await client.set_device(*arguments)
+            result["response"] = response.decode("utf-8", "replace")
+        except Exception as exc:
+            error = type(exc).__name__ + ": " + str(exc)
+    result["ok"] = error is None
+    if error is not None:
+        result["error"] = error
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+    out.write(json.dumps(result) + "\n")
+    out.flush()
+    return result["ok"]
+
+
+async def read_lines(lines):
+    """
+    Async iterator of the lines of an iterable or stream.
+    A pipe or terminal is read in a thread, so that the commands already
+    read run while the producer is slow.
+    """
+
+    try:
+        seekable = lines.seekable()
+    except (AttributeError, OSError, ValueError):
+        seekable = True
+    if seekable:
+        for line in lines:
+            yield line
+        return
+
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, lines.readline)
+        if not line:
+            return
+        yield line
+
+
+async def run_batch(lines, out=sys.stdout,
+        gateway_concurrency=dalion_api_async_client.DEF_GATEWAY_CONCURRENCY,
+        max_concurrency=dalion_api_async_client.DEF_MAX_CONCURRENCY):
+    """
+    Run the commands of an iterable or stream of JSON lines, each command
+    starts as soon as its line is read.
+    Returns the number of succeeded and failed commands.
+    """
+
+    succeeded = 0
+    failed = 0
+    pending = set()
+
+    def collect(done):
+        nonlocal succeeded, failed
+        for task in done:
+            if task.result():
+                succeeded += 1
+            else:
+                failed += 1
+
+    # The tasks inherit the correlation id of the batch
+    with dalion_api_tracing.batch():
+        async with dalion_api_async_client.AsyncClient(gateway_concurrency, max_concurrency) as client:
+            number = 0
+            async for line in read_lines(lines):
+                number += 1
+                if not line.strip():
+                    continue
+                try:
+                    command = parse_command(line)
+                except (TypeError, ValueError) as exc:
+                    out.write(json.dumps({"line": number, "ok": False,
+                        "error": "Invalid JSON: " + str(exc)}) + "\n")
+                    failed += 1
+                    continue
+
+                pending.add(asyncio.ensure_future(run_command(client, number, command, out)))
+                if len(pending) >= DEF_MAX_PENDING:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                else:
+                    # Let the command start before the next line
+                    await asyncio.sleep(0)
+
+            if pending:
+                done, _ = await asyncio.wait(pending)
+                collect(done)
+
+    return succeeded, failed
+
+
+def main(argv=None):
+    """
+    main
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    path = argv[0] if argv else "-"
+
+    start = time.perf_counter()
+    if path == "-":
+        succeeded, failed = asyncio.run(run_batch(sys.stdin))
+    else:
+        with open(path, encoding="utf-8") as lines:
+            succeeded, failed = asyncio.run(run_batch(lines))
+    elapsed = time.perf_counter() - start
+
+    total = succeeded + failed
+    sys.stderr.write("{} commands, {} succeeded, {} failed in {:.3f} s ({:.1f} commands/s)\n".format(
+        total, succeeded, failed, elapsed, total / elapsed if elapsed else 0.0))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
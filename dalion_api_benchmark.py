@@ -0,0 +1,364 @@
+"""
+dalion_api_benchmark.py
+
+Benchmark suite of the DALION API operations.
+Measures prepare_url of every script, the set_colour cvalue JSON build and
+quote_plus, parse_response of realistic 64 device payloads and the end to
+end operations per second and p50/p99 latency against a local
+dalion_api_simulator. Results are stored as JSON baselines and compared
+to flag the regressions.
+
+Usage - Command line arguments
+dalion_api_benchmark.py run [--output file] [--quick] [--latency s] [--filter text]
+dalion_api_benchmark.py compare baseline current [--threshold percent]
+
+Examples:
+Store a baseline.
+dalion_api_benchmark.py run --output baseline.json
+
+Flag the benchmarks more than 10% slower than the baseline.
+dalion_api_benchmark.py run --output current.json
+dalion_api_benchmark.py compare baseline.json current.json --threshold 10
+"""
+
+import sys
+import json
+import time
+import timeit
+import asyncio
+import argparse
+import platform
+
+import dalion_api_async_client
+import dalion_api_get_control_device
+import dalion_api_get_device
+import dalion_api_set_colour
+import dalion_api_set_device
+import dalion_api_set_level
+import dalion_api_simulator
+import dalion_api_tracing
+import dalion_api_transport
+import device_variables
+
+
+DEF_THRESHOLD = 10.0
+
+"""
+"" Default regression threshold in percent.
+"""
+
+DEF_METRICS = {"ops_per_sec": 1, "p50_ms": -1, "p99_ms": -1}
+
+"""
+"" Compared metrics, 1 when higher is better, -1 when lower is better.
+"""
+
+DEF_IP = "192.168.0.210"
+
+"""
+"" IP address used by the micro-benchmarks.
+"""
+
+DEF_E2E_BENCHMARKS = ("e2e.get_device", "e2e.set_device", "e2e.set_colour", "e2e.get",
+    "e2e.async.get_device")
+
+"""
+"" Names of the end-to-end benchmarks, run against a local simulator.
+"""
+
+DEF_CVALUE = {
+    16:  {"xx": 20000, "xy": 21000},
+    32:  {"tc": 333},
+    64:  {"p0": 1, "p1": 2, "p2": 3, "p3": 4, "p4": 5, "p5": 6},
+    128: {"rr": 255, "rg": 128, "rb": 0, "rw": 10, "ra": 20, "rf": 30}
+}
+
+"""
+"" cvalue per ctype.
+"""
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """
+    Measure a function like timeit, best of repeat runs of at least min_time.
+    """
+
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    best = min(timer.repeat(repeat, number)) / number
+    return {"ops_per_sec": 1 / best, "mean_us": best * 1e6}
+
+
+def measure_latency(func, count):
+    """
+    Call a function count times and measure every call.
+    """
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        begin = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    return latency_result(latencies, elapsed)
+
+
+def latency_result(latencies, elapsed):
+    """
+    Operations per second and percentiles of latencies.
+    """
+
+    latencies = sorted(latencies)
+    return {
+        "ops_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000
+    }
+
+
+def percentile(values, percent):
+    """
+    Percentile of sorted values, nearest rank.
+    """
+
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def cvalue_arguments(valctype):
+    """
+    cvalue arguments of prepare_url for a ctype.
+    """
+
+    return dalion_api_async_client.cvalue_arguments(DEF_CVALUE[valctype])
+
+
+def micro_benchmarks():
+    """
+    prepare_url and cvalue encoding benchmarks.
+    """
+
+    dval = device_variables.find_variable("dval")
+    dvgr = device_variables.find_variable("dvgr")
+
+    benchmarks = {
+        "prepare_url.get_device":
+            lambda: dalion_api_get_device.prepare_url(DEF_IP, "1", 1, "0"),
+        "prepare_url.get_control_device":
+            lambda: dalion_api_get_control_device.prepare_url(DEF_IP, "1"),
+        "prepare_url.set_device.dval":
+            lambda: dalion_api_set_device.prepare_url(DEF_IP, "1", 1, "0", "50", dval),
+        "prepare_url.set_device.dvgr":
+            lambda: dalion_api_set_device.prepare_url(DEF_IP, "1", 1, "0", "7", dvgr),
+        "prepare_url.set_level":
+            lambda: dalion_api_set_level.prepare_url(DEF_IP, "1", 1, "0", "50"),
+        "prepare_batch_urls.set_colour.64":
+            lambda: dalion_api_set_colour.prepare_batch_urls(DEF_IP, "1", 1, range(64),
+                "d8ac", 32, *cvalue_arguments(32)),
+    }
+    for valctype in DEF_CVALUE:
+        arguments = cvalue_arguments(valctype)
+        benchmarks["prepare_url.set_colour." + str(valctype)] = (
+            lambda arguments=arguments, valctype=valctype:
+                dalion_api_set_colour.prepare_url(DEF_IP, "1", 1, 0, "d8ac", valctype, *arguments))
+
+    arguments = cvalue_arguments(32)
+
+    def prepare_cvalue_cold():
+        dalion_api_set_colour.encode_cvalue.cache_clear()
+        return dalion_api_set_colour.prepare_cvalue(32, *arguments)
+
+    benchmarks["set_colour.prepare_cvalue.cached"] = (
+        lambda: dalion_api_set_colour.prepare_cvalue(32, *arguments))
+    benchmarks["set_colour.prepare_cvalue.cold"] = prepare_cvalue_cold
+
+    return benchmarks
+
+
+def parse_benchmarks():
+    """
+    parse_response benchmarks of realistic payloads.
+    """
+
+    state = dalion_api_simulator.SimulatorState()
+    device = json.dumps(state.get_device_response(1, 0)).encode("utf-8")
+    control_devices = json.dumps(state.get_response(1)).encode("utf-8")
+
+    return {
+        "parse_response.get_device":
+            lambda: dalion_api_get_device.parse_response(device, "dvrh"),
+        "record.get_device":
+            lambda: dalion_api_get_device.DeviceRecord(device),
+        "parse_response.get_control_device.64":
+            lambda: dalion_api_get_control_device.parse_response(control_devices, 63, "os"),
+        "snapshot.get_control_device.64":
+            lambda: dalion_api_get_control_device.ControlDeviceSnapshot(control_devices),
+    }
+
+
+def end_to_end_benchmarks(valip, count, names=DEF_E2E_BENCHMARKS):
+    """
+    Operations against a DALION through the shared transport, one at a time,
+    those of names only.
+    """
+
+    dval = device_variables.find_variable("dval")
+    urls = {
+        "e2e.get_device": dalion_api_get_device.prepare_url(valip, "1", 1, "0"),
+        "e2e.set_device": dalion_api_set_device.prepare_url(valip, "1", 1, "0", "50", dval),
+        "e2e.set_colour": dalion_api_set_colour.prepare_url(valip, "1", 1, 0, "d8ac", 32,
+            *cvalue_arguments(32)),
+        "e2e.get": dalion_api_get_control_device.prepare_url(valip, "1"),
+    }
+
+    results = {}
+    for name, url in urls.items():
+        if name not in names:
+            continue
+        dalion_api_transport.send_request(url)
+        results[name] = measure_latency(lambda url=url: dalion_api_transport.send_request(url), count)
+    return results
+
+
+async def async_benchmark(valip, count):
+    """
+    Concurrent get_device over the 64 lamps of the 4 channels with AsyncClient.
+    """
+
+    latencies = []
+
+    async def get(client, valch, valii):
+        begin = time.perf_counter()
+        await client.get_device(valip, valch, 1, valii, "dval")
+        latencies.append(time.perf_counter() - begin)
+
+    async with dalion_api_async_client.AsyncClient() as client:
+        await client.get_device(valip, 1, 1, 0, "dval")
+        start = time.perf_counter()
+        await asyncio.gather(*[get(client, 1 + number % 4, number % 64) for number in range(count)])
+        elapsed = time.perf_counter() - start
+
+    return latency_result(latencies, elapsed)
+
+
+def run(quick=False, latency=0.0, name_filter=None, log=sys.stderr):
+    """
+    Run the suite, returns the results document.
+    """
+
+    repeat = 3 if quick else 5
+    min_time = 0.05 if quick else 0.2
+    count = 100 if quick else 500
+
+    results = {}
+
+    def selected(name):
+        return (name_filter is None) or (name_filter in name)
+
+    for name, func in list(micro_benchmarks().items()) + list(parse_benchmarks().items()):
+        if selected(name):
+            results[name] = measure(func, repeat, min_time)
+            log.write("{:45} {:12.1f} ops/s\n".format(name, results[name]["ops_per_sec"]))
+
+    e2e = [name for name in DEF_E2E_BENCHMARKS if selected(name)]
+    if e2e:
+        with dalion_api_simulator.Simulator(latency=latency, max_connections=256) as simulator:
+            results.update(end_to_end_benchmarks(simulator.address, count, e2e))
+            if "e2e.async.get_device" in e2e:
+                results["e2e.async.get_device"] = asyncio.run(async_benchmark(simulator.address,
+                    count * 4))
+            dalion_api_transport.close()
+        for name, result in results.items():
+            if name.startswith("e2e"):
+                log.write("{:45} {:12.1f} ops/s  p50 {:8.3f} ms  p99 {:8.3f} ms\n".format(
+                    name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"]))
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+            "latency": latency
+        },
+        "results": results
+    }
+
+
+def compare(baseline, current, threshold=DEF_THRESHOLD):
+    """
+    Compare two results documents.
+    Returns the list of (name, metric, baseline, current, change in percent)
+    regressions beyond threshold percent.
+    """
+
+    regressions = []
+    for name, base in baseline["results"].items():
+        result = current["results"].get(name)
+        if result is None:
+            continue
+        for metric, sign in DEF_METRICS.items():
+            value = base.get(metric)
+            if (metric not in result) or (not value):
+                continue
+            change = (result[metric] - value) / value * 100
+            if change * sign < -threshold:
+                regressions.append((name, metric, value, result[metric], change))
+    return regressions
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="DALION API benchmark suite.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = commands.add_parser("run", help="Run the benchmarks.")
+    parser_run.add_argument("--output", help="JSON file of the results.")
+    parser_run.add_argument("--quick", action="store_true", help="Fewer iterations.")
+    parser_run.add_argument("--latency", type=float, default=0.0,
+        help="Simulator latency in seconds for the end to end benchmarks.")
+    parser_run.add_argument("--filter", help="Run the benchmarks whose name contains this text.")
+
+    parser_compare = commands.add_parser("compare", help="Compare two results files.")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("current")
+    parser_compare.add_argument("--threshold", type=float, default=DEF_THRESHOLD,
+        help="Regression threshold in percent.")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        document = run(args.quick, args.latency, args.filter)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output:
+                json.dump(document, output, indent=2)
+        else:
+            print(json.dumps(document, indent=2))
+        return
+
+    with open(args.baseline, encoding="utf-8") as baseline:
+        baseline = json.load(baseline)
+    with open(args.current, encoding="utf-8") as current:
+        current = json.load(current)
+
+    regressions = compare(baseline, current, args.threshold)
+    for name, metric, base, value, change in regressions:
+        print("REGRESSION {:45} {:12} {:12.3f} -> {:12.3f} ({:+.1f}%)".format(
+            name, metric, base, value, change))
+    if regressions:
+        sys.exit(1)
+    print("No regression beyond {}%.".format(args.threshold))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,116 @@
+"""
+dalion_api_benchmark_transport.py
+
+Compares the requests per second of a new connection per request
+(urllib.request.urlopen) against the pooled keep-alive transport.
+
+Usage - Command line arguments
+dalion_api_benchmark_transport.py ip channel [count] [threads]
+
+ip: The DALION IP address, or simulator for a local dalion_api_simulator.
+channel: The channel number, 1-4.
+count: The number of requests per run, default 200.
+threads: The number of concurrent threads, default 1.
+
+Examples:
+Send 200 get_device requests to the lamp 0 of the channel 1 with each transport.
+dalion_api_benchmark_transport.py 192.168.0.210 1
+
+Send 1000 requests from 4 threads with each transport.
+dalion_api_benchmark_transport.py 192.168.0.210 1 1000 4
+
+Measure against a local simulated DALION.
+dalion_api_benchmark_transport.py simulator 1 1000 4
+"""
+
+import sys
+import time
+import urllib.request
+import concurrent.futures
+
+import dalion_api_get_device
+import dalion_api_simulator
+import dalion_api_tracing
+import dalion_api_transport
+
+
+def send_urlopen(url):
+    """
+    Send the HTTP GET request on a new connection.
+    """
+
+    return urllib.request.urlopen(url).read()
+
+
+def send_pooled(url):
+    """
+    Send the HTTP GET request through the pooled transport.
+    """
+
+    return dalion_api_transport.send_request(url)
+
+
+def run(send, url, count, threads):
+    """
+    Send count requests from threads workers.
+    Returns the number of requests per second.
+    """
+
+    start = time.perf_counter()
+    if threads <= 1:
+        for _ in range(count):
+            send(url)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            for _ in executor.map(send, [url] * count):
+                pass
+    elapsed = time.perf_counter() - start
+
+    return count / elapsed
+
+
+def main():
+    """
+    main
+    """
+
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit()
+
+    valip = sys.argv[1]
+    valch = sys.argv[2]
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    simulator = None
+    if valip == "simulator":
+        simulator = dalion_api_simulator.Simulator(max_connections=max(threads, 1) * 4 + 16)
+        simulator.start()
+        valip = simulator.address
+
+    url = dalion_api_get_device.prepare_url(valip, valch, 1, "0")
+
+    dalion_api_transport.configure(pool_size=max(threads, 1))
+
+    # Warm up both paths
+    send_urlopen(url)
+    send_pooled(url)
+
+    rate_urlopen = run(send_urlopen, url, count, threads)
+    rate_pooled = run(send_pooled, url, count, threads)
+
+    print("Request: ")
+    print(url)
+    print("")
+    print("urlopen:   {:10.1f} req/s".format(rate_urlopen))
+    print("pooled:    {:10.1f} req/s".format(rate_pooled))
+    print("speedup:   {:10.2f} x".format(rate_pooled / rate_urlopen))
+
+    dalion_api_transport.close()
+    if simulator is not None:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,198 @@
+"""
+dalion_api_cache.py
+
+In-process read-through cache of the device variables read with get_device.
+Entries are keyed by (DALION, channel, lamp/group/channel, variable id) and
+expire after a per-variable time to live: static variables such as dvsa and
+dvgr live much longer than dval. The least recently used entries are evicted
+once max_entries is reached.
+Every write bumps the generation of its channel: a response read before
+a write, e.g. in flight while it completed, is not cached.
+
+Usage
+import dalion_api_async_client
+import dalion_api_cache
+
+cache = dalion_api_cache.DeviceCache()
+client = dalion_api_async_client.AsyncClient(cache=cache)
+...
+print(cache.stats())
+"""
+
+import time
+import collections
+
+import dalion_api_get_device
+import dalion_api_metrics
+import device_variables
+
+
+DEF_TTL = 2.0
+
+"""
+"" Default time to live in seconds.
+"""
+
+DEF_VARIABLE_TTL = {
+    "dval": 2.0,
+    "na":   3600.0,
+    "dvpl": 600.0,
+    "dvsl": 600.0,
+    "dvnl": 600.0,
+    "dvxl": 600.0,
+    "dvfr": 600.0,
+    "dvft": 600.0,
+    "dvgr": 3600.0,
+    "dvsa": 3600.0,
+    "dvrh": 60.0,
+    "dvbi": 60.0
+}
+
+"""
+"" Time to live in seconds per variable id.
+"""
+
+DEF_MAX_ENTRIES = 16384
+
+"""
+"" Default maximum number of cached variables.
+"""
+
+
+class DeviceCache:
+    """
+    TTL and LRU cache of device variables.
+    """
+
+    def __init__(self, ttl=None, default_ttl=DEF_TTL, max_entries=DEF_MAX_ENTRIES,
+            clock=time.monotonic):
+        self.ttl = dict(DEF_VARIABLE_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        # key -> (value, expiry), least recently used first
+        self._entries = collections.OrderedDict()
+        # (DALION, channel) -> keys
+        self._channels = {}
+        # (DALION, channel) -> writes
+        self._generations = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, valip, valch, valc, valii, valid):
+        """
+        Get a cached variable.
+        Returns (True, value) on a hit and (False, None) on a miss.
+        """
+
+        key = device_variables.target_key(valip, valch, valc, valii) + (valid,)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                dalion_api_metrics.increment("dalion_cache_hits_total",
+                    (valip, str(valch), "get_device"))
+                return True, entry[0]
+            self._remove(key)
+        self.misses += 1
+        dalion_api_metrics.increment("dalion_cache_misses_total", (valip, str(valch), "get_device"))
+        return False, None
+
+    def put(self, valip, valch, valc, valii, valid, value):
+        """
+        Cache a variable.
+        """
+
+        key = device_variables.target_key(valip, valch, valc, valii) + (valid,)
+        expiry = self._clock() + self.ttl.get(valid, self.default_ttl)
+        self._entries[key] = (value, expiry)
+        self._entries.move_to_end(key)
+        self._channels.setdefault(key[:2], set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def generation(self, valip, valch):
+        """
+        Get the generation of a channel, to read before sending a get_device.
+        """
+
+        return self._generations.get((valip, int(valch)), 0)
+
+    def put_response(self, valip, valch, valc, valii, response, generation=None):
+        """
+        Cache every variable of a decoded get_device response.
+        generation: generation of the channel when the read was sent, the
+        response is dropped if a write completed since.
+        """
+
+        if (generation is not None) and (generation != self.generation(valip, valch)):
+            self.stale += 1
+            return
+        for variable in response['data']['device']['variables']:
+            self.put(valip, valch, valc, valii, variable['id'],
+                dalion_api_get_device.decode_variable(variable))
+
+    def invalidate(self, valip, valch, valc, valii, valid=None):
+        """
+        Invalidate the entries changed by a write to a lamp, group or channel.
+        A lamp write invalidates the lamp and every group and channel entry
+        of the channel, a group or channel write invalidates every entry of
+        the channel. valid None invalidates every variable.
+        """
+
+        target = device_variables.target_key(valip, valch, valc, valii) + (valid,)
+        self._generations[target[:2]] = self._generations.get(target[:2], 0) + 1
+        keys = self._channels.get(target[:2], ())
+        for key in list(keys):
+            if (valid is not None) and (key[4] != valid):
+                continue
+            if (target[2] == 1) and (key[2] == 1) and (key[3] != target[3]):
+                continue
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+
+        self._entries.clear()
+        self._channels.clear()
+
+    def stats(self):
+        """
+        Get the hit and miss statistics.
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale": self.stale,
+            "entries": len(self._entries)
+        }
+
+    def _remove(self, key):
+        """
+        Remove an entry.
+        """
+
+        del self._entries[key]
+        keys = self._channels.get(key[:2])
+        keys.discard(key)
+        if not keys:
+            del self._channels[key[:2]]
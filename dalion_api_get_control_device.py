@@ -21,12 +21,21 @@ dalion_api_get_control_device.py 192.168.0.210 1 0 ls
 
 Get the occupancy of the control device 0 on the channel 1.
 dalion_api_get_control_device.py 192.168.0.210 1 0 os
+
+Usage - Every control device of a channel
+dalion_api_get_control_device.py ip channel all
+
+Get the occupancy and light of every control device on the channel 1
+with a single request.
+dalion_api_get_control_device.py 192.168.0.210 1 all
 """
 
 import sys
-import urllib.request
 import urllib.parse
-import json
+
+import dalion_api_metrics
+import dalion_api_tracing
+import dalion_api_transport
 
 
 DEF_ID = [
@@ -38,7 +47,14 @@ DEF_ID = [
 "" List of id.
 """
 
+DEF_ID_SET = frozenset(vid['id'] for vid in DEF_ID)
+
+"""
+"" Set of id.
+"""
+
 
+@dalion_api_tracing.traced("valid_arguments")
 def valid_arguments(valip, valch, valii, valid):
     """
     Valid the arguments
@@ -73,6 +89,8 @@ def valid_arguments(valip, valch, valii, valid):
     return bvalid
 
 
+@dalion_api_tracing.traced("prepare_url")
+@dalion_api_metrics.timed_url
 def prepare_url(valip, valch):
     """
     Prepare the URL
@@ -95,25 +113,65 @@ def send_request(url):
     Send the HTTP GET request.
     """
 
-    response = urllib.request.urlopen(url).read()
+    response = dalion_api_transport.send_request(url)
 
     return response
 
 
+class ControlDeviceSnapshot:
+    """
+    Control devices of a channel from one action=get response,
+    indexed by control device index.
+    """
+
+    def __init__(self, response):
+        if isinstance(response, (bytes, str)):
+            response = dalion_api_metrics.loads(response, dalion_api_metrics.last_labels())
+
+        self.devices = {}
+        for device in response['data']['control_devices']['devices']:
+            self.devices[int(device['ii'])] = device
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(sorted(self.devices))
+
+    def get(self, valii, valid):
+        """
+        Get a variable of a control device, "" if unknown.
+        """
+
+        device = self.devices.get(int(valii))
+        if (device is None) | (valid not in DEF_ID_SET):
+            return ""
+        return device.get(valid, "")
+
+
+@dalion_api_tracing.traced("parse_response")
 def parse_response(response, valii, valid):
     """
     Parse the response
     """
 
-    response = json.loads(response)
-	
-    for device in response['data']['control_devices']['devices']:
-        if device['ii'] == valii:
-            if valid == 'os':
-                return device['os']
-            if valid == 'ls':
-                return device['ls']
-    return ""
+    return ControlDeviceSnapshot(response).get(valii, valid)
+
+
+def print_snapshot(snapshot):
+    """
+    Print every control device of a snapshot.
+    """
+
+    vstr = "ii"
+    for vid in DEF_ID:
+        vstr += "\t" + vid['id']
+    print(vstr)
+    for valii in snapshot:
+        vstr = str(valii)
+        for vid in DEF_ID:
+            vstr += "\t" + str(snapshot.get(valii, vid['id']))
+        print(vstr)
 
 
 def main():
@@ -121,6 +179,23 @@ def main():
     main
     """
 
+    # Dump every control device of the channel
+    if (len(sys.argv) == 4) and (sys.argv[3] == "all"):
+        valip = sys.argv[1]
+        valch = sys.argv[2]
+
+        url = prepare_url(valip, valch)
+        print("")
+        print("Request: ")
+        print(url)
+        print("")
+
+        snapshot = ControlDeviceSnapshot(send_request(url))
+        print("Response: ")
+        print_snapshot(snapshot)
+        print("")
+        return
+
     # Parse the command arguments
     if len(sys.argv) != 5:
         # User Input
@@ -201,4 +276,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    dalion_api_tracing.run(main)
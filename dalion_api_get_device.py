@@ -14,7 +14,7 @@ ip: The DALION IP address.
 channel: The channel number, 1-4.
 destination: 1 = lamp, 2 = group, 3 = channel.
 destination-index: Lamp index 0-63, group index 0-15 or channel -1.
-id: The variable id.
+id: The variable id, or all for every variable with a single request.
 
 Examples:
 Get the light intensity of the channel 1.
@@ -31,16 +31,21 @@ dalion_api_get_device.py 192.168.0.210 1 1 1 dvgr
 
 Get the fade time of the lamp 0 on the channel 1.
 dalion_api_get_device.py 192.168.0.210 1 1 0 dvft
+
+Get every variable of the lamp 0 on the channel 1.
+dalion_api_get_device.py 192.168.0.210 1 1 0 all
 """
 
 import sys
-import urllib.request
 import urllib.parse
-import json
 
+import dalion_api_metrics
+import dalion_api_tracing
+import dalion_api_transport
 import device_variables
 
 
+@dalion_api_tracing.traced("valid_arguments")
 def valid_arguments(valip, valch, valc, valii, valid):
     """
     Valid the arguments
@@ -86,6 +91,8 @@ def valid_arguments(valip, valch, valc, valii, valid):
     return bvalid
 
 
+@dalion_api_tracing.traced("prepare_url")
+@dalion_api_metrics.timed_url
 def prepare_url(valip, valch, valc, valii):
     """
     Prepare the URL
@@ -119,27 +126,98 @@ def send_request(url):
     Send the HTTP GET request.
     """
 
-    response = urllib.request.urlopen(url).read()
+    response = dalion_api_transport.send_request(url)
 
     return response
 
 
+def decode_variable(variable):
+    """
+    Decode the value of a response variable to its type with the registry
+    decoder of its id, or of its type for an unknown id:
+    nb and se as int, nb10 as float scaled by 1/10, tx as str
+    """
+
+    descriptor = device_variables.registry.get(variable['id'])
+    if descriptor is not None:
+        return descriptor.decode(variable['va'])
+    return device_variables.decoder(variable['ty'])(variable['va'])
+
+
+@dalion_api_tracing.traced("parse_response")
 def parse_response(response, valid):
     """
     Parse the response
     """
 
-    response = json.loads(response)
+    if isinstance(response, (bytes, str)):
+        response = dalion_api_metrics.loads(response, dalion_api_metrics.last_labels())
 
     for variable in response['data']['device']['variables']:
         if variable['id'] == valid:
-            if variable['ty'] == 'nb10':
-                return float(variable['va']) / 10
-            else:
-                return variable['va']
+            return decode_variable(variable)
     return ""
 
 
+class DeviceRecord:
+    """
+    Every variable of a get_device response, decoded by decode_variable.
+    The variables are available as attributes, e.g. record.dval.
+    """
+
+    @dalion_api_tracing.traced("parse_response")
+    def __init__(self, response):
+        if isinstance(response, (bytes, str)):
+            response = dalion_api_metrics.loads(response, dalion_api_metrics.last_labels())
+
+        values = {}
+        for variable in response['data']['device']['variables']:
+            values[variable['id']] = decode_variable(variable)
+        self.__dict__['values'] = values
+
+    def __getattr__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DeviceRecord is read-only")
+
+    def __getitem__(self, valid):
+        return self.values[valid]
+
+    def __contains__(self, valid):
+        return valid in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "DeviceRecord(" + repr(self.values) + ")"
+
+    def get(self, valid, default=""):
+        """
+        Get a variable, default if missing.
+        """
+
+        return self.values.get(valid, default)
+
+
+def print_record(record):
+    """
+    Print every variable of a record.
+    """
+
+    for valid in record:
+        descriptor = device_variables.registry.get(valid)
+        name = descriptor.tx if descriptor is not None else valid
+        print(valid + "\t" + str(record[valid]) + "\t" + name)
+
+
 def main():
     """
     main
@@ -206,13 +284,8 @@ def main():
         valc = int(valc)
 
         # Find the variable for valid
-        index = 0
-        for variable in device_variables.device_variables:
-            if variable['id'] == valid:
-                valvi = index
-                break
-            index = index + 1
-        variable = device_variables.device_variables[valvi]
+        if valid != "all":
+            variable = device_variables.find_variable(valid)
 
 
     # Valid arguments
@@ -232,6 +305,13 @@ def main():
     # Send the request
     response = send_request(url)
 
+    # Every variable
+    if valid == "all":
+        print("Response: ")
+        print_record(DeviceRecord(response))
+        print("")
+        return
+
     # Parse the response
     response = parse_response(response, valid)
 
@@ -242,4 +322,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    dalion_api_tracing.run(main)
@@ -0,0 +1,273 @@
+"""
+dalion_api_groups.py
+
+Bitset index of the group memberships of the lamps.
+dvgr is the 16-bit group mask of a lamp. Per channel the index keeps the
+dvgr of every lamp and, per group, the 64-bit mask of its lamps (bit N
+for the short address N), so that the members of a group, the groups
+covering a set of lamps and the intersections and unions of lamp sets are
+a few integer bit operations.
+
+The index follows the dvgr writes sent through an AsyncClient once
+attached, whether addressed to a lamp, a group or the channel.
+
+Usage
+import dalion_api_groups
+
+index = dalion_api_groups.GroupIndex()
+index.set_lamp("192.168.0.210", 1, 0, 0x0003)
+index.set_lamp("192.168.0.210", 1, 1, 0x0002)
+groups = index.channel("192.168.0.210", 1)
+print(dalion_api_groups.lamps_of(groups.members[1]))    # [0, 1]
+print(dalion_api_groups.groups_of(groups.groups_within(0b11)))    # [0, 1]
+
+# Follow the dvgr writes of an AsyncClient
+index.attach(client)
+"""
+
+DEF_GROUPS = 16
+
+"""
+"" Number of groups of a channel, the bits of dvgr.
+"""
+
+DEF_LAMPS = 64
+
+"""
+"" Short addresses of a channel, the bits of a lamp mask.
+"""
+
+
+def popcount(mask):
+    """
+    Number of bits set in a mask.
+    """
+
+    return bin(mask).count("1")
+
+
+def lamps_mask(valiis):
+    """
+    Lamp mask of short addresses.
+    """
+
+    mask = 0
+    for valii in valiis:
+        mask |= 1 << int(valii)
+    return mask
+
+
+def lamps_of(mask):
+    """
+    Short addresses of a lamp mask, in order.
+    """
+
+    lamps = []
+    while mask:
+        low = mask & -mask
+        lamps.append(low.bit_length() - 1)
+        mask ^= low
+    return lamps
+
+
+groups_of = lamps_of
+
+"""
+"" Group indexes of a group mask (dvgr), in order.
+"""
+
+
+class ChannelGroups:
+    """
+    Group memberships of the lamps of a channel.
+    dvgr: dict short address -> group mask of the known lamps.
+    members: list of the lamp mask of every group.
+    present: lamp mask of the known lamps.
+    """
+
+    __slots__ = ("dvgr", "members", "present")
+
+    def __init__(self):
+        self.dvgr = {}
+        self.members = [0] * DEF_GROUPS
+        self.present = 0
+
+    @classmethod
+    def from_dvgr(cls, groups):
+        """
+        Build from a dict short address -> dvgr.
+        """
+
+        channel = cls()
+        for valii, valgr in groups.items():
+            channel.set_lamp(valii, valgr)
+        return channel
+
+    def set_lamp(self, valii, valgr):
+        """
+        Set the dvgr of a lamp, only the groups that changed are updated.
+        """
+
+        valii = int(valii)
+        valgr = int(valgr) & 0xFFFF
+        bit = 1 << valii
+        changed = self.dvgr.get(valii, 0) ^ valgr
+        while changed:
+            low = changed & -changed
+            self.members[low.bit_length() - 1] ^= bit
+            changed ^= low
+        self.dvgr[valii] = valgr
+        self.present |= bit
+
+    def remove_lamp(self, valii):
+        """
+        Forget a lamp.
+        """
+
+        valii = int(valii)
+        bit = 1 << valii
+        for valgi in groups_of(self.dvgr.pop(valii, 0)):
+            self.members[valgi] &= ~bit
+        self.present &= ~bit
+
+    def groups_within(self, mask):
+        """
+        Group mask of the non-empty groups whose lamps are all in a lamp mask.
+        """
+
+        groups = 0
+        for valgi, members in enumerate(self.members):
+            if members and not (members & ~mask):
+                groups |= 1 << valgi
+        return groups
+
+    def groups_touching(self, mask):
+        """
+        Group mask of the groups with a lamp in a lamp mask.
+        """
+
+        groups = 0
+        for valgi, members in enumerate(self.members):
+            if members & mask:
+                groups |= 1 << valgi
+        return groups
+
+    def union(self, groups):
+        """
+        Lamp mask of the lamps of any group of a group mask.
+        """
+
+        mask = 0
+        for valgi in groups_of(groups):
+            mask |= self.members[valgi]
+        return mask
+
+    def intersection(self, groups):
+        """
+        Lamp mask of the lamps in every group of a group mask.
+        """
+
+        mask = self.present
+        for valgi in groups_of(groups):
+            mask &= self.members[valgi]
+        return mask
+
+    def cover(self, mask):
+        """
+        Groups covering a lamp mask exactly, with no lamp outside it,
+        chosen greedily by the number of lamps left to cover.
+        Returns the group mask and the lamp mask left uncovered.
+        """
+
+        candidates = groups_of(self.groups_within(mask))
+        groups = 0
+        left = mask
+        while left:
+            best = max(candidates, key=lambda valgi: popcount(self.members[valgi] & left),
+                default=None)
+            if (best is None) or not (self.members[best] & left):
+                break
+            groups |= 1 << best
+            left &= ~self.members[best]
+        return groups, left
+
+
+class GroupIndex:
+    """
+    ChannelGroups of every channel of every DALION.
+    """
+
+    def __init__(self):
+        # (ip, channel) -> ChannelGroups
+        self.channels = {}
+
+    def channel(self, valip, valch):
+        """
+        Group memberships of a channel, created if missing.
+        """
+
+        key = (valip, int(valch))
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = ChannelGroups()
+            self.channels[key] = channel
+        return channel
+
+    def set_lamp(self, valip, valch, valii, valgr):
+        """
+        Set the dvgr of a lamp.
+        """
+
+        self.channel(valip, valch).set_lamp(valii, valgr)
+
+    def remove_lamp(self, valip, valch, valii):
+        """
+        Forget a lamp.
+        """
+
+        self.channel(valip, valch).remove_lamp(valii)
+
+    def lamps_in(self, valip, valch, valgi):
+        """
+        Lamp mask of a group.
+        """
+
+        return self.channel(valip, valch).members[int(valgi)]
+
+    def on_write(self, valip, valch, valc, valii, valid, valv):
+        """
+        Write listener of AsyncClient, follows the dvgr writes to a lamp,
+        the members of a group or every known lamp of a channel.
+        """
+
+        if valid != "dvgr":
+            return
+        channel = self.channel(valip, valch)
+        if int(valc) == 1:
+            targets = [int(valii)]
+        elif int(valc) == 2:
+            targets = lamps_of(channel.members[int(valii)])
+        else:
+            targets = lamps_of(channel.present)
+        for target in targets:
+            channel.set_lamp(target, valv)
+
+    def attach(self, client):
+        """
+        Follow the dvgr writes of an AsyncClient.
+        """
+
+        client.add_write_listener(self.on_write)
+
+    @classmethod
+    def from_topology(cls, topology):
+        """
+        Build from a dalion_api_inventory.TopologyIndex.
+        """
+
+        index = cls()
+        for valip, channels in topology.gateways.items():
+            for valch, channel in channels.items():
+                for valsa, lamp in channel["lamps"].items():
+                    index.set_lamp(valip, valch, valsa, lamp.get("dvgr", 0))
+        return index
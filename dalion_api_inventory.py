@@ -0,0 +1,281 @@
+"""
+dalion_api_inventory.py
+
+Concurrent inventory of the lamps and control devices of many DALIONs.
+Every short address 0-63 of the 4 channels is probed with get_device and
+every channel with action=get, concurrently with bounded parallelism. The
+results stream as they arrive and build a topology index
+(DALION -> channel -> lamp with dvsa, dvgr and name) that persists to a
+JSON file. A later run warm-starts from the file and can re-verify only
+the known lamps. With a timeout, the scan ends on schedule and the probes
+unfinished at the deadline are reported as errors.
+
+Usage - Command line arguments
+dalion_api_inventory.py [--index file] [--verify] [--timeout s] ip [ip ...]
+
+--index: JSON file of the topology index, default dalion_inventory.json.
+--verify: Only re-verify the lamps already in the index.
+--timeout: Deadline of the whole scan in seconds.
+
+Examples:
+Scan two DALIONs and save the index.
+dalion_api_inventory.py 192.168.0.210 192.168.0.211
+
+Re-verify the known lamps of the saved index.
+dalion_api_inventory.py --verify 192.168.0.210 192.168.0.211
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import urllib.error
+
+import dalion_api_async_client
+import dalion_api_tracing
+
+
+DEF_INDEX_FILE = "dalion_inventory.json"
+
+"""
+"" Default file of the topology index.
+"""
+
+DEF_LAMPS = 64
+
+"""
+"" Short addresses per channel.
+"""
+
+DEF_MAX_PARALLEL = 128
+
+"""
+"" Default maximum number of probes in flight.
+"""
+
+
+class TopologyIndex:
+    """
+    DALION -> channel -> lamps and control devices.
+    A lamp is a dict {"dvsa", "dvgr", "na", "seen"}.
+    """
+
+    def __init__(self):
+        # ip -> channel -> {"lamps": {short address: lamp}, "control_devices": [ii]}
+        self.gateways = {}
+
+    def channel(self, valip, valch):
+        """
+        Get the entry of a channel, created if missing.
+        """
+
+        channels = self.gateways.setdefault(valip, {})
+        return channels.setdefault(int(valch), {"lamps": {}, "control_devices": []})
+
+    def lamps(self, valip, valch):
+        """
+        Lamps of a channel by short address.
+        """
+
+        return self.gateways.get(valip, {}).get(int(valch), {"lamps": {}})["lamps"]
+
+    def set_lamp(self, valip, valch, valsa, record):
+        """
+        Store a lamp from its get_device record.
+        """
+
+        lamp = {
+            "dvsa": record.get("dvsa", valsa),
+            "dvgr": record.get("dvgr", 0),
+            "na": record.get("na", ""),
+            "seen": time.time()
+        }
+        self.channel(valip, valch)["lamps"][int(valsa)] = lamp
+        return lamp
+
+    def remove_lamp(self, valip, valch, valsa):
+        """
+        Remove an absent lamp.
+        """
+
+        return self.channel(valip, valch)["lamps"].pop(int(valsa), None) is not None
+
+    def set_control_devices(self, valip, valch, valiis):
+        """
+        Store the control device indexes of a channel.
+        """
+
+        self.channel(valip, valch)["control_devices"] = sorted(valiis)
+
+    def count(self):
+        """
+        Number of lamps and control devices.
+        """
+
+        lamps = 0
+        control_devices = 0
+        for channels in self.gateways.values():
+            for channel in channels.values():
+                lamps += len(channel["lamps"])
+                control_devices += len(channel["control_devices"])
+        return lamps, control_devices
+
+    def save(self, path):
+        """
+        Write the index to a JSON file, atomically.
+        """
+
+        document = {
+            valip: {
+                str(valch): {
+                    "lamps": {str(valsa): lamp for valsa, lamp in channel["lamps"].items()},
+                    "control_devices": channel["control_devices"]
+                } for valch, channel in channels.items()
+            } for valip, channels in self.gateways.items()
+        }
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as output:
+            json.dump(document, output, indent=1)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index from a JSON file, empty if the file is missing.
+        """
+
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        with open(path, encoding="utf-8") as source:
+            document = json.load(source)
+        for valip, channels in document.items():
+            for valch, channel in channels.items():
+                entry = index.channel(valip, valch)
+                entry["lamps"] = {int(valsa): lamp for valsa, lamp in channel["lamps"].items()}
+                entry["control_devices"] = channel["control_devices"]
+        return index
+
+
+class InventoryScanner:
+    """
+    Concurrent scanner filling a TopologyIndex.
+    """
+
+    def __init__(self, client, index=None, max_parallel=DEF_MAX_PARALLEL):
+        self.client = client
+        self.index = index if index is not None else TopologyIndex()
+        self._semaphore = asyncio.Semaphore(max_parallel)
+
+    async def scan(self, valips, channels=dalion_api_async_client.DEF_CHANNELS, verify=False,
+            timeout=None):
+        """
+        Probe the lamps and control devices, async iterator of the events
+        as they arrive:
+        ("lamp", ip, channel, short address, lamp)
+        ("absent", ip, channel, short address, None)
+        ("control_devices", ip, channel, None, [ii])
+        ("error", ip, channel, short address or None, exception)
+        verify only probes the lamps already in the index.
+        timeout is the deadline of the whole scan, each probe gets the
+        client timeout if None.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        probes = []
+        for valip in valips:
+            for valch in channels:
+                probes.append(self._probe_control_devices(valip, valch, deadline))
+                if verify:
+                    addresses = sorted(self.index.lamps(valip, valch))
+                else:
+                    addresses = range(DEF_LAMPS)
+                for valsa in addresses:
+                    probes.append(self._probe_lamp(valip, valch, valsa, deadline))
+
+        for probe in asyncio.as_completed(probes):
+            yield await probe
+
+    async def _probe_lamp(self, valip, valch, valsa, deadline=None):
+        """
+        Probe a short address.
+        """
+
+        async with self._semaphore:
+            try:
+                record = await self.client.get_record(valip, valch, 1, valsa,
+                    self.client.budget(deadline))
+            except urllib.error.HTTPError as exc:
+                if exc.code != 404:
+                    return ("error", valip, valch, valsa, exc)
+                record = None
+            except (OSError, ValueError, KeyError) as exc:
+                return ("error", valip, valch, valsa, exc)
+
+        if (record is None) or (len(record) == 0):
+            self.index.remove_lamp(valip, valch, valsa)
+            return ("absent", valip, valch, valsa, None)
+        return ("lamp", valip, valch, valsa, self.index.set_lamp(valip, valch, valsa, record))
+
+    async def _probe_control_devices(self, valip, valch, deadline=None):
+        """
+        Probe the control devices of a channel.
+        """
+
+        async with self._semaphore:
+            try:
+                snapshot = await self.client.get_snapshot(valip, valch,
+                    self.client.budget(deadline))
+            except (OSError, ValueError, KeyError) as exc:
+                return ("error", valip, valch, None, exc)
+
+        valiis = list(snapshot)
+        self.index.set_control_devices(valip, valch, valiis)
+        return ("control_devices", valip, valch, None, valiis)
+
+
+async def run_scan(valips, path, verify, timeout=None):
+    """
+    Scan, print the events as JSON lines and save the index.
+    """
+
+    index = TopologyIndex.load(path)
+    start = time.perf_counter()
+    async with dalion_api_async_client.AsyncClient() as client:
+        scanner = InventoryScanner(client, index)
+        async for kind, valip, valch, valsa, value in scanner.scan(valips, verify=verify,
+                timeout=timeout):
+            if kind == "absent":
+                continue
+            if kind == "error":
+                value = type(value).__name__ + ": " + str(value)
+            print(json.dumps({"event": kind, "ip": valip, "channel": valch,
+                "short_address": valsa, "value": value}), flush=True)
+    elapsed = time.perf_counter() - start
+
+    index.save(path)
+    lamps, control_devices = index.count()
+    print("{} lamps, {} control devices in {:.3f} s, index saved to {}".format(
+        lamps, control_devices, elapsed, path), file=sys.stderr)
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Inventory of DALIONs.")
+    parser.add_argument("ips", nargs="+", metavar="ip")
+    parser.add_argument("--index", default=DEF_INDEX_FILE, help="JSON file of the topology index.")
+    parser.add_argument("--verify", action="store_true",
+        help="Only re-verify the lamps already in the index.")
+    parser.add_argument("--timeout", type=float, help="Deadline of the whole scan in seconds.")
+    args = parser.parse_args()
+
+    asyncio.run(run_scan(args.ips, args.index, args.verify, args.timeout))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,552 @@
+"""
+dalion_api_metrics.py
+
+Metrics of the requests to the DALIONs.
+The shared transport of the scripts, the URL builders, the response
+parsers, the AsyncClient and the read cache record into one registry:
+histograms of the URL build time, the network round-trip, the bytes
+received and the JSON decode time, and counters of the errors, retries
+and cache hits and misses, keyed by gateway (host:port), channel and
+action (get_device, set_device, set_colour, get).
+
+The registry is read in-process with snapshot(), or in the Prometheus
+text format with exposition() and on a local HTTP endpoint with serve().
+The long-running scripts start the endpoint when the environment variable
+DALION_METRICS_PORT is set.
+
+Usage
+import dalion_api_metrics
+
+server = dalion_api_metrics.serve(9464)
+...
+print(dalion_api_metrics.snapshot()["dalion_request_seconds"])
+server.shutdown()
+
+Usage - Command line arguments
+dalion_api_metrics.py demo [--port port] [--count n] [--latency s]
+
+Examples:
+Send requests to a local simulator and print the metrics, served on
+http://127.0.0.1:9464/metrics until Ctrl-C.
+dalion_api_metrics.py demo --port 9464
+
+Serve the metrics of the sensor poller.
+DALION_METRICS_PORT=9464 dalion_api_sensor_poller.py 192.168.0.210
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import asyncio
+import functools
+import argparse
+import threading
+import http.server
+
+import dalion_api_tracing
+
+
+DEF_PORT = 9464
+
+"""
+"" Default port of the HTTP endpoint.
+"""
+
+DEF_HOST = "127.0.0.1"
+
+"""
+"" Default address of the HTTP endpoint, local only.
+"""
+
+DEF_ENVIRONMENT = "DALION_METRICS_PORT"
+
+"""
+"" Environment variable giving the port of the endpoint of the long-running scripts.
+"""
+
+DEF_SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+"""
+"" Upper bounds of the buckets of the time histograms, in seconds.
+"""
+
+DEF_BYTES_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+"""
+"" Upper bounds of the buckets of the size histograms, in bytes.
+"""
+
+DEF_LABELS = ("gateway", "channel", "action")
+
+"""
+"" Labels of every metric.
+"""
+
+DEF_LABELS_CACHE_SIZE = 4096
+
+"""
+"" Maximum number of URL prefixes whose labels are cached.
+"""
+
+DEF_METRICS = {
+    "dalion_url_build_seconds": ("histogram", "Time to build the request URL.", DEF_SECONDS_BUCKETS),
+    "dalion_request_seconds": ("histogram", "Network round-trip of the requests.", DEF_SECONDS_BUCKETS),
+    "dalion_response_bytes": ("histogram", "Bytes of the response bodies.", DEF_BYTES_BUCKETS),
+    "dalion_json_decode_seconds": ("histogram", "Time to decode the JSON responses.",
+        DEF_SECONDS_BUCKETS),
+    "dalion_errors_total": ("counter", "Failed requests, by error type.", None),
+    "dalion_retries_total": ("counter", "Requests retried on a new connection.", None),
+    "dalion_cache_hits_total": ("counter", "Reads served by the cache.", None),
+    "dalion_cache_misses_total": ("counter", "Reads missing from the cache.", None)
+}
+
+"""
+"" Type, help and buckets of every metric.
+"""
+
+
+def url_labels(url):
+    """
+    (gateway, channel, action) of a DALION API URL, "" when missing.
+    The labels are cached by the URL up to the channel parameter, when
+    the action comes first as in the URLs of the scripts.
+    """
+
+    start = url.find("&ch=")
+    if (start < 0) or (url.find("?action=", 0, start) < 0):
+        return _parse_labels(url)
+    end = url.find("&", start + 4)
+    prefix = url if end < 0 else url[:end]
+    labels = _labels.get(prefix)
+    if labels is None:
+        if len(_labels) >= DEF_LABELS_CACHE_SIZE:
+            _labels.clear()
+        labels = _parse_labels(prefix)
+        _labels[prefix] = labels
+    return labels
+
+
+def _parse_labels(url):
+    """
+    (gateway, channel, action) of a URL.
+    """
+
+    start = url.find("://")
+    start = 0 if start < 0 else start + 3
+    end = url.find("/", start)
+    gateway = url[start:] if end < 0 else url[start:end]
+    return (gateway, _parameter(url, "ch"), _parameter(url, "action"))
+
+
+def _parameter(url, name):
+    """
+    Value of a query parameter of a URL, "" when missing.
+    """
+
+    for separator in ("?", "&"):
+        start = url.find(separator + name + "=")
+        if start >= 0:
+            start += len(name) + 2
+            end = url.find("&", start)
+            return url[start:] if end < 0 else url[start:end]
+    return ""
+
+
+_labels = {}
+
+"""
+"" URL prefix -> labels.
+"""
+
+
+class Histogram:
+    """
+    Counts of the observed values per bucket, with their sum.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last count is above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        (upper bound, cumulative count) of every bucket, +Inf last.
+        """
+
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket of the q quantile, None if empty.
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """
+    Histograms and counters keyed by metric name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> Histogram or count
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, labels, value):
+        """
+        Record a value in a histogram.
+        """
+
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(DEF_METRICS[name][2])
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def increment(self, name, labels, amount=1):
+        """
+        Add to a counter, the labels may have extra values after DEF_LABELS.
+        """
+
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def reset(self):
+        """
+        Forget every value.
+        """
+
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """
+        Copy of every metric: dict name -> list of entries with the labels
+        and, for a histogram, count, sum, mean, p50, p95, p99 and the
+        cumulative buckets, for a counter the value.
+        """
+
+        result = {name: [] for name in DEF_METRICS}
+        with self._lock:
+            for (name, labels), histogram in self._histograms.items():
+                result[name].append({
+                    "labels": _label_dict(name, labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99),
+                    "buckets": histogram.cumulative()
+                })
+            for (name, labels), value in self._counters.items():
+                result[name].append({"labels": _label_dict(name, labels), "value": value})
+        return result
+
+    def exposition(self):
+        """
+        Every metric in the Prometheus text format.
+        """
+
+        lines = []
+        snapshot = self.snapshot()
+        for name, (kind, description, _) in DEF_METRICS.items():
+            lines.append("# HELP " + name + " " + description)
+            lines.append("# TYPE " + name + " " + kind)
+            for entry in snapshot[name]:
+                labels = entry["labels"]
+                if kind == "counter":
+                    lines.append(name + _format_labels(labels) + " " + _format_value(entry["value"]))
+                    continue
+                for bound, total in entry["buckets"]:
+                    bucket = dict(labels, le="+Inf" if bound == float("inf") else _format_value(bound))
+                    lines.append(name + "_bucket" + _format_labels(bucket) + " " + str(total))
+                lines.append(name + "_sum" + _format_labels(labels) + " " + _format_value(entry["sum"]))
+                lines.append(name + "_count" + _format_labels(labels) + " " + str(entry["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def _label_dict(name, labels):
+    """
+    Labels of a metric as a dict, the extra value of dalion_errors_total is its type.
+    """
+
+    names = DEF_LABELS + (("type",) if name == "dalion_errors_total" else ())
+    return dict(zip(names, labels))
+
+
+def _format_labels(labels):
+    """
+    {name="value",...} with the values escaped.
+    """
+
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+        .replace('"', '\\"').replace("\n", "\\n")) for name, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+"""
+"" Registry shared by the scripts.
+"""
+
+
+def observe(name, labels, value):
+    """
+    Record a value in a histogram of the shared registry.
+    """
+
+    registry.observe(name, labels, value)
+
+
+def increment(name, labels, amount=1):
+    """
+    Add to a counter of the shared registry.
+    """
+
+    registry.increment(name, labels, amount)
+
+
+def error(labels, exc):
+    """
+    Count a failed request by the type of its exception.
+    """
+
+    registry.increment("dalion_errors_total", labels + (type(exc).__name__,))
+
+
+def snapshot():
+    """
+    Copy of every metric of the shared registry.
+    """
+
+    return registry.snapshot()
+
+
+def exposition():
+    """
+    Every metric of the shared registry in the Prometheus text format.
+    """
+
+    return registry.exposition()
+
+
+def timed_url(function):
+    """
+    Decorator of a URL builder, records its time in
+    dalion_url_build_seconds with the labels of the URL, or of the first
+    URL of a list.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        url = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        first = url[0] if isinstance(url, list) and url else url
+        if isinstance(first, str):
+            registry.observe("dalion_url_build_seconds", url_labels(first), elapsed)
+        return url
+
+    return wrapper
+
+
+def loads(body, labels):
+    """
+    Decode a JSON response, recording the time in dalion_json_decode_seconds.
+    """
+
+    start = time.perf_counter()
+    value = json.loads(body)
+    registry.observe("dalion_json_decode_seconds", labels, time.perf_counter() - start)
+    return value
+
+
+_local = threading.local()
+
+"""
+"" Labels of the last request of the thread, for the parsers of the scripts.
+"""
+
+
+def last_labels():
+    """
+    Labels of the last request sent by the thread through the transport.
+    """
+
+    return getattr(_local, "labels", ("", "", ""))
+
+
+def set_last_labels(labels):
+    """
+    Remember the labels of the request sent by the thread.
+    """
+
+    _local.labels = labels
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    /metrics in the Prometheus text format, /snapshot in JSON.
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = self.server.registry.exposition().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/snapshot":
+            snapshot = self.server.registry.snapshot()
+            for entries in snapshot.values():
+                for entry in entries:
+                    if "buckets" in entry:
+                        entry["buckets"] = [("+Inf" if bound == float("inf") else bound, total)
+                            for bound, total in entry["buckets"]]
+            body = json.dumps(snapshot).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=DEF_PORT, host=DEF_HOST, metrics=None):
+    """
+    Serve a registry, the shared one by default, on a background thread.
+    Returns the server, stopped with server.shutdown().
+    """
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = metrics or registry
+    thread = threading.Thread(target=server.serve_forever, name="dalion-metrics", daemon=True)
+    thread.start()
+    return server
+
+
+def serve_from_environment():
+    """
+    Serve the shared registry on the port of DALION_METRICS_PORT if set.
+    Returns the server or None.
+    """
+
+    port = os.environ.get(DEF_ENVIRONMENT)
+    if not port:
+        return None
+    return serve(int(port))
+
+
+async def run_demo(port, count, latency):
+    """
+    Send requests to a local simulator with the scripts and the
+    AsyncClient, print and serve the metrics.
+    """
+
+    # Imported here, the instrumented modules import this module. They
+    # record into the registry of dalion_api_metrics, not of __main__.
+    import dalion_api_async_client
+    import dalion_api_cache
+    import dalion_api_get_control_device
+    import dalion_api_get_device
+    import dalion_api_metrics
+    import dalion_api_set_device
+    import dalion_api_simulator
+    import device_variables
+
+    with dalion_api_simulator.Simulator(latency=latency) as simulator:
+        valip = simulator.address
+        dval = device_variables.find_variable("dval")
+        for valii in range(count):
+            url = dalion_api_set_device.prepare_url(valip, "1", 1, str(valii % 64), 50, dval)
+            dalion_api_set_device.send_request(url)
+            url = dalion_api_get_device.prepare_url(valip, "1", 1, str(valii % 64))
+            dalion_api_get_device.parse_response(dalion_api_get_device.send_request(url), "dval")
+        url = dalion_api_get_control_device.prepare_url(valip, "1")
+        dalion_api_get_control_device.parse_response(
+            dalion_api_get_control_device.send_request(url), 0, "os")
+
+        async with dalion_api_async_client.AsyncClient(cache=dalion_api_cache.DeviceCache()) as client:
+            for valii in range(count):
+                await client.get_device(valip, 2, 1, valii % 8, "dval")
+
+        for name, entries in dalion_api_metrics.snapshot().items():
+            for entry in entries:
+                if "count" in entry:
+                    print("{:28} {:55} count {:5} mean {:9.6f}".format(name,
+                        ",".join(entry["labels"].values()), entry["count"], entry["mean"]))
+                else:
+                    print("{:28} {:55} value {:5}".format(name, ",".join(entry["labels"].values()),
+                        entry["value"]))
+
+    if port:
+        dalion_api_metrics.serve(port)
+        print("Serving http://{}:{}/metrics, Ctrl-C to stop".format(DEF_HOST, port))
+        while True:
+            await asyncio.sleep(3600)
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Metrics of the DALION requests.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_demo = commands.add_parser("demo", help="Measure requests to a local simulator.")
+    parser_demo.add_argument("--port", type=int, default=0,
+        help="Serve the metrics on this port after the requests.")
+    parser_demo.add_argument("--count", type=int, default=100)
+    parser_demo.add_argument("--latency", type=float, default=0.0,
+        help="Simulator latency in seconds.")
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run_demo(args.port, args.count, args.latency))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,345 @@
+"""
+dalion_api_planner.py
+
+Group-aware write planner.
+Turns a desired per-lamp level (dval) or colour map of a channel into a
+short sequence of set_device or set_colour commands using the dvgr group
+memberships of the lamps, held as bitsets by dalion_api_groups: a channel
+broadcast (gi=-1), then group writes (gi), then lamp overrides (di). Each
+command is chosen greedily while it replaces at least two lamp writes,
+and the order makes the last command reaching a lamp carry its desired
+value, so the final state is correct. The number of requests saved
+against one write per lamp is reported.
+
+groups must give the dvgr of every lamp of the channel, since a group
+write or a broadcast reaches every member, including the lamps missing
+from the desired map. Those lamps are never changed unless their current
+value is known and equal.
+
+Usage
+import dalion_api_planner
+
+plan = dalion_api_planner.plan_writes({0: 50, 1: 50, 2: 80}, {0: 0x0001, 1: 0x0001, 2: 0x0002})
+for valc, valii, value in plan:
+    print(valc, valii, value)
+print(plan.saved, "requests saved")
+
+Usage - Command line arguments
+dalion_api_planner.py plan ip channel desired.json [--index file] [--cid cid] [--ctype n] [--execute]
+dalion_api_planner.py demo [--latency s]
+
+desired.json: JSON object short address -> level in percent, or -> cvalue
+    fields for set_colour, e.g. {"0": {"tc": 333}}, with --cid and --ctype.
+--index: Topology index of dalion_api_inventory.py giving the dvgr of the lamps.
+--execute: Send the commands, otherwise only print them.
+
+Examples:
+Print the commands of a scene of the channel 1.
+dalion_api_planner.py plan 192.168.0.210 1 scene.json
+
+Plan, send and verify a scene against a local simulator.
+dalion_api_planner.py demo
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+import dalion_api_async_client
+import dalion_api_groups
+import dalion_api_inventory
+import dalion_api_simulator
+import dalion_api_tracing
+
+
+DEF_BROADCAST = -1
+
+"""
+"" Group index of the channel broadcast.
+"""
+
+_MISSING = object()
+
+"""
+"" Value of a lamp missing from a map.
+"""
+
+
+class WritePlan:
+    """
+    Ordered list of (destination, index, value) commands: destination 3
+    with index -1 for the broadcast, 2 with the group index, 1 with the
+    lamp index.
+    naive is the number of lamp writes without planning.
+    """
+
+    __slots__ = ("commands", "naive")
+
+    def __init__(self, commands, naive):
+        self.commands = commands
+        self.naive = naive
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def __repr__(self):
+        return "WritePlan({} commands, {} saved)".format(len(self.commands), self.saved)
+
+    @property
+    def saved(self):
+        """
+        Requests saved against one write per lamp.
+        """
+
+        return self.naive - len(self.commands)
+
+
+def colour_key(valcvalue):
+    """
+    Hashable value of a dict of cvalue fields.
+    """
+
+    return tuple(sorted(valcvalue.items()))
+
+
+def plan_writes(desired, groups, current=None, broadcast=True):
+    """
+    Plan the commands setting the desired values.
+    desired: dict short address -> value, any hashable value.
+    groups: dalion_api_groups.ChannelGroups of the channel, or a dict
+        short address -> dvgr of every lamp of the channel.
+    current: dict short address -> known current value, the lamps
+        already at their desired value are not written.
+    Returns a WritePlan.
+    """
+
+    if not isinstance(groups, dalion_api_groups.ChannelGroups):
+        groups = dalion_api_groups.ChannelGroups.from_dvgr(groups)
+    popcount = dalion_api_groups.popcount
+
+    # Lamp masks per desired value and per known value
+    desired = {int(valii): value for valii, value in desired.items()}
+    wanted = {}
+    for valii, value in desired.items():
+        wanted[value] = wanted.get(value, 0) | (1 << valii)
+    state = {}
+    for valii, value in (current or {}).items():
+        state[value] = state.get(value, 0) | (1 << int(valii))
+    desired_mask = dalion_api_groups.lamps_mask(desired)
+    wrong = desired_mask
+    for value, mask in wanted.items():
+        wrong &= ~(mask & state.get(value, 0))
+    naive = popcount(wrong)
+    commands = []
+
+    def best_value(targets):
+        """
+        Value of a write to targets fixing the most lamps, and the
+        number of lamp writes it saves, None if it would change a lamp
+        missing from desired.
+        """
+
+        # Only a write of their known current value leaves the lamps
+        # missing from desired unchanged
+        candidates = wanted
+        outside = targets & ~desired_mask
+        if outside:
+            for value, mask in state.items():
+                if not (outside & ~mask):
+                    candidates = {value: wanted[value]} if value in wanted else {}
+                    break
+            else:
+                return None, 0
+
+        correct = popcount(targets & desired_mask & ~wrong)
+        best = None
+        gain = 0
+        for value, mask in candidates.items():
+            fixed = popcount(targets & wrong & mask)
+            if fixed:
+                value_gain = fixed - (correct - popcount(targets & ~wrong & mask))
+                if value_gain > gain:
+                    best, gain = value, value_gain
+        return best, gain
+
+    def apply(targets, value):
+        nonlocal wrong
+        for other in state:
+            state[other] &= ~targets
+        state[value] = state.get(value, 0) | targets
+        wrong = (wrong & ~targets) | (targets & desired_mask & ~wanted.get(value, 0))
+
+    if broadcast:
+        lamps = groups.present | desired_mask
+        value, gain = best_value(lamps)
+        if gain > 1:
+            commands.append((3, DEF_BROADCAST, value))
+            apply(lamps, value)
+
+    while wrong:
+        best = None
+        for valgi, members in enumerate(groups.members):
+            if members:
+                value, gain = best_value(members)
+                if (gain > 1) and ((best is None) or (gain > best[2])):
+                    best = (valgi, value, gain)
+        if best is None:
+            break
+        valgi, value, _ = best
+        commands.append((2, valgi, value))
+        apply(groups.members[valgi], value)
+
+    for valii in dalion_api_groups.lamps_of(wrong):
+        commands.append((1, valii, desired[valii]))
+
+    return WritePlan(commands, naive)
+
+
+async def execute(client, valip, valch, plan, valcid=None, valctype=None):
+    """
+    Send the commands of a plan, the broadcast and the group writes one
+    after the other, then the lamp overrides concurrently.
+    The values are levels, or colour_key values with valcid and valctype.
+    Returns the list of responses or exceptions of the lamp overrides.
+    """
+
+    async def send(valc, valii, value):
+        if valcid is None:
+            return await client.set_device(valip, valch, valc, valii, "dval", value)
+        return await client.set_colour(valip, valch, valc, valii, valcid, valctype, dict(value))
+
+    overrides = []
+    for valc, valii, value in plan:
+        if valc == 1:
+            overrides.append(send(valc, valii, value))
+        else:
+            await send(valc, valii, value)
+    return await asyncio.gather(*overrides, return_exceptions=True)
+
+
+def print_plan(plan):
+    """
+    Print the commands of a plan.
+    """
+
+    names = {3: "broadcast", 2: "group", 1: "lamp"}
+    for valc, valii, value in plan:
+        print("{:9} {:3} {}".format(names[valc], valii, value))
+    print("{} commands instead of {}, {} requests saved".format(len(plan), plan.naive, plan.saved))
+
+
+async def run_plan(args):
+    """
+    Plan and optionally send the desired values of a file.
+    """
+
+    with open(args.desired, encoding="utf-8") as source:
+        desired = {int(valii): value for valii, value in json.load(source).items()}
+    colour = any(isinstance(value, dict) for value in desired.values())
+    if colour:
+        if (args.cid is None) or (args.ctype is None):
+            print("--cid and --ctype are required for colours")
+            sys.exit(1)
+        desired = {valii: colour_key(value) for valii, value in desired.items()}
+
+    topology = dalion_api_inventory.TopologyIndex.load(args.index)
+    groups = dalion_api_groups.GroupIndex.from_topology(topology).channel(args.ip, args.channel)
+    if not groups.present:
+        print("No lamp of the channel in " + args.index + ", run dalion_api_inventory.py first")
+        sys.exit(1)
+
+    plan = plan_writes(desired, groups)
+    print_plan(plan)
+
+    if args.execute:
+        async with dalion_api_async_client.AsyncClient() as client:
+            results = await execute(client, args.ip, args.channel, plan,
+                args.cid if colour else None, args.ctype if colour else None)
+        for result in results:
+            if isinstance(result, BaseException):
+                print("error:", result)
+
+
+async def run_demo(latency):
+    """
+    Plan, send and verify a scene of a channel of a local simulator.
+    """
+
+    with dalion_api_simulator.Simulator(latency=latency, max_connections=128) as simulator:
+        valip = simulator.address
+        async with dalion_api_async_client.AsyncClient() as client:
+            index = dalion_api_groups.GroupIndex()
+            index.attach(client)
+            records = await asyncio.gather(*[client.get_record(valip, 1, 1, valii)
+                for valii in range(dalion_api_simulator.DEF_LAMPS)])
+            for record in records:
+                index.set_lamp(valip, 1, record.dvsa, record.dvgr)
+            groups = index.channel(valip, 1)
+
+            # Most lamps at 40%, the groups 3 and 7 at 80%
+            desired = {valii: 40.0 for valii in groups.dvgr}
+            for valii in dalion_api_groups.lamps_of(groups.members[3] | groups.members[7]):
+                desired[valii] = 80.0
+            # A few lamps at 10%, then the same lamps in a group of their
+            # own, the index follows the dvgr writes
+            reading = (5, 22, 41, 50)
+            for valii in reading:
+                desired[valii] = 10.0
+            plan = plan_writes(desired, groups)
+            print_plan(plan)
+            await client.set_device(valip, 1, 2, 15, "dvgr", 1 << 14)
+            for valii in reading:
+                await client.set_device(valip, 1, 1, valii, "dvgr", 1 << 15)
+            print("after moving the group 15 to the group 14 and the lamps {} to the group 15".format(
+                reading))
+            plan = plan_writes(desired, groups)
+            print_plan(plan)
+
+            start = time.perf_counter()
+            await execute(client, valip, 1, plan)
+            elapsed = time.perf_counter() - start
+
+            records = await asyncio.gather(*[client.get_record(valip, 1, 1, valii)
+                for valii in range(dalion_api_simulator.DEF_LAMPS)])
+            wrong = [record.dvsa for record in records if record.dval != desired[record.dvsa]]
+
+    print("sent in {:.3f} s, {} lamps wrong".format(elapsed, len(wrong)))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Group-aware write planner.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_plan = commands.add_parser("plan", help="Plan the writes of a desired map.")
+    parser_plan.add_argument("ip")
+    parser_plan.add_argument("channel", type=int)
+    parser_plan.add_argument("desired")
+    parser_plan.add_argument("--index", default=dalion_api_inventory.DEF_INDEX_FILE,
+        help="Topology index of dalion_api_inventory.py.")
+    parser_plan.add_argument("--cid", help="Colour id for set_colour.")
+    parser_plan.add_argument("--ctype", type=int, help="Colour type for set_colour.")
+    parser_plan.add_argument("--execute", action="store_true", help="Send the commands.")
+
+    parser_demo = commands.add_parser("demo", help="Plan, send and verify against a simulator.")
+    parser_demo.add_argument("--latency", type=float, default=0.0,
+        help="Simulator latency in seconds.")
+
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        asyncio.run(run_plan(args))
+    else:
+        asyncio.run(run_demo(args.latency))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
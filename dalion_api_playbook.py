@@ -0,0 +1,283 @@
+"""
+dalion_api_playbook.py
+
+Precompiled scene/preset playbooks.
+A declarative list of steps is compiled once into a frozen playbook of
+pre-encoded HTTP requests grouped per DALION, so that recalling the preset
+only sends the requests in parallel, without rebuilding any URL.
+Each request keeps its URL and the variables it writes, so that a recall
+invalidates the read cache and updates the write listeners of the client
+(e.g. dalion_api_groups.GroupIndex) as set_device and set_colour do.
+
+A step sets a variable with set_device
+{"ip": "192.168.0.210", "channel": 1, "destination": 1, "index": 0, "id": "dval", "value": 50}
+or a colour with set_colour, index may be a list of lamps or groups
+{"ip": "192.168.0.210", "channel": 1, "destination": 1, "index": [0, 1, 2],
+ "cid": "d8ac", "ctype": 32, "cvalue": {"tc": 333}}
+id defaults to dval.
+
+Usage - Command line arguments
+dalion_api_playbook.py run preset.json [--ordered] [--timeout s]
+dalion_api_playbook.py benchmark [--count n] [--latency s]
+
+preset.json: JSON list of steps.
+--ordered: Send the requests of each DALION one after the other, in the
+    order of the steps, e.g. when a lamp overrides its group.
+--timeout: Deadline of the recall in seconds, the requests unfinished at
+    the deadline fail with TimeoutError.
+
+Examples:
+Recall a preset.
+dalion_api_playbook.py run evening.json
+
+Compare compile-once/replay-many against building the URLs each time.
+dalion_api_playbook.py benchmark
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+import dalion_api_async_client
+import dalion_api_set_colour
+import dalion_api_set_device
+import dalion_api_simulator
+import dalion_api_tracing
+import device_variables
+
+
+class PreparedRequest:
+    """
+    Pre-encoded request of a playbook.
+    writes is a tuple of (ip, channel, destination, index, id, value)
+    written by the request, id and value None for a colour.
+    """
+
+    __slots__ = ("request", "url", "writes")
+
+    def __init__(self, request, url, writes):
+        self.request = request
+        self.url = url
+        self.writes = writes
+
+
+class Playbook:
+    """
+    Frozen list of pre-encoded requests grouped per DALION.
+    gateways is a tuple of (host, port, requests), requests a tuple of
+    PreparedRequest.
+    """
+
+    __slots__ = ("gateways", "count")
+
+    def __init__(self, gateways):
+        object.__setattr__(self, "gateways", tuple(gateways))
+        object.__setattr__(self, "count", sum(len(requests) for _, _, requests in self.gateways))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Playbook is read-only")
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "Playbook({} requests, {} DALIONs)".format(self.count, len(self.gateways))
+
+
+def step_urls(step):
+    """
+    URLs of a step.
+    """
+
+    return [url for url, _ in step_requests(step)]
+
+
+def step_requests(step):
+    """
+    URLs of a step with the variables each one writes.
+    """
+
+    valip = str(step["ip"])
+    valch = str(step["channel"])
+    valc = int(step.get("destination", 3))
+    valii = step.get("index", -1)
+
+    if "cid" in step:
+        ## set_colour
+        arguments = dalion_api_async_client.cvalue_arguments(step.get("cvalue", {}))
+        valctype = int(step["ctype"])
+        if isinstance(valii, list):
+            # A batch URL may hold any of the indexes
+            writes = tuple((valip, valch, valc, index, None, None) for index in valii)
+            return [(url, writes) for url in dalion_api_set_colour.prepare_batch_urls(valip,
+                valch, valc, valii, step["cid"], valctype, *arguments)]
+        return [(dalion_api_set_colour.prepare_url(valip, valch, valc, valii,
+            step["cid"], valctype, *arguments), ((valip, valch, valc, valii, None, None),))]
+
+    ## set_device
+    valid = step.get("id", "dval")
+    valv = str(step["value"])
+    descriptor = device_variables.registry.get(valid)
+    if descriptor is None:
+        raise ValueError("Unknown variable id: " + str(valid))
+    if not descriptor.validate(valv):
+        raise ValueError("Variable value is out of range: " + valid + " " + valv)
+    indexes = valii if isinstance(valii, list) else [valii]
+    return [(dalion_api_set_device.prepare_url(valip, valch, valc, str(index), valv,
+        descriptor.variable), ((valip, valch, valc, index, valid, valv),)) for index in indexes]
+
+
+def compile_playbook(steps):
+    """
+    Compile a list of steps into a Playbook.
+    """
+
+    gateways = {}
+    for step in steps:
+        for url, writes in step_requests(step):
+            host, port, path = dalion_api_async_client.split_url(url)
+            gateways.setdefault((host, port), []).append(PreparedRequest(
+                dalion_api_async_client.encode_request(host, port, path), url, writes))
+
+    return Playbook((host, port, tuple(requests)) for (host, port), requests in gateways.items())
+
+
+async def replay(client, playbook, ordered=False, timeout=None):
+    """
+    Send the requests of a playbook, the DALIONs in parallel.
+    ordered sends the requests of each DALION one after the other.
+    timeout is the deadline of the whole recall, the client timeout per
+    request if None.
+    Returns the list of responses or exceptions, in playbook order.
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    async def send(host, port, prepared):
+        response = await client.send_prepared(host, port, prepared.request, prepared.url,
+            timeout=client.budget(deadline))
+        for write in prepared.writes:
+            client.written(*write)
+        return response
+
+    async def send_gateway(host, port, requests):
+        if ordered:
+            results = []
+            for prepared in requests:
+                try:
+                    results.append(await send(host, port, prepared))
+                except Exception as exc:
+                    results.append(exc)
+            return results
+        return await asyncio.gather(*[send(host, port, prepared) for prepared in requests],
+            return_exceptions=True)
+
+    with dalion_api_tracing.batch():
+        results = await asyncio.gather(*[send_gateway(host, port, requests)
+            for host, port, requests in playbook.gateways])
+    return [result for gateway in results for result in gateway]
+
+
+def demo_steps(valip, count):
+    """
+    Steps of a preset over count lamps of the 4 channels, a level and a
+    colour temperature per lamp.
+    """
+
+    steps = []
+    for number in range(count):
+        valch = 1 + (number // 64) % 4
+        valii = number % 64
+        steps.append({"ip": valip, "channel": valch, "destination": 1, "index": valii,
+            "id": "dval", "value": number % 100})
+        steps.append({"ip": valip, "channel": valch, "destination": 1, "index": valii,
+            "cid": "d8ac", "ctype": 32, "cvalue": {"tc": 200 + number % 300}})
+    return steps
+
+
+async def run_benchmark(count, latency, rounds=5):
+    """
+    Compare building the URLs at each recall against compiling once and
+    replaying the playbook.
+    """
+
+    with dalion_api_simulator.Simulator(latency=latency, max_connections=64) as simulator:
+        steps = demo_steps(simulator.address, count)
+        async with dalion_api_async_client.AsyncClient() as client:
+
+            # Build the URLs at each recall
+            build = 0.0
+            start = time.perf_counter()
+            for _ in range(rounds):
+                begin = time.perf_counter()
+                urls = [url for step in steps for url in step_urls(step)]
+                build += time.perf_counter() - begin
+                await asyncio.gather(*[client.send_request(url) for url in urls])
+            rebuild_elapsed = time.perf_counter() - start
+
+            # Compile once, replay
+            begin = time.perf_counter()
+            playbook = compile_playbook(steps)
+            compile_elapsed = time.perf_counter() - begin
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await replay(client, playbook)
+            replay_elapsed = time.perf_counter() - start
+
+    print("{} steps, {} requests, {} rounds".format(len(steps), len(playbook), rounds))
+    print("rebuild: {:8.3f} ms URL build per recall, {:8.3f} ms per recall".format(
+        build / rounds * 1000, rebuild_elapsed / rounds * 1000))
+    print("compile: {:8.3f} ms once".format(compile_elapsed * 1000))
+    print("replay:  {:8.3f} ms URL build per recall, {:8.3f} ms per recall".format(
+        0.0, replay_elapsed / rounds * 1000))
+
+
+async def run_preset(path, ordered, timeout=None):
+    """
+    Compile and recall a preset file.
+    """
+
+    with open(path, encoding="utf-8") as source:
+        playbook = compile_playbook(json.load(source))
+
+    async with dalion_api_async_client.AsyncClient() as client:
+        start = time.perf_counter()
+        results = await replay(client, playbook, ordered, timeout)
+        elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if isinstance(result, BaseException)]
+    for result in failed:
+        print("error:", result)
+    print("{} requests, {} failed in {:.3f} s".format(len(results), len(failed), elapsed))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Precompiled scene/preset playbooks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = commands.add_parser("run", help="Recall a preset file.")
+    parser_run.add_argument("preset")
+    parser_run.add_argument("--ordered", action="store_true")
+    parser_run.add_argument("--timeout", type=float, help="Deadline of the recall in seconds.")
+
+    parser_benchmark = commands.add_parser("benchmark", help="Compare against rebuilding the URLs.")
+    parser_benchmark.add_argument("--count", type=int, default=256, help="Number of lamps.")
+    parser_benchmark.add_argument("--latency", type=float, default=0.0,
+        help="Simulator latency in seconds.")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        asyncio.run(run_preset(args.preset, args.ordered, args.timeout))
+    else:
+        asyncio.run(run_benchmark(args.count, args.latency))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,437 @@
+"""
+dalion_api_reconciler.py
+
+Desired-state reconciler.
+Every cycle diffs the desired variables of lamps, groups and channels
+(dval, dvpl, dvsl, dvnl, dvxl, dvft, dvfr, dvgr) against their last known
+actual values and sends only the changed ones, every changed variable of
+a target packed into a single set_device request, the device parameter
+being a list of {id, va}. The actual values of a lamp are read once with
+a single get_device request and then follow the writes.
+Every cycle reports the variable writes and the requests avoided against
+re-pushing the full desired configuration, one request per variable.
+
+The channel targets are sent first, then the groups, then the lamps, so
+that a lamp overrides its group. A channel or group write updates the
+known values of its lamps, the lamps of a group are taken from a
+dalion_api_groups.GroupIndex if given, otherwise every lamp of the
+channel is read again. Groups and channels are not read back, their
+values are known once written.
+
+Usage
+import dalion_api_reconciler
+
+reconciler = dalion_api_reconciler.Reconciler(client)
+desired = {("192.168.0.210", 1, 1, 0): {"dval": 50, "dvft": 2}}
+report = await reconciler.reconcile(desired)
+print(report.writes_avoided, report.requests_avoided)
+
+Usage - Command line arguments
+dalion_api_reconciler.py run desired.json [--interval s] [--cycles n] [--refresh]
+dalion_api_reconciler.py demo [--cycles n] [--latency s]
+
+desired.json: JSON list of targets
+{"ip": "192.168.0.210", "channel": 1, "destination": 1, "index": 0,
+ "variables": {"dval": 50, "dvft": 2}}
+--interval: Seconds between the cycles.
+--cycles: Number of cycles, 0 to run until interrupted.
+--refresh: Read the lamps again every cycle, e.g. when they are also
+    changed by wall switches or another controller.
+
+Examples:
+Keep the channel 1 at its desired configuration every 10 seconds.
+dalion_api_reconciler.py run channel1.json --interval 10 --cycles 0
+
+Reconcile a changing configuration against a local simulator.
+dalion_api_reconciler.py demo
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import dalion_api_async_client
+import dalion_api_groups
+import dalion_api_metrics
+import dalion_api_simulator
+import dalion_api_tracing
+import device_variables
+
+
+DEF_VARIABLES = ("dval", "dvpl", "dvsl", "dvnl", "dvxl", "dvft", "dvfr", "dvgr")
+
+"""
+"" Variables read back from the lamps.
+"""
+
+DEF_INTERVAL = 10.0
+
+"""
+"" Default seconds between the cycles.
+"""
+
+_MISSING = object()
+
+"""
+"" Value of a variable never read or written.
+"""
+
+
+def normalize(valid, valv):
+    """
+    Comparable value of a variable: nb10 as float rounded to 0.1,
+    nb and se as int, the others as str.
+    """
+
+    ty = device_variables.registry[valid].ty
+    if ty == 'nb10':
+        return round(float(valv), 1)
+    if (ty == 'nb') | (ty == 'se'):
+        return int(valv)
+    return str(valv)
+
+
+class CycleReport:
+    """
+    Counters of a reconcile cycle.
+    variables: desired variables, the writes of a full re-push.
+    writes, requests: variables and set_device requests sent.
+    reads: get_device requests sent.
+    """
+
+    __slots__ = ("targets", "variables", "reads", "writes", "requests", "errors", "elapsed")
+
+    def __init__(self):
+        self.targets = 0
+        self.variables = 0
+        self.reads = 0
+        self.writes = 0
+        self.requests = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return ("CycleReport({} variables, {} writes, {} requests, {} reads, {} errors, "
+            "{} writes and {} requests avoided)").format(self.variables, self.writes,
+            self.requests, self.reads, self.errors, self.writes_avoided, self.requests_avoided)
+
+    @property
+    def writes_avoided(self):
+        """
+        Variable writes avoided against a full re-push.
+        """
+
+        return self.variables - self.writes
+
+    @property
+    def requests_avoided(self):
+        """
+        Requests avoided against one set_device request per desired variable.
+        """
+
+        return self.variables - self.requests
+
+
+class Reconciler:
+    """
+    Sends the changes between the desired and the last known actual
+    variables of lamps, groups and channels through an AsyncClient.
+    groups: optional dalion_api_groups.GroupIndex of the lamps.
+    """
+
+    def __init__(self, client, groups=None, timeout=None):
+        self.client = client
+        self.groups = groups
+        self.timeout = timeout
+        # (ip, channel, destination, index) -> id -> known value
+        self.actual = {}
+        self.cycles = 0
+        self.variables = 0
+        self.writes = 0
+        self.requests = 0
+        self.reads = 0
+        self.errors = 0
+
+    def forget(self, valip=None, valch=None):
+        """
+        Forget the known values of every target, or of a DALION or channel.
+        """
+
+        for key in list(self.actual):
+            if ((valip is None) or (key[0] == valip)) and ((valch is None) or (key[1] == int(valch))):
+                del self.actual[key]
+
+    async def reconcile(self, desired, refresh=False):
+        """
+        Run a cycle.
+        desired: dict (ip, channel, destination, index) -> dict id -> value.
+        refresh: Read the lamps again instead of trusting the known values.
+        Returns a CycleReport.
+        """
+
+        start = time.perf_counter()
+        report = CycleReport()
+
+        targets = {}
+        for key, values in desired.items():
+            normalized = {}
+            for valid, valv in values.items():
+                device_variables.find_variable(valid)
+                if not device_variables.registry[valid].validate(valv):
+                    raise ValueError("Variable value is out of range: " + valid + " " + str(valv))
+                normalized[valid] = normalize(valid, valv)
+            targets[device_variables.target_key(*key)] = normalized
+            report.targets += 1
+            report.variables += len(normalized)
+
+        with dalion_api_tracing.batch():
+            for valc in (3, 2, 1):
+                level = [key for key in targets if key[2] == valc]
+                if valc == 1:
+                    await self._read([key for key in level if refresh or (key not in self.actual)], report)
+
+                changes = []
+                for key in level:
+                    known = self.actual.get(key, {})
+                    changed = {valid: valv for valid, valv in targets[key].items()
+                        if known.get(valid, _MISSING) != valv}
+                    if changed:
+                        changes.append((key, changed))
+                if valc == 1:
+                    results = await asyncio.gather(*[self._write(key, changed)
+                        for key, changed in changes], return_exceptions=True)
+                else:
+                    # One after the other, as the planner: the last write wins on the
+                    # lamps of overlapping groups
+                    results = []
+                    for key, changed in changes:
+                        try:
+                            results.append(await self._write(key, changed))
+                        except Exception as exc:
+                            results.append(exc)
+                for (key, changed), result in zip(changes, results):
+                    report.requests += 1
+                    report.writes += len(changed)
+                    if isinstance(result, BaseException):
+                        # The target and its lamps may be in any state, e.g. a timeout
+                        # after the DALION applied the write
+                        report.errors += 1
+                        if valc != 1:
+                            for valsa in self._lamps(key):
+                                self.actual.pop((key[0], key[1], 1, valsa), None)
+                        self.actual.pop(key, None)
+
+        report.elapsed = time.perf_counter() - start
+        self.cycles += 1
+        self.variables += report.variables
+        self.writes += report.writes
+        self.requests += report.requests
+        self.reads += report.reads
+        self.errors += report.errors
+        return report
+
+    async def _read(self, keys, report):
+        """
+        Read the known values of lamps, a lamp that fails to read is
+        written in full.
+        """
+
+        records = await asyncio.gather(*[self.client.get_record(*key, timeout=self.timeout)
+            for key in keys], return_exceptions=True)
+        for key, record in zip(keys, records):
+            report.reads += 1
+            if isinstance(record, BaseException):
+                report.errors += 1
+                self.actual.pop(key, None)
+                continue
+            known = {}
+            for valid in DEF_VARIABLES:
+                try:
+                    known[valid] = normalize(valid, record[valid])
+                except (KeyError, TypeError, ValueError):
+                    pass
+            self.actual[key] = known
+
+    async def _write(self, key, changed):
+        """
+        Send the changed variables of a target and update the known values
+        of the target and of its lamps.
+        """
+
+        valip, valch, valc, valii = key
+        # Members before the write, a dvgr write moves them
+        lamps = self._lamps(key) if valc != 1 else None
+
+        await self.client.set_variables(valip, valch, valc, valii, changed, self.timeout)
+        self.actual.setdefault(key, {}).update(changed)
+
+        if valc == 1:
+            return
+        if (valc == 2) and (self.groups is None):
+            # Group of unknown members
+            for valsa in lamps:
+                self.actual.pop((valip, valch, 1, valsa), None)
+            return
+        for valsa in lamps:
+            known = self.actual.get((valip, valch, 1, valsa))
+            if known is not None:
+                known.update(changed)
+
+    def _lamps(self, key):
+        """
+        Lamps of a group or channel target: the members of a group in the
+        group index, else every known lamp of the channel.
+        """
+
+        valip, valch, valc, valii = key
+        if (valc == 2) and (self.groups is not None):
+            return dalion_api_groups.lamps_of(self.groups.lamps_in(valip, valch, valii))
+        return [known[3] for known in self.actual if (known[0] == valip) & (known[1] == valch)
+            & (known[2] == 1)]
+
+    def stats(self):
+        """
+        Get the counters of every cycle.
+        """
+
+        return {
+            "cycles": self.cycles,
+            "variables": self.variables,
+            "writes": self.writes,
+            "requests": self.requests,
+            "reads": self.reads,
+            "errors": self.errors,
+            "writes_avoided": self.variables - self.writes,
+            "requests_avoided": self.variables - self.requests
+        }
+
+
+def load_desired(path):
+    """
+    Load a JSON list of targets.
+    Returns a dict (ip, channel, destination, index) -> dict id -> value.
+    """
+
+    with open(path, encoding="utf-8") as source:
+        entries = json.load(source)
+    desired = {}
+    for entry in entries:
+        key = device_variables.target_key(entry["ip"], entry["channel"], entry["destination"],
+            entry.get("index", -1))
+        desired.setdefault(key, {}).update(entry["variables"])
+    return desired
+
+
+def print_report(cycle, report):
+    """
+    Print the counters of a cycle.
+    """
+
+    print("cycle {:3}: {:4} variables, {:4} writes in {:3} requests, {:3} reads, {} errors, "
+        "{:4} writes and {:4} requests avoided, {:.3f} s".format(cycle, report.variables,
+        report.writes, report.requests, report.reads, report.errors, report.writes_avoided,
+        report.requests_avoided, report.elapsed))
+
+
+async def run(path, interval, cycles, refresh):
+    """
+    Reconcile the desired file every interval seconds.
+    """
+
+    desired = load_desired(path)
+    async with dalion_api_async_client.AsyncClient() as client:
+        reconciler = Reconciler(client)
+        cycle = 0
+        while (cycles == 0) or (cycle < cycles):
+            cycle += 1
+            print_report(cycle, await reconciler.reconcile(desired, refresh))
+            if (cycles == 0) or (cycle < cycles):
+                await asyncio.sleep(interval)
+    print(reconciler.stats())
+
+
+async def run_demo(cycles, latency):
+    """
+    Reconcile a configuration changing every cycle against a local
+    simulator and verify the lamps.
+    """
+
+    random.seed(0)
+    with dalion_api_simulator.Simulator(latency=latency, max_connections=128) as simulator:
+        valip = simulator.address
+        async with dalion_api_async_client.AsyncClient() as client:
+            index = dalion_api_groups.GroupIndex()
+            index.attach(client)
+            records = await asyncio.gather(*[client.get_record(valip, 1, 1, valii)
+                for valii in range(dalion_api_simulator.DEF_LAMPS)])
+            for record in records:
+                index.set_lamp(valip, 1, record.dvsa, record.dvgr)
+
+            # The channel fade time, the group 3 level and the full
+            # configuration of the lamps 0-15
+            desired = {(valip, 1, 3, -1): {"dvft": 2}, (valip, 1, 2, 3): {"dval": 60}}
+            for valii in range(16):
+                desired[(valip, 1, 1, valii)] = {"dval": 40, "dvpl": 100, "dvsl": 100,
+                    "dvnl": 1, "dvxl": 100, "dvft": 2, "dvfr": 3, "dvgr": 1 << (valii % 16)}
+
+            reconciler = Reconciler(client, index)
+            for cycle in range(1, cycles + 1):
+                # The controller changes a few levels every cycle
+                for valii in random.sample(range(16), 2):
+                    desired[(valip, 1, 1, valii)]["dval"] = random.choice([10, 40, 70, 100])
+                if cycle == cycles:
+                    # A wall switch changed a lamp, found by a refresh
+                    simulator.state.set_device(1, [7], {"dval": 0})
+                print_report(cycle, await reconciler.reconcile(desired, refresh=(cycle == cycles)))
+
+            wrong = 0
+            for (_, _, valc, valii), values in desired.items():
+                if valc != 1:
+                    continue
+                record = await client.get_record(valip, 1, 1, valii)
+                wrong += sum(1 for valid, valv in values.items()
+                    if normalize(valid, record[valid]) != normalize(valid, valv))
+
+    print(reconciler.stats())
+    print("{} variables wrong".format(wrong))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Desired-state reconciler.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = commands.add_parser("run", help="Reconcile a desired file.")
+    parser_run.add_argument("desired")
+    parser_run.add_argument("--interval", type=float, default=DEF_INTERVAL,
+        help="Seconds between the cycles.")
+    parser_run.add_argument("--cycles", type=int, default=1,
+        help="Number of cycles, 0 to run until interrupted.")
+    parser_run.add_argument("--refresh", action="store_true",
+        help="Read the lamps again every cycle.")
+
+    parser_demo = commands.add_parser("demo", help="Reconcile against a simulator.")
+    parser_demo.add_argument("--cycles", type=int, default=5)
+    parser_demo.add_argument("--latency", type=float, default=0.0,
+        help="Simulator latency in seconds.")
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "run":
+            dalion_api_metrics.serve_from_environment()
+            asyncio.run(run(args.desired, args.interval, args.cycles, args.refresh))
+        else:
+            asyncio.run(run_demo(args.cycles, args.latency))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
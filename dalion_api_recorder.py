@@ -0,0 +1,676 @@
+"""
+dalion_api_recorder.py
+
+Memory-mapped time-series recorder of the lamps (dval, dvrh, dvbi) and
+the control devices (os, ls), fed by the get_device and action=get
+responses.
+A series is a directory of append-only segments of fixed-size records:
+each segment file is preallocated for capacity records and mapped in
+memory, one column after the other (time, device, then the variables),
+so that a range of records is a memoryview slice of every column, read
+without copying, and the aggregations run over whole columns in C.
+A full segment is closed and a new one started, the oldest segments are
+deleted beyond max_segments, so the disk usage is bounded by
+max_segments x capacity x record size.
+
+Time is in seconds since the epoch and never goes backwards in a series,
+dval is recorded raw (in 1/10 %), dvrh and dvbi in seconds.
+The devices are numbered in devices.json of the directory.
+
+Usage
+import dalion_api_recorder
+
+recorder = dalion_api_recorder.Recorder("history")
+recorder.record_lamp("192.168.0.210", 1, 0, record)
+recorder.record_snapshot("192.168.0.210", 1, snapshot)
+print(recorder.lamps.aggregate("dval", start, end))
+print(recorder.lamp_hours(group_index, start, end))
+recorder.close()
+
+Usage - Command line arguments
+dalion_api_recorder.py record ip [channel ...] [--directory d] [--index file] [--interval s] [--cycles n]
+dalion_api_recorder.py query [--directory d] [--since s] [--column id] [--index file]
+dalion_api_recorder.py benchmark [--devices n] [--seconds n]
+
+--directory: Directory of the series.
+--index: Topology index of dalion_api_inventory.py, the lamps to record
+    and their groups.
+--interval: Seconds between the samples.
+--since: Seconds of history to aggregate, all of it if missing.
+
+Examples:
+Record the lamps of the index and the sensors of the channel 1 every second.
+dalion_api_recorder.py record 192.168.0.210 1 --interval 1
+
+Level statistics and lamp-hours per group of the last hour.
+dalion_api_recorder.py query --since 3600
+
+Compare the size and speed against JSON lines.
+dalion_api_recorder.py benchmark
+"""
+
+import os
+import sys
+import mmap
+import json
+import time
+import array
+import bisect
+import random
+import struct
+import asyncio
+import argparse
+import itertools
+
+import dalion_api_async_client
+import dalion_api_groups
+import dalion_api_inventory
+import dalion_api_metrics
+import dalion_api_tracing
+
+
+DEF_DIRECTORY = "dalion_history"
+
+"""
+"" Default directory of the series.
+"""
+
+DEF_CAPACITY = 1 << 20
+
+"""
+"" Default number of records of a segment.
+"""
+
+DEF_MAX_SEGMENTS = 64
+
+"""
+"" Default number of segments kept per series.
+"""
+
+DEF_INTERVAL = 1.0
+
+"""
+"" Default seconds between the samples.
+"""
+
+DEF_MAGIC = b"DALIONTS"
+
+"""
+"" First bytes of a segment file.
+"""
+
+DEF_HEADER = struct.Struct("<8sIII")
+
+"""
+"" Segment header: magic, version, capacity, count.
+"""
+
+DEF_VERSION = 1
+
+"""
+"" Version of the segment format.
+"""
+
+DEF_LAMP_COLUMNS = (("t", "I"), ("device", "I"), ("dval", "i"), ("dvrh", "i"), ("dvbi", "i"))
+
+"""
+"" Columns of the lamp series.
+"""
+
+DEF_SENSOR_COLUMNS = (("t", "I"), ("device", "I"), ("os", "i"), ("ls", "i"))
+
+"""
+"" Columns of the control device series.
+"""
+
+
+class Segment:
+    """
+    Segment file of capacity records mapped in memory.
+    columns: name -> memoryview of the whole column.
+    """
+
+    def __init__(self, path, columns, capacity=DEF_CAPACITY):
+        self.path = path
+        size = DEF_HEADER.size + capacity * sum(struct.calcsize(typecode) for _, typecode in columns)
+        if not os.path.exists(path):
+            with open(path, "wb") as output:
+                output.write(DEF_HEADER.pack(DEF_MAGIC, DEF_VERSION, capacity, 0))
+                output.truncate(size)
+
+        self.file = open(path, "r+b")
+        magic, version, self.capacity, self.count = DEF_HEADER.unpack(self.file.read(DEF_HEADER.size))
+        if (magic != DEF_MAGIC) | (version != DEF_VERSION):
+            self.file.close()
+            raise ValueError("Not a segment file: " + path)
+        size = DEF_HEADER.size + self.capacity * sum(struct.calcsize(typecode)
+            for _, typecode in columns)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self._view = memoryview(self.map)
+
+        self.columns = {}
+        offset = DEF_HEADER.size
+        for name, typecode in columns:
+            length = self.capacity * struct.calcsize(typecode)
+            self.columns[name] = self._view[offset:offset + length].cast(typecode)
+            offset += length
+        self._order = [self.columns[name] for name, _ in columns]
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        """
+        True when no record can be appended.
+        """
+
+        return self.count >= self.capacity
+
+    def append(self, values):
+        """
+        Append a record, values in the order of the columns.
+        """
+
+        index = self.count
+        for column, value in zip(self._order, values):
+            column[index] = value
+        # The count is written last, a reader never sees a partial record
+        self.count = index + 1
+        DEF_HEADER.pack_into(self.map, 0, DEF_MAGIC, DEF_VERSION, self.capacity, self.count)
+
+    def first_time(self):
+        """
+        Time of the first record, None if empty.
+        """
+
+        return self.columns["t"][0] if self.count else None
+
+    def last_time(self):
+        """
+        Time of the last record, None if empty.
+        """
+
+        return self.columns["t"][self.count - 1] if self.count else None
+
+    def bounds(self, start, end):
+        """
+        Record indexes [lo, hi) of the times in [start, end).
+        """
+
+        times = self.columns["t"]
+        return (bisect.bisect_left(times, start, 0, self.count),
+            bisect.bisect_left(times, end, 0, self.count))
+
+    def close(self):
+        """
+        Flush and unmap the file. The mapping stays alive while a
+        window of it is still referenced.
+        """
+
+        self.map.flush()
+        try:
+            for column in self.columns.values():
+                column.release()
+            self._view.release()
+            self.map.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+
+class Window:
+    """
+    Records [lo, hi) of a segment, columns are memoryview slices of the
+    mapped file, not copies.
+    """
+
+    __slots__ = ("segment", "lo", "hi", "columns")
+
+    def __init__(self, segment, lo, hi):
+        self.segment = segment
+        self.lo = lo
+        self.hi = hi
+        self.columns = {name: column[lo:hi] for name, column in segment.columns.items()}
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+
+class Series:
+    """
+    Append-only series of fixed-size records in rotating segments.
+    """
+
+    def __init__(self, directory, name, columns, capacity=DEF_CAPACITY,
+            max_segments=DEF_MAX_SEGMENTS):
+        self.directory = directory
+        self.name = name
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+
+        numbers = sorted(int(entry[len(name) + 1:-4]) for entry in os.listdir(directory)
+            if entry.startswith(name + "-") and entry.endswith(".seg"))
+        self.segments = [Segment(self._path(number), self.columns, capacity) for number in numbers]
+        self._next = (numbers[-1] + 1) if numbers else 0
+        if (not self.segments) or self.segments[-1].full():
+            self._rotate()
+        self._last_time = max(segment.last_time() or 0 for segment in self.segments)
+
+    def _path(self, number):
+        return os.path.join(self.directory, "{}-{:08d}.seg".format(self.name, number))
+
+    def _rotate(self):
+        """
+        Start a new segment and delete the oldest beyond max_segments.
+        """
+
+        if self.segments:
+            self.segments[-1].map.flush()
+        self.segments.append(Segment(self._path(self._next), self.columns, self.capacity))
+        self._next += 1
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            oldest.close()
+            os.remove(oldest.path)
+
+    def append(self, *values):
+        """
+        Append a record, values in the order of the columns, the time first.
+        A time before the last one is recorded as the last one.
+        """
+
+        self._last_time = max(int(values[0]), self._last_time)
+        if self.segments[-1].full():
+            self._rotate()
+        self.segments[-1].append((self._last_time,) + values[1:])
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def windows(self, start=0, end=1 << 32):
+        """
+        Windows of the records with a time in [start, end), in time order.
+        """
+
+        windows = []
+        for segment in self.segments:
+            if (not segment.count) or (segment.last_time() < start) or (segment.first_time() >= end):
+                continue
+            lo, hi = segment.bounds(start, end)
+            if hi > lo:
+                windows.append(Window(segment, lo, hi))
+        return windows
+
+    def aggregate(self, column, start=0, end=1 << 32, devices=None):
+        """
+        count, min, max and mean of a column over [start, end), of the
+        devices of a set of device numbers or of every device.
+        """
+
+        count = 0
+        total = 0
+        low = None
+        high = None
+        for window in self.windows(start, end):
+            values = window[column]
+            if devices is not None:
+                values = array.array(values.format, itertools.compress(values,
+                    map(devices.__contains__, window["device"])))
+            if not len(values):
+                continue
+            count += len(values)
+            total += sum(values)
+            low = min(values) if low is None else min(low, min(values))
+            high = max(values) if high is None else max(high, max(values))
+        return {"count": count, "min": low, "max": high, "mean": (total / count) if count else None}
+
+    def first_last(self, column, start=0, end=1 << 32):
+        """
+        First and last value of a column per device over [start, end).
+        Returns two dicts device -> value.
+        """
+
+        windows = self.windows(start, end)
+        last = {}
+        for window in windows:
+            last.update(zip(window["device"], window[column]))
+        first = {}
+        for window in reversed(windows):
+            first.update(zip(reversed(window["device"]), reversed(window[column])))
+        return first, last
+
+    def disk_usage(self):
+        """
+        Bytes allocated on the disk by the segments.
+        """
+
+        return sum(os.stat(segment.path).st_blocks * 512 for segment in self.segments)
+
+    def close(self):
+        """
+        Flush and close every segment.
+        """
+
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+class DeviceTable:
+    """
+    Numbers of the devices of a recorder, kept in devices.json.
+    A device is (kind, ip, channel, index), kind "lamp" or "sensor".
+    The new devices are added in memory and written by save().
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "devices.json")
+        self.devices = []
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as source:
+                self.devices = [tuple(device) for device in json.load(source)]
+        self.numbers = {device: number for number, device in enumerate(self.devices)}
+        self.modified = False
+
+    def number(self, kind, valip, valch, valii):
+        """
+        Number of a device, added if missing.
+        """
+
+        device = (kind, valip, int(valch), int(valii))
+        number = self.numbers.get(device)
+        if number is None:
+            number = len(self.devices)
+            self.devices.append(device)
+            self.numbers[device] = number
+            self.modified = True
+        return number
+
+    def save(self):
+        """
+        Write devices.json if devices were added, before the records
+        referring to them.
+        """
+
+        if not self.modified:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as output:
+            json.dump(self.devices, output)
+        os.replace(temporary, self.path)
+        self.modified = False
+
+
+class Recorder:
+    """
+    lamps and sensors series of a directory.
+    """
+
+    def __init__(self, directory=DEF_DIRECTORY, capacity=DEF_CAPACITY,
+            max_segments=DEF_MAX_SEGMENTS):
+        os.makedirs(directory, exist_ok=True)
+        self.devices = DeviceTable(directory)
+        self.lamps = Series(directory, "lamps", DEF_LAMP_COLUMNS, capacity, max_segments)
+        self.sensors = Series(directory, "sensors", DEF_SENSOR_COLUMNS, capacity, max_segments)
+
+    def record_lamp(self, valip, valch, valii, record, now=None):
+        """
+        Record dval, dvrh and dvbi of a dalion_api_get_device.DeviceRecord.
+        """
+
+        now = time.time() if now is None else now
+        number = self.devices.number("lamp", valip, valch, valii)
+        self.devices.save()
+        self.lamps.append(now, number,
+            int(round(float(record["dval"]) * 10)), int(record["dvrh"]), int(record["dvbi"]))
+
+    def record_snapshot(self, valip, valch, snapshot, now=None):
+        """
+        Record os and ls of every control device of a
+        dalion_api_get_control_device.ControlDeviceSnapshot.
+        """
+
+        now = time.time() if now is None else now
+        for valii in snapshot:
+            self.devices.number("sensor", valip, valch, valii)
+        self.devices.save()
+        for valii in snapshot:
+            self.sensors.append(now, self.devices.number("sensor", valip, valch, valii),
+                int(snapshot.get(valii, "os") or 0), int(snapshot.get(valii, "ls") or 0))
+
+    def lamp_numbers(self, valip, valch, mask):
+        """
+        Device numbers of the lamps of a lamp mask, the known ones.
+        """
+
+        numbers = set()
+        for valii in dalion_api_groups.lamps_of(mask):
+            number = self.devices.numbers.get(("lamp", valip, int(valch), valii))
+            if number is not None:
+                numbers.add(number)
+        return numbers
+
+    def lamp_hours(self, groups, start=0, end=1 << 32):
+        """
+        Lamp-hours run per group over [start, end), the dvrh increase of
+        the member lamps. groups is a dalion_api_groups.GroupIndex.
+        Returns a dict (ip, channel, group) -> hours.
+        """
+
+        first, last = self.lamps.first_last("dvrh", start, end)
+        hours = {}
+        for (valip, valch), channel in groups.channels.items():
+            for valgi, members in enumerate(channel.members):
+                numbers = self.lamp_numbers(valip, valch, members)
+                if numbers:
+                    seconds = sum(last[number] - first[number] for number in numbers if number in last)
+                    hours[(valip, valch, valgi)] = seconds / 3600
+        return hours
+
+    async def poll(self, client, lamps, channels, interval=DEF_INTERVAL, cycles=0):
+        """
+        Record the lamps [(ip, channel, index)] and the control devices of
+        the channels [(ip, channel)] every interval seconds, cycles times
+        or until cancelled. The failed requests are skipped.
+        """
+
+        cycle = 0
+        while (cycles == 0) or (cycle < cycles):
+            started = time.monotonic()
+            records = await asyncio.gather(*[client.get_record(valip, valch, 1, valii)
+                for valip, valch, valii in lamps], return_exceptions=True)
+            snapshots = await asyncio.gather(*[client.get_snapshot(valip, valch)
+                for valip, valch in channels], return_exceptions=True)
+            now = time.time()
+            # One devices.json write for the new devices of the cycle
+            for (valip, valch, valii), record in zip(lamps, records):
+                if not isinstance(record, BaseException):
+                    self.devices.number("lamp", valip, valch, valii)
+            for (valip, valch), snapshot in zip(channels, snapshots):
+                if not isinstance(snapshot, BaseException):
+                    for valii in snapshot:
+                        self.devices.number("sensor", valip, valch, valii)
+            self.devices.save()
+            for (valip, valch, valii), record in zip(lamps, records):
+                if not isinstance(record, BaseException):
+                    self.record_lamp(valip, valch, valii, record, now)
+            for (valip, valch), snapshot in zip(channels, snapshots):
+                if not isinstance(snapshot, BaseException):
+                    self.record_snapshot(valip, valch, snapshot, now)
+            cycle += 1
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def close(self):
+        """
+        Flush and close the series.
+        """
+
+        self.lamps.close()
+        self.sensors.close()
+
+
+def print_aggregate(name, column, result, scale=1.0):
+    """
+    Print an aggregate.
+    """
+
+    if not result["count"]:
+        print("{:8} {:5} no record".format(name, column))
+        return
+    print("{:8} {:5} {:10} records, min {:10.1f}, max {:10.1f}, mean {:10.1f}".format(name, column,
+        result["count"], result["min"] * scale, result["max"] * scale, result["mean"] * scale))
+
+
+def run_query(args):
+    """
+    Print the aggregates of the series of a directory.
+    """
+
+    end = time.time() + 1
+    start = (end - args.since) if args.since else 0
+    recorder = Recorder(args.directory)
+    try:
+        columns = [args.column] if args.column else ["dval", "dvrh", "dvbi", "os", "ls"]
+        for column in columns:
+            series = recorder.lamps if column in dict(DEF_LAMP_COLUMNS) else recorder.sensors
+            print_aggregate(series.name, column, series.aggregate(column, start, end),
+                0.1 if column == "dval" else 1.0)
+
+        if os.path.exists(args.index):
+            topology = dalion_api_inventory.TopologyIndex.load(args.index)
+            groups = dalion_api_groups.GroupIndex.from_topology(topology)
+            for (valip, valch, valgi), hours in sorted(recorder.lamp_hours(groups, start, end).items()):
+                print("{} channel {} group {:2}: {:.3f} lamp-hours".format(valip, valch, valgi, hours))
+        print("{} lamp and {} sensor records, {:.1f} MB on disk".format(len(recorder.lamps),
+            len(recorder.sensors), (recorder.lamps.disk_usage() + recorder.sensors.disk_usage()) / 1e6))
+    finally:
+        recorder.close()
+
+
+async def run_record(args):
+    """
+    Record the lamps of the index and the control devices of the channels.
+    """
+
+    channels = args.channels or [1, 2, 3, 4]
+    lamps = []
+    if os.path.exists(args.index):
+        topology = dalion_api_inventory.TopologyIndex.load(args.index)
+        for valch in channels:
+            lamps.extend((args.ip, valch, valsa) for valsa in sorted(topology.lamps(args.ip, valch)))
+    print("Recording {} lamps and {} channels to {}".format(len(lamps), len(channels), args.directory))
+
+    recorder = Recorder(args.directory)
+    try:
+        async with dalion_api_async_client.AsyncClient() as client:
+            await recorder.poll(client, lamps, [(args.ip, valch) for valch in channels],
+                args.interval, args.cycles)
+    finally:
+        recorder.close()
+
+
+def benchmark(devices, seconds, directory):
+    """
+    Record seconds of samples of devices lamps, then compare the size,
+    write and aggregation times against JSON lines.
+    """
+
+    random.seed(0)
+    samples = []
+    for second in range(seconds):
+        for device in range(devices):
+            samples.append((1700000000 + second, device, random.randint(0, 1000),
+                3600 + second, 7200 + second))
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "benchmark.jsonl")
+    start = time.perf_counter()
+    with open(path, "w", encoding="utf-8") as output:
+        for t, device, dval, dvrh, dvbi in samples:
+            output.write(json.dumps({"t": t, "device": device, "dval": dval, "dvrh": dvrh,
+                "dvbi": dvbi}) + "\n")
+    json_write = time.perf_counter() - start
+    json_size = os.path.getsize(path)
+    start = time.perf_counter()
+    with open(path, encoding="utf-8") as source:
+        values = [json.loads(line)["dval"] for line in source]
+    json_mean = sum(values) / len(values)
+    json_read = time.perf_counter() - start
+    os.remove(path)
+
+    series = Series(directory, "benchmark", DEF_LAMP_COLUMNS, capacity=max(len(samples) // 4, 1),
+        max_segments=8)
+    try:
+        start = time.perf_counter()
+        for sample in samples:
+            series.append(*sample)
+        series_write = time.perf_counter() - start
+        series_size = series.disk_usage()
+        start = time.perf_counter()
+        result = series.aggregate("dval")
+        series_read = time.perf_counter() - start
+        assert result["mean"] == json_mean
+    finally:
+        segments = list(series.segments)
+        series.close()
+        for segment in segments:
+            os.remove(segment.path)
+
+    print("{} records".format(len(samples)))
+    print("JSON lines: {:8.1f} MB, write {:.3f} s, mean {:.3f} s".format(json_size / 1e6, json_write,
+        json_read))
+    print("segments:   {:8.1f} MB, write {:.3f} s, mean {:.3f} s".format(series_size / 1e6,
+        series_write, series_read))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Memory-mapped time-series recorder.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_record = commands.add_parser("record", help="Record lamps and control devices.")
+    parser_record.add_argument("ip")
+    parser_record.add_argument("channels", nargs="*", type=int)
+    parser_record.add_argument("--directory", default=DEF_DIRECTORY)
+    parser_record.add_argument("--index", default=dalion_api_inventory.DEF_INDEX_FILE,
+        help="Topology index of dalion_api_inventory.py.")
+    parser_record.add_argument("--interval", type=float, default=DEF_INTERVAL)
+    parser_record.add_argument("--cycles", type=int, default=0,
+        help="Number of samples, 0 to record until interrupted.")
+
+    parser_query = commands.add_parser("query", help="Aggregate the recorded series.")
+    parser_query.add_argument("--directory", default=DEF_DIRECTORY)
+    parser_query.add_argument("--since", type=float, help="Seconds of history.")
+    parser_query.add_argument("--column", choices=["dval", "dvrh", "dvbi", "os", "ls"])
+    parser_query.add_argument("--index", default=dalion_api_inventory.DEF_INDEX_FILE,
+        help="Topology index of dalion_api_inventory.py, for the lamp-hours per group.")
+
+    parser_benchmark = commands.add_parser("benchmark", help="Compare against JSON lines.")
+    parser_benchmark.add_argument("--devices", type=int, default=1000)
+    parser_benchmark.add_argument("--seconds", type=int, default=300)
+    parser_benchmark.add_argument("--directory", default=DEF_DIRECTORY)
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "record":
+            dalion_api_metrics.serve_from_environment()
+            asyncio.run(run_record(args))
+        elif args.command == "query":
+            run_query(args)
+        else:
+            benchmark(args.devices, args.seconds, args.directory)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,338 @@
+"""
+dalion_api_sensor_poller.py
+
+Long-running poller of the control devices (occupancy and light sensors).
+Each channel is read with a single action=get request per poll and only
+the changes of os/ls per control device are emitted to the subscribers,
+through callbacks or an async iterator.
+
+The interval adapts per channel: it drops to min_interval after an
+occupancy (os) change and stays there for active_window seconds, then
+backs off by the backoff factor up to max_interval while the channel is
+quiet. The detection latency, from the previous poll to the poll that saw
+the change, is reported by stats().
+
+Usage
+import asyncio
+import dalion_api_async_client
+import dalion_api_sensor_poller
+
+async def run():
+    async with dalion_api_async_client.AsyncClient() as client:
+        poller = dalion_api_sensor_poller.SensorPoller(client, [("192.168.0.210", 1)])
+        task = asyncio.ensure_future(poller.run())
+        async for change in poller.changes():
+            print(change)
+
+asyncio.run(run())
+
+Usage - Command line arguments
+dalion_api_sensor_poller.py ip [channel ...]
+
+Prints a JSON line per change of the channels, 1-4 if missing.
+The statistics are printed on Ctrl-C.
+
+Examples:
+Watch the sensors of the channels 1 and 2.
+dalion_api_sensor_poller.py 192.168.0.210 1 2
+"""
+
+import sys
+import json
+import time
+import asyncio
+import logging
+
+import dalion_api_async_client
+import dalion_api_get_control_device
+import dalion_api_metrics
+import dalion_api_tracing
+
+
+DEF_MIN_INTERVAL = 0.25
+
+"""
+"" Default poll interval in seconds after an occupancy change.
+"""
+
+DEF_MAX_INTERVAL = 5.0
+
+"""
+"" Default poll interval in seconds of a quiet channel.
+"""
+
+DEF_BACKOFF = 1.5
+
+"""
+"" Default factor applied to the interval of a quiet channel at each poll.
+"""
+
+DEF_ACTIVE_WINDOW = 30.0
+
+"""
+"" Default seconds the interval stays at min_interval after an occupancy change.
+"""
+
+
+_logger = logging.getLogger(__name__)
+
+"""
+"" Logger of the subscriber callback errors.
+"""
+
+
+class SensorChange:
+    """
+    Change of a control device variable.
+    latency is the upper bound of the detection latency in seconds,
+    from the start of the previous poll to the end of the poll that saw it.
+    """
+
+    __slots__ = ("valip", "valch", "valii", "valid", "old", "new", "time", "latency")
+
+    def __init__(self, valip, valch, valii, valid, old, new, time, latency):
+        self.valip = valip
+        self.valch = valch
+        self.valii = valii
+        self.valid = valid
+        self.old = old
+        self.new = new
+        self.time = time
+        self.latency = latency
+
+    def __repr__(self):
+        return "SensorChange(" + ", ".join(
+            name + "=" + repr(getattr(self, name)) for name in self.__slots__) + ")"
+
+    def as_dict(self):
+        """
+        Change as a dict.
+        """
+
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ChannelState:
+    """
+    Poll state and statistics of a channel.
+    """
+
+    def __init__(self, valip, valch, interval):
+        self.valip = valip
+        self.valch = valch
+        self.interval = interval
+        self.snapshot = None
+        self.last_poll = None
+        self.last_active = None
+        self.polls = 0
+        self.errors = 0
+        self.callback_errors = 0
+        self.changes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+
+class SensorPoller:
+    """
+    Adaptive poller of the control devices of many channels.
+    """
+
+    def __init__(self, client, channels, min_interval=DEF_MIN_INTERVAL,
+            max_interval=DEF_MAX_INTERVAL, backoff=DEF_BACKOFF, active_window=DEF_ACTIVE_WINDOW):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.active_window = active_window
+        self._channels = [ChannelState(valip, int(valch), min_interval) for valip, valch in channels]
+        self._callbacks = []
+        self._queues = []
+        self._stop = None
+
+    def subscribe(self, callback):
+        """
+        Call callback(change) for every change.
+        An exception of a callback is logged and does not stop the polling.
+        """
+
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Stop calling callback.
+        """
+
+        self._callbacks.remove(callback)
+
+    async def changes(self):
+        """
+        Async iterator of the changes, ends when the poller stops.
+        """
+
+        queue = asyncio.Queue()
+        self._queues.append(queue)
+        try:
+            while True:
+                change = await queue.get()
+                if change is None:
+                    return
+                yield change
+        finally:
+            self._queues.remove(queue)
+
+    async def run(self):
+        """
+        Poll every channel until stop() is called.
+        """
+
+        self._stop = asyncio.Event()
+        try:
+            await asyncio.gather(*[self._poll_channel(channel) for channel in self._channels])
+        finally:
+            for queue in self._queues:
+                queue.put_nowait(None)
+
+    def stop(self):
+        """
+        Stop polling.
+        """
+
+        if self._stop is not None:
+            self._stop.set()
+
+    async def _poll_channel(self, channel):
+        """
+        Poll a channel.
+        """
+
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                snapshot = await self.client.get_snapshot(channel.valip, channel.valch)
+            except (OSError, asyncio.TimeoutError, KeyError, TypeError, ValueError):
+                # Network errors, HTTP errors and invalid or malformed responses
+                channel.errors += 1
+                channel.interval = self.max_interval
+                await self._sleep(self.max_interval)
+                continue
+            done = time.monotonic()
+
+            channel.polls += 1
+            active = False
+            if channel.snapshot is not None:
+                latency = done - channel.last_poll
+                for change in self._diff(channel, snapshot, done, latency):
+                    if change.valid == 'os':
+                        active = True
+                    channel.changes += 1
+                    channel.latency_total += latency
+                    channel.latency_max = max(channel.latency_max, latency)
+                    self._emit(channel, change)
+            channel.snapshot = snapshot
+            channel.last_poll = start
+
+            # Adapt the interval
+            if active:
+                channel.last_active = done
+                channel.interval = self.min_interval
+            elif (channel.last_active is None) or (done - channel.last_active > self.active_window):
+                channel.interval = min(channel.interval * self.backoff, self.max_interval)
+
+            await self._sleep(channel.interval - (time.monotonic() - start))
+
+    def _diff(self, channel, snapshot, done, latency):
+        """
+        Changes of os/ls between the previous snapshot and snapshot.
+        """
+
+        previous = channel.snapshot
+        for valii in snapshot:
+            for vid in dalion_api_get_control_device.DEF_ID:
+                valid = vid['id']
+                old = previous.get(valii, valid)
+                new = snapshot.get(valii, valid)
+                if old != new:
+                    yield SensorChange(channel.valip, channel.valch, valii, valid, old, new,
+                        time.time(), latency)
+
+    def _emit(self, channel, change):
+        """
+        Send a change of a channel to the subscribers.
+        """
+
+        for callback in list(self._callbacks):
+            try:
+                callback(change)
+            except Exception:
+                channel.callback_errors += 1
+                _logger.exception("Sensor change callback %r failed", callback)
+        for queue in self._queues:
+            queue.put_nowait(change)
+
+    async def _sleep(self, delay):
+        """
+        Sleep unless the poller stops.
+        """
+
+        if delay <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self):
+        """
+        Statistics per channel: polls, errors, callback errors, changes,
+        current interval and the mean and max detection latency in seconds.
+        """
+
+        stats = {}
+        for channel in self._channels:
+            stats[channel.valip + "/" + str(channel.valch)] = {
+                "polls": channel.polls,
+                "errors": channel.errors,
+                "callback_errors": channel.callback_errors,
+                "changes": channel.changes,
+                "interval": channel.interval,
+                "latency_mean": channel.latency_total / channel.changes if channel.changes else 0.0,
+                "latency_max": channel.latency_max
+            }
+        return stats
+
+
+async def watch(valip, channels):
+    """
+    Print the changes of the channels until cancelled.
+    """
+
+    async with dalion_api_async_client.AsyncClient() as client:
+        poller = SensorPoller(client, [(valip, valch) for valch in channels])
+        poller.subscribe(lambda change: print(json.dumps(change.as_dict()), flush=True))
+        try:
+            await poller.run()
+        finally:
+            print(json.dumps(poller.stats(), indent=2), file=sys.stderr)
+
+
+def main():
+    """
+    main
+    """
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit()
+
+    valip = sys.argv[1]
+    channels = [int(valch) for valch in sys.argv[2:]] or list(dalion_api_async_client.DEF_CHANNELS)
+    dalion_api_metrics.serve_from_environment()
+
+    try:
+        asyncio.run(watch(valip, channels))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -14,6 +14,8 @@ ip: The DALION IP address.
 channel: The channel number, 1-4.
 destination: 1 = lamp, 2 = group, 3 = channel.
 destination-index: Lamp short address 0-63, group index 0-15 or channel -1.
+    A comma separated list of lamp short addresses or group indexes
+    sets the same colour on all of them with as few requests as possible.
 cid: Indicates the colour to modify (d8ac, dvpl, dvsl, dvnl, dvxl, d8s0-15, d8tw, d8tc).
 ctype: Indicates the type of colour
     (16 = xy-coordinate, 32 = colour temperature Tc, 64 = primary N, 128 = RGBWAF).
@@ -25,12 +27,19 @@ dalion_api_set_colour.py 192.168.0.210 1 3 -1 d8ac 32 2500
 
 Set light colour temperature to 4000 Kelvin for the group 2 on the channel 1.
 dalion_api_set_colour.py 192.168.0.210 1 2 2 d8ac 32 4000
+
+Set light colour temperature to 3000 Kelvin for the lamps 0, 1, 2 and 5 on the channel 1.
+dalion_api_set_colour.py 192.168.0.210 1 1 0,1,2,5 d8ac 32 3000
 """
 
 import sys
-import urllib.request
 import urllib.parse
 import json
+import functools
+
+import dalion_api_metrics
+import dalion_api_tracing
+import dalion_api_transport
 
 
 DEF_CID = [
@@ -114,8 +123,38 @@ DEF_DEFAULT_CVALUE = {
 "" Default cvalue.
 """
 
+_CVALUE_TEMPLATE = tuple(DEF_DEFAULT_CVALUE['value'].items())
+
+"""
+"" Immutable copy of the default cvalue fields, every field masked.
+"""
+
+DEF_CTYPE_FIELDS = {
+    16:  ("xx", "xy"),
+    32:  ("tc",),
+    64:  ("p0", "p1", "p2", "p3", "p4", "p5"),
+    128: ("rr", "rg", "rb", "rw", "ra", "rf")
+}
+
+"""
+"" cvalue fields set by each ctype.
+"""
+
+DEF_CVALUE_CACHE_SIZE = 4096
+
+"""
+"" Maximum number of memoized encoded cvalues.
+"""
+
+DEF_MAX_URL_LENGTH = 2048
+
+"""
+"" Default maximum length of a batch URL.
+"""
+
 
 
+@dalion_api_tracing.traced("valid_arguments")
 def valid_arguments(valip, valch, valc, valii):
     """
     Valid the arguments
@@ -157,6 +196,71 @@ def valid_arguments(valip, valch, valc, valii):
     return bvalid
 
 
+def prepare_target(valc, valiis):
+    """
+    Prepare the lamp short address, group index or channel parameter
+    for a list of indexes, sent as ints.
+    """
+
+    if valc == 1:
+        # Lamp short address
+        return "&sa=" + urllib.parse.quote_plus(json.dumps([int(valii) for valii in valiis]))
+    if valc == 2:
+        # Group index
+        return "&gi=" + urllib.parse.quote_plus(json.dumps([int(valii) for valii in valiis]))
+    # Channel
+    return "&gi=" + urllib.parse.quote_plus(json.dumps([-1]))
+
+
+def prepare_cvalue(valctype,
+        valcvalue_xx, valcvalue_xy,
+        valcvalue_tc,
+        valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
+        valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf):
+    """
+    Prepare the encoded cvalue parameter
+    """
+
+    if valctype == 16:
+        ## xy-coordinate
+        values = (valcvalue_xx, valcvalue_xy)
+    elif valctype == 32:
+        ## colour temperature Tc
+        values = (valcvalue_tc,)
+    elif valctype == 64:
+        ## primary N
+        values = (valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5)
+    elif valctype == 128:
+        ## RGBWAF
+        values = (valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf)
+    else:
+        values = ()
+
+    return encode_cvalue(valctype, *values)
+
+
+@functools.lru_cache(maxsize=DEF_CVALUE_CACHE_SIZE, typed=True)
+def encode_cvalue(valctype, *values):
+    """
+    Encode the cvalue of a ctype from the immutable template.
+    values are the fields of DEF_CTYPE_FIELDS[valctype], in order; only
+    these fields are unmasked. The encoded strings are memoized by value
+    and type, 250 and 250.0 encode differently.
+    """
+
+    valcvalue = dict(_CVALUE_TEMPLATE)
+    for key, value in zip(DEF_CTYPE_FIELDS.get(valctype, ()), values):
+        valcvalue[key] = value
+        valcvalue[key + "_isMask"] = False
+
+    valcvalue = json.dumps({"type": valctype, "value": valcvalue})
+    valcvalue = urllib.parse.quote_plus(valcvalue)
+
+    return valcvalue
+
+
+@dalion_api_tracing.traced("prepare_url")
+@dalion_api_metrics.timed_url
 def prepare_url(valip, valch, valc, valii,
         valcid, valctype,
         valcvalue_xx, valcvalue_xy,
@@ -177,21 +281,7 @@ def prepare_url(valip, valch, valc, valii,
     url += "&ch=" + valch
 
     ## Parameter - Lamp index, group index or channel
-    if valc == 1:
-        # Lamp index
-        valii = json.dumps([valii])
-        valii = urllib.parse.quote_plus(valii)
-        url += "&sa=" + valii
-    elif valc == 2:
-        # Group index
-        valii = json.dumps([valii])
-        valii = urllib.parse.quote_plus(valii)
-        url += "&gi=" + valii
-    else:
-        # Channel
-        valii = json.dumps([-1])
-        valii = urllib.parse.quote_plus(valii)
-        url += "&gi=" + valii
+    url += prepare_target(valc, [valii])
 
     ## Parameter - cid
     url += "&cid=" + valcid
@@ -200,56 +290,72 @@ def prepare_url(valip, valch, valc, valii,
     url += "&ctype=" + str(valctype)
 
     ## Parameter - cvalue
-    valcvalue = DEF_DEFAULT_CVALUE
-    valcvalue['type'] = valctype
-    if valctype == 16:
-        ## xy-coordinate
-        valcvalue['value']['xx'] = valcvalue_xx
-        valcvalue['value']['xy'] = valcvalue_xy
+    url += "&cvalue=" + prepare_cvalue(valctype,
+        valcvalue_xx, valcvalue_xy,
+        valcvalue_tc,
+        valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
+        valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf)
 
-        valcvalue['value']['xx_isMask'] = False
-        valcvalue['value']['xy_isMask'] = False
-    elif valctype == 32:
-        ## colour temperature Tc
-        valcvalue['value']['tc'] = valcvalue_tc
+    return url
 
-        valcvalue['value']['tc_isMask'] = False
-    elif valctype == 64:
-        ## primary N
-        valcvalue['value']['p0'] = valcvalue_p0
-        valcvalue['value']['p1'] = valcvalue_p1
-        valcvalue['value']['p2'] = valcvalue_p2
-        valcvalue['value']['p3'] = valcvalue_p3
-        valcvalue['value']['p4'] = valcvalue_p4
-        valcvalue['value']['p5'] = valcvalue_p5
-
-        valcvalue['value']['p0_isMask'] = False
-        valcvalue['value']['p1_isMask'] = False
-        valcvalue['value']['p2_isMask'] = False
-        valcvalue['value']['p3_isMask'] = False
-        valcvalue['value']['p4_isMask'] = False
-        valcvalue['value']['p5_isMask'] = False
-    elif valctype == 128:
-        ## RGBWAF
-        valcvalue['value']['rr'] = valcvalue_rr
-        valcvalue['value']['rg'] = valcvalue_rg
-        valcvalue['value']['rb'] = valcvalue_rb
-        valcvalue['value']['rw'] = valcvalue_rw
-        valcvalue['value']['ra'] = valcvalue_ra
-        valcvalue['value']['rf'] = valcvalue_rf
-
-        valcvalue['value']['rr_isMask'] = False
-        valcvalue['value']['rg_isMask'] = False
-        valcvalue['value']['rb_isMask'] = False
-        valcvalue['value']['rw_isMask'] = False
-        valcvalue['value']['ra_isMask'] = False
-        valcvalue['value']['rf_isMask'] = False
-
-    valcvalue = json.dumps(valcvalue)
-    valcvalue = urllib.parse.quote_plus(valcvalue)
-    url += "&cvalue=" + valcvalue
 
-    return url
+@dalion_api_tracing.traced("prepare_url")
+@dalion_api_metrics.timed_url
+def prepare_batch_urls(valip, valch, valc, valiis,
+        valcid, valctype,
+        valcvalue_xx, valcvalue_xy,
+        valcvalue_tc,
+        valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
+        valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf,
+        max_url_length=DEF_MAX_URL_LENGTH):
+    """
+    Prepare the URLs setting the same colour on many lamps or groups.
+    The lamp short addresses or group indexes are packed in as few URLs
+    as max_url_length allows.
+    """
+
+    ## Parameter - IP, action and channel
+    prefix = "http://" + valip
+    prefix += "/api/v100/dali_devices.ssi?action=set_colour"
+    prefix += "&ch=" + valch
+
+    ## Parameter - cid, ctype and cvalue
+    suffix = "&cid=" + valcid
+    suffix += "&ctype=" + str(valctype)
+    suffix += "&cvalue=" + prepare_cvalue(valctype,
+        valcvalue_xx, valcvalue_xy,
+        valcvalue_tc,
+        valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
+        valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf)
+
+    if valc not in (1, 2):
+        # Channel
+        return [prefix + prepare_target(valc, [-1]) + suffix]
+
+    ## Parameter - Lamp short addresses or group indexes
+    # "&sa=" or "&gi=", "[" and "]" encoded as "%5B" and "%5D"
+    budget = max_url_length - len(prefix) - len(suffix) - 4 - 6
+    # ", " encoded as "%2C+"
+    separator = 4
+
+    urls = []
+    chunk = []
+    length = 0
+    for valii in dict.fromkeys(int(valii) for valii in valiis):
+        size = len(str(valii)) + (separator if chunk else 0)
+        if length + size > budget:
+            if not chunk:
+                raise ValueError("max_url_length is too small for a single index.")
+            urls.append(prefix + prepare_target(valc, chunk) + suffix)
+            chunk = []
+            size = len(str(valii))
+            length = 0
+        chunk.append(valii)
+        length += size
+    if chunk:
+        urls.append(prefix + prepare_target(valc, chunk) + suffix)
+
+    return urls
 
 
 def send_request(url):
@@ -257,7 +363,7 @@ def send_request(url):
     Send the HTTP GET request
     """
 
-    response = urllib.request.urlopen(url).read()
+    response = dalion_api_transport.send_request(url)
 
     return response
 
@@ -403,8 +509,10 @@ def main():
 
         # destination (lamp, group, channel)
         valc = sys.argv[3]
+        valc = int(valc)
 
         # lamp short address, group index, -1 channel
+        # or a comma separated list of lamp short addresses or group indexes
         valii = sys.argv[4]
 
         # cid
@@ -445,32 +553,43 @@ def main():
             valcvalue_rf = sys.argv[12]
 
     # Valid arguments
-    bvalid = valid_arguments(valip, valch, valc, valii)
-    if bvalid is False:
-        sys.exit()
+    valiis = str(valii).split(",")
+    for valii in valiis:
+        bvalid = valid_arguments(valip, valch, valc, valii)
+        if bvalid is False:
+            sys.exit()
 
     # Prepare the URL
-    url = prepare_url(valip, valch, valc, valii,
-        valcid, valctype,
-        valcvalue_xx, valcvalue_xy,
-        valcvalue_tc,
-        valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
-        valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf)
+    if len(valiis) == 1:
+        urls = [prepare_url(valip, valch, valc, valii,
+            valcid, valctype,
+            valcvalue_xx, valcvalue_xy,
+            valcvalue_tc,
+            valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
+            valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf)]
+    else:
+        urls = prepare_batch_urls(valip, valch, valc, valiis,
+            valcid, valctype,
+            valcvalue_xx, valcvalue_xy,
+            valcvalue_tc,
+            valcvalue_p0, valcvalue_p1, valcvalue_p2, valcvalue_p3, valcvalue_p4, valcvalue_p5,
+            valcvalue_rr, valcvalue_rg, valcvalue_rb, valcvalue_rw, valcvalue_ra, valcvalue_rf)
 
-    # Print the URL
-    print("")
-    print("Request: ")
-    print(url)
-    print("")
+    for url in urls:
+        # Print the URL
+        print("")
+        print("Request: ")
+        print(url)
+        print("")
 
-    # Send the request
-    response = send_request(url)
+        # Send the request
+        response = send_request(url)
 
-    # Print the response
-    print("Response: ")
-    print(response)
-    print("")
+        # Print the response
+        print("Response: ")
+        print(response)
+        print("")
 
 
 if __name__ == '__main__':
-    main()
+    dalion_api_tracing.run(main)
@@ -17,6 +17,10 @@ destination-index: Lamp index 0-63, group index 0-15 or channel -1.
 id: The variable id.
 value: The value.
 
+Usage - Batch of JSON line commands from a file or stdin
+dalion_api_set_device.py --batch [file]
+See dalion_api_batch.py.
+
 Examples:
 Set light intensity to 10% for the channel 1.
 dalion_api_set_device.py 192.168.0.210 1 3 -1 dval 100
@@ -36,16 +40,20 @@ dalion_api_set_device.py 192.168.0.210 1 3 -1 dvft 2
 
 
 import sys
-import urllib.request
 import urllib.parse
 import json
 
+import dalion_api_metrics
+import dalion_api_tracing
+import dalion_api_transport
 import device_variables
 
 
-def valid_arguments(valip, valch, valc, valii, valid, valv, variable):
+@dalion_api_tracing.traced("valid_arguments")
+def valid_arguments(valip, valch, valc, valii, valid, valv, variable, out=None):
     """
     Valid the arguments
+    The messages are printed to out, sys.stdout by default.
     """
 
     bvalid = True
@@ -58,51 +66,63 @@ def valid_arguments(valip, valch, valc, valii, valid, valv, variable):
 
     # Valid - IP
     if valip == "":
-        print("IP is invalid.")
+        print("IP is invalid.", file=out)
         bvalid = False
     # Valid - Channel
     if (valch < 1) | (valch > 4):
-        print("Channel number is invalid.")
+        print("Channel number is invalid.", file=out)
         bvalid = False
     # Valid - Index
     if valc == 1:
         # Lamp index
         if (valii < 0) | (valii > 63):
-            print("Lamp index is invalid.")
+            print("Lamp index is invalid.", file=out)
             bvalid = False
     elif valc == 2:
         # Group index
         if (valii < 0) | (valii > 15):
-            print("Group index is invalid.")
+            print("Group index is invalid.", file=out)
             bvalid = False
     else:
         # Channel
         if valii != -1:
-            print("Channel index is invalid.")
+            print("Channel index is invalid.", file=out)
             bvalid = False
 
-    if (variable['ty'] == 'nb') | (variable['ty'] == 'nb10'):
-        if variable['ty'] == 'nb10':
-            valv = float(valv) * 10
-        else:
-            valv = int(valv)
-        if (valv < int(variable['mi'])) | (valv > int(variable['ma'])):
-            print("Variable value is out of range.")
-            bvalid = False
+    # Valid - Value
+    if not device_variables.registry[variable['id']].validate(valv):
+        print("Variable value is out of range.", file=out)
+        bvalid = False
 
     # Valid - id
     if valid == "":
-        print("id is invalid.")
+        print("id is invalid.", file=out)
         bvalid = False
 
     return bvalid
 
 
+@dalion_api_tracing.traced("prepare_url")
 def prepare_url(valip, valch, valc, valii, valv, variable):
     """
     Prepare the URL
     """
 
+    return prepare_variables_url(valip, valch, valc, valii, [(variable['id'], valv)])
+
+
+@dalion_api_tracing.traced("prepare_url")
+@dalion_api_metrics.timed_url
+def prepare_variables_url(valip, valch, valc, valii, values):
+    """
+    Prepare the URL setting many variables of a lamp, group or channel
+    with a single request.
+    values: list of (id, value), or dict id -> value.
+    """
+
+    if isinstance(values, dict):
+        values = values.items()
+
     ## Parameter - IP
     url = "http://" + valip
 
@@ -124,12 +144,8 @@ def prepare_url(valip, valch, valc, valii, valv, variable):
         url += "&gi=-1"
 
     ## Parameter - Device
-    if variable['ty'] == 'nb10':
-        value = str(float(valv) * 10)
-    else:
-        value = valv
-
-    device = json.dumps([{'id': variable['id'], 'va': value}])
+    registry = device_variables.registry
+    device = json.dumps([{'id': valid, 'va': registry[valid].encode(valv)} for valid, valv in values])
     device = urllib.parse.quote_plus(device)
     url += "&device=" + device
 
@@ -141,7 +157,7 @@ def send_request(url):
     Send the HTTP GET request
     """
 
-    response = urllib.request.urlopen(url).read()
+    response = dalion_api_transport.send_request(url)
 
     return response
 
@@ -151,6 +167,13 @@ def main():
     main
     """
 
+    # Batch of JSON line commands
+    if (len(sys.argv) > 1) and (sys.argv[1] == "--batch"):
+        # Imported here, dalion_api_batch imports this module
+        import dalion_api_batch
+        dalion_api_batch.main(sys.argv[2:])
+        return
+
     # Parse the command arguments
     if len(sys.argv) != 7:
         # User Input
@@ -217,13 +240,7 @@ def main():
         valc = int(valc)
 
         # Find the variable for valid
-        index = 0
-        for variable in device_variables.device_variables:
-            if variable['id'] == valid:
-                valvi = index
-                break
-            index = index + 1
-        variable = device_variables.device_variables[valvi]
+        variable = device_variables.find_variable(valid)
 
 
     # Valid arguments
@@ -250,4 +267,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    dalion_api_tracing.run(main)
@@ -16,6 +16,10 @@ destination: 1 = lamp, 2 = group, 3 = channel.
 destination-index: Lamp index 0-63, group index 0-15 or channel -1.
 value: The light intensity value in percent.
 
+Usage - Batch of JSON line commands from a file or stdin
+dalion_api_set_level.py --batch [file]
+See dalion_api_batch.py.
+
 Examples:
 Set light intensity to 10% for the channel 1.
 dalion_api_set_level.py 192.168.0.210 1 3 -1 100
@@ -29,79 +33,120 @@ dalion_api_set_level.py 192.168.0.210 1 1 0 0
 
 
 import sys
-import urllib.request
 import urllib.parse
 import json
 
+import dalion_api_metrics
+import dalion_api_tracing
+import dalion_api_transport
 
-if len(sys.argv) != 6:
-    # User Input
 
-    # Input - IP
-    valip = input("Enter DALION IP address: ")
+@dalion_api_tracing.traced("prepare_url")
+@dalion_api_metrics.timed_url
+def prepare_url(valip, valch, valc, valii, valv):
+    """
+    Prepare the URL
+    """
 
-    # Input - Destination (channel number)
-    valch = input("Enter channel number (1-4): ")
+    ## Parameter - IP
+    url = "http://" + valip
 
-    # Input - Destination (lamp, group or channel)
-    STRD = """Select destination:
-    1) Lamp
-    2) Group
-    3) Channel
-    """
-    valc = input(STRD)
-    valc = int(valc)
+    ## Parameter - URL
+    url += "/api/v100/dali_devices.ssi?action=set_device"
+
+    ## Parameter - Channel
+    url += "&ch=" + valch
 
-    ## Input - Lamp or group index
+    ## Parameter - Lamp index, group index or channel
     if valc == 1:
-        # Input - Lamp index
-        valii = input("Enter lamp index (0-63): ")
+        # Lamp index
+        url += "&di=" + valii
     elif valc == 2:
-        # Input - Group index
-        valii = input("Enter group index (0-15): ")
-
-    # Input - Value in percent
-    valv = input("Enter light intensity in percent %: ")
-else:
-    # Command line arguments
-
-    valip = sys.argv[1]
-    valch = sys.argv[2]
-    valc  = sys.argv[3]
-    valii = sys.argv[4]
-    valv  = sys.argv[5]
-
-    valc = int(valc)
-
-# Prepare the URL
-
-## Parameter - IP
-url = "http://" + valip
-
-## Parameter - URL
-url += "/api/v100/dali_devices.ssi?action=set_device"
-
-## Parameter - Channel
-url += "&ch=" + valch
-
-## Parameter - Lamp index, group index or channel
-if valc == 1:
-    # Lamp index
-    url += "&di=" + valii
-elif valc == 2:
-    # Group index
-    url += "&gi=" + valii
-else:
-    # Channel
-    url += "&gi=-1"
-
-## Parameter - Device
-device = json.dumps([{'id': 'dval', 'va': str(float(valv) * 10)}])
-device = urllib.parse.quote_plus(device)
-url += "&device=" + device
-
-print(url)
-
-# Send the HTTP GET request
-response = urllib.request.urlopen(url).read()
-print(response)
+        # Group index
+        url += "&gi=" + valii
+    else:
+        # Channel
+        url += "&gi=-1"
+
+    ## Parameter - Device
+    device = json.dumps([{'id': 'dval', 'va': str(float(valv) * 10)}])
+    device = urllib.parse.quote_plus(device)
+    url += "&device=" + device
+
+    return url
+
+
+def send_request(url):
+    """
+    Send the HTTP GET request
+    """
+
+    response = dalion_api_transport.send_request(url)
+
+    return response
+
+
+def main():
+    """
+    main
+    """
+
+    # Batch of JSON line commands
+    if (len(sys.argv) > 1) and (sys.argv[1] == "--batch"):
+        # Imported here, only the batch mode needs the asyncio client
+        import dalion_api_batch
+        dalion_api_batch.main(sys.argv[2:])
+        return
+
+    if len(sys.argv) != 6:
+        # User Input
+
+        # Input - IP
+        valip = input("Enter DALION IP address: ")
+
+        # Input - Destination (channel number)
+        valch = input("Enter channel number (1-4): ")
+
+        # Input - Destination (lamp, group or channel)
+        strd = """Select destination:
+        1) Lamp
+        2) Group
+        3) Channel
+        """
+        valc = input(strd)
+        valc = int(valc)
+
+        ## Input - Lamp or group index
+        valii = -1
+        if valc == 1:
+            # Input - Lamp index
+            valii = input("Enter lamp index (0-63): ")
+        elif valc == 2:
+            # Input - Group index
+            valii = input("Enter group index (0-15): ")
+
+        # Input - Value in percent
+        valv = input("Enter light intensity in percent %: ")
+    else:
+        # Command line arguments
+
+        valip = sys.argv[1]
+        valch = sys.argv[2]
+        valc  = sys.argv[3]
+        valii = sys.argv[4]
+        valv  = sys.argv[5]
+
+        valc = int(valc)
+
+    # Prepare the URL
+    url = prepare_url(valip, valch, valc, valii, valv)
+
+    print(url)
+
+    # Send the HTTP GET request
+    response = send_request(url)
+    print(response)
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
@@ -0,0 +1,564 @@
+"""
+dalion_api_simulator.py
+
+Local stand-in for a DALION, for offline testing and benchmarking.
+Implements /api/v100/dali_devices.ssi with action=get_device, set_device,
+set_colour and get, for 4 channels of 64 lamps, 16 groups following the
+dvgr membership of the lamps and 64 control devices.
+
+Latency, jitter, the maximum number of concurrent connections, the
+number of requests processed at once (workers, the others queue like on
+the embedded HTTP server) and the maximum URL length are configurable so
+that measurements are reproducible.
+
+Usage - Command line arguments
+dalion_api_simulator.py [--host host] [--port port] [--latency s] [--jitter s]
+    [--max-connections n] [--max-url-length n] [--lamps n] [--sensor-interval s]
+    [--workers n]
+
+Examples:
+Simulate a DALION on 127.0.0.1:8080 answering in 20 ms +/- 5 ms.
+dalion_api_simulator.py --port 8080 --latency 0.02 --jitter 0.005
+
+Use it with the scripts.
+dalion_api_get_device.py 127.0.0.1:8080 1 1 0 dval
+
+Usage - Python
+import dalion_api_simulator
+
+with dalion_api_simulator.Simulator(latency=0.01) as simulator:
+    url = dalion_api_get_device.prepare_url(simulator.address, "1", 1, "0")
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import http.server
+import urllib.parse
+
+import dalion_api_tracing
+import device_variables
+
+
+DEF_CHANNELS = 4
+
+"""
+"" Number of channels.
+"""
+
+DEF_LAMPS = 64
+
+"""
+"" Number of lamps per channel.
+"""
+
+DEF_GROUPS = 16
+
+"""
+"" Number of groups per channel.
+"""
+
+DEF_CONTROL_DEVICES = 64
+
+"""
+"" Number of control devices per channel.
+"""
+
+DEF_MAX_CONNECTIONS = 16
+
+"""
+"" Default maximum number of concurrent connections.
+"""
+
+DEF_MAX_URL_LENGTH = 4096
+
+"""
+"" Default maximum URL length.
+"""
+
+DEF_WORKERS = 0
+
+"""
+"" Default number of requests processed at once, 0 for no limit.
+"""
+
+DEF_PATH = "/api/v100/dali_devices.ssi"
+
+"""
+"" Path of the API.
+"""
+
+
+def default_lamp(valii):
+    """
+    Default variables of a lamp.
+    The lamp N is in the group N % 16.
+    """
+
+    return {
+        "dval": 0,
+        "na":   "Lamp " + str(valii),
+        "dvpl": 1000,
+        "dvsl": 1000,
+        "dvnl": 1,
+        "dvxl": 1000,
+        "dvfr": 7,
+        "dvft": 0,
+        "dvgr": 1 << (valii % DEF_GROUPS),
+        "dvsa": valii,
+        "dvrh": 0,
+        "dvbi": 0
+    }
+
+
+class SimulatorState:
+    """
+    Lamps, groups and control devices of the simulated DALION.
+    """
+
+    def __init__(self, lamps=DEF_LAMPS):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # channel -> lamp index -> variables
+        self.lamps = {}
+        # channel -> lamp index -> cid -> cvalue
+        self.colours = {}
+        # channel -> control device index -> control device
+        self.control_devices = {}
+        # (channel, lamp index) -> time of the last run hours update
+        self._updated = {}
+        for valch in range(1, DEF_CHANNELS + 1):
+            self.lamps[valch] = {valii: default_lamp(valii) for valii in range(lamps)}
+            self.colours[valch] = {valii: {} for valii in range(lamps)}
+            self.control_devices[valch] = {
+                valii: {"ii": valii, "os": 0, "ls": 0} for valii in range(DEF_CONTROL_DEVICES)
+            }
+
+    def members(self, valch, valgi):
+        """
+        Lamp indexes of a group, every lamp for the channel (-1).
+        """
+
+        lamps = self.lamps[valch]
+        if valgi == -1:
+            return list(lamps)
+        mask = 1 << valgi
+        return [valii for valii, lamp in lamps.items() if lamp["dvgr"] & mask]
+
+    def update_run_hours(self, valch, valii):
+        """
+        Count the run hours of a lamp that is on.
+        """
+
+        now = time.monotonic()
+        key = (valch, valii)
+        last = self._updated.get(key, self.started)
+        # Whole seconds only, the fraction counts at the next update
+        seconds = int(now - last)
+        self._updated[key] = last + seconds
+        lamp = self.lamps[valch][valii]
+        if lamp["dval"] > 0:
+            lamp["dvrh"] += seconds
+            lamp["dvbi"] += seconds
+
+    def get_device(self, valch, valii):
+        """
+        Variables of a lamp.
+        """
+
+        self.update_run_hours(valch, valii)
+        return self.lamps[valch][valii]
+
+    def get_device_response(self, valch, valii):
+        """
+        Body of the get_device response of a lamp.
+        """
+
+        variables = []
+        for valid, value in self.get_device(valch, valii).items():
+            descriptor = device_variables.registry[valid]
+            variables.append({"id": valid, "ty": descriptor.ty, "va": value})
+        return {"status": "ok", "data": {"device": {"variables": variables}}}
+
+    def get_response(self, valch):
+        """
+        Body of the action=get response of a channel.
+        """
+
+        devices = [dict(device) for device in self.control_devices[valch].values()]
+        return {"status": "ok", "data": {"control_devices": {"devices": devices}}}
+
+    def set_device(self, valch, valiis, values):
+        """
+        Set variables of lamps.
+        """
+
+        for valii in valiis:
+            self.update_run_hours(valch, valii)
+            self.lamps[valch][valii].update(values)
+
+    def set_colour(self, valch, valiis, valcid, valcvalue):
+        """
+        Set the colour of lamps, only the unmasked fields.
+        """
+
+        fields = {key: value for key, value in valcvalue.get("value", {}).items()
+            if (not key.endswith("_isMask")) and (not valcvalue["value"].get(key + "_isMask", False))}
+        for valii in valiis:
+            colour = self.colours[valch][valii].setdefault(valcid, {})
+            colour["type"] = valcvalue.get("type")
+            colour.update(fields)
+
+    def set_control_device(self, valch, valii, os=None, ls=None):
+        """
+        Change the state of a control device.
+        """
+
+        with self.lock:
+            device = self.control_devices[valch][valii]
+            if os is not None:
+                device["os"] = os
+            if ls is not None:
+                device["ls"] = ls
+
+
+class SimulatorError(Exception):
+    """
+    Request rejected by the simulator, with its HTTP status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SimulatorHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP handler of the simulated DALION.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.accepted = self.server.open_connection()
+
+    def finish(self):
+        self.server.close_connection()
+        super().finish()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        """
+        Handle a request.
+        """
+
+        server = self.server
+        if not self.accepted:
+            server.count("rejected")
+            self.close_connection = True
+            self.reply(503, {"status": "error", "message": "Too many connections"})
+            return
+        if len(self.path) > server.max_url_length:
+            server.count("rejected")
+            self.reply(414, {"status": "error", "message": "URL too long"})
+            return
+
+        if server.workers is None:
+            status, body = self.process()
+        else:
+            with server.workers:
+                status, body = self.process()
+        server.count("requests")
+        self.reply(status, body)
+
+    def process(self):
+        """
+        Wait for the latency and handle the API request.
+        """
+
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            return 200, server.handle_api(self.path)
+        except SimulatorError as exc:
+            return exc.status, {"status": "error", "message": str(exc)}
+
+    def reply(self, status, body):
+        """
+        Send the response with a single write.
+        """
+
+        body = json.dumps(body).encode("utf-8")
+        head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n".format(
+            status, self.responses.get(status, ("",))[0], len(body))
+        if self.close_connection:
+            head += "Connection: close\r\n"
+        self.wfile.write(head.encode("latin-1") + b"\r\n" + body)
+
+
+class SimulatorServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server of the simulated DALION.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, state, latency=0.0, jitter=0.0,
+            max_connections=DEF_MAX_CONNECTIONS, max_url_length=DEF_MAX_URL_LENGTH, verbose=False,
+            workers=DEF_WORKERS):
+        super().__init__(address, SimulatorHandler)
+        self.state = state
+        self.latency = latency
+        self.jitter = jitter
+        self.max_connections = max_connections
+        self.max_url_length = max_url_length
+        self.verbose = verbose
+        self.workers = threading.Semaphore(workers) if workers > 0 else None
+        self.stats = {"requests": 0, "rejected": 0, "connections": 0, "max_connections": 0}
+        self._lock = threading.Lock()
+
+    def open_connection(self):
+        """
+        Count a new connection, False above max_connections.
+        """
+
+        with self._lock:
+            self.stats["connections"] += 1
+            self.stats["max_connections"] = max(self.stats["max_connections"],
+                self.stats["connections"])
+            return self.stats["connections"] <= self.max_connections
+
+    def close_connection(self):
+        """
+        Count a closed connection.
+        """
+
+        with self._lock:
+            self.stats["connections"] -= 1
+
+    def handle_error(self, request, client_address):
+        """
+        Ignore the connections closed by the client, e.g. cancelled requests.
+        """
+
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, name):
+        """
+        Increment a counter.
+        """
+
+        with self._lock:
+            self.stats[name] += 1
+
+    def handle_api(self, path):
+        """
+        Handle an API request, returns the response body.
+        """
+
+        split = urllib.parse.urlsplit(path)
+        if split.path != DEF_PATH:
+            raise SimulatorError(404, "Not found")
+        query = urllib.parse.parse_qs(split.query)
+
+        def param(name, default=None):
+            values = query.get(name)
+            if not values:
+                if default is None:
+                    raise SimulatorError(400, "Missing parameter " + name)
+                return default
+            return values[0]
+
+        def number(name, default=None):
+            try:
+                return int(param(name, default))
+            except ValueError:
+                raise SimulatorError(400, "Invalid parameter " + name) from None
+
+        def array(name):
+            try:
+                values = [int(value) for value in json.loads(param(name))]
+            except (TypeError, ValueError):
+                raise SimulatorError(400, "Invalid parameter " + name) from None
+            return values
+
+        state = self.state
+        action = param("action")
+        valch = number("ch")
+        if valch not in state.lamps:
+            raise SimulatorError(400, "Invalid channel")
+
+        with state.lock:
+            if action == "get":
+                return state.get_response(valch)
+
+            if action == "get_device":
+                valiis = self.targets(valch, number("di", "-2"), number("gi", "-2"))
+                if not valiis:
+                    raise SimulatorError(404, "Device not found")
+                return state.get_device_response(valch, valiis[0])
+
+            if action == "set_device":
+                valiis = self.targets(valch, number("di", "-2"), number("gi", "-2"))
+                try:
+                    entries = json.loads(param("device"))
+                    values = {}
+                    for entry in entries:
+                        descriptor = device_variables.registry[entry["id"]]
+                        if descriptor.ty in ("nb", "nb10", "se"):
+                            values[descriptor.id] = int(float(entry["va"]))
+                        else:
+                            values[descriptor.id] = str(entry["va"])
+                except (KeyError, TypeError, ValueError):
+                    raise SimulatorError(400, "Invalid parameter device") from None
+                state.set_device(valch, valiis, values)
+                return {"status": "ok"}
+
+            if action == "set_colour":
+                if "sa" in query:
+                    valiis = [valii for valii in array("sa") if valii in state.lamps[valch]]
+                else:
+                    valiis = []
+                    for valgi in array("gi"):
+                        valiis.extend(state.members(valch, valgi))
+                try:
+                    valcvalue = json.loads(param("cvalue"))
+                except ValueError:
+                    raise SimulatorError(400, "Invalid parameter cvalue") from None
+                state.set_colour(valch, valiis, param("cid"), valcvalue)
+                return {"status": "ok"}
+
+        raise SimulatorError(400, "Invalid action")
+
+    def targets(self, valch, valdi, valgi):
+        """
+        Lamp indexes addressed by di or gi.
+        """
+
+        if valdi != -2:
+            return [valdi] if valdi in self.state.lamps[valch] else []
+        if (valgi < -1) | (valgi >= DEF_GROUPS):
+            raise SimulatorError(400, "Missing parameter di or gi")
+        return self.state.members(valch, valgi)
+
+
+class Simulator:
+    """
+    Simulated DALION running in a background thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+            max_connections=DEF_MAX_CONNECTIONS, max_url_length=DEF_MAX_URL_LENGTH,
+            lamps=DEF_LAMPS, sensor_interval=0.0, verbose=False, workers=DEF_WORKERS):
+        self.state = SimulatorState(lamps)
+        self.server = SimulatorServer((host, port), self.state, latency, jitter,
+            max_connections, max_url_length, verbose, workers)
+        self.sensor_interval = sensor_interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def address(self):
+        """
+        host:port of the simulator, to use as the DALION IP address.
+        """
+
+        host, port = self.server.server_address[:2]
+        return host + ":" + str(port)
+
+    @property
+    def stats(self):
+        """
+        Request and connection counters.
+        """
+
+        return dict(self.server.stats)
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        if self.sensor_interval > 0:
+            threading.Thread(target=self._run_sensors, daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run_sensors(self):
+        """
+        Toggle the occupancy and change the light of a random control
+        device every sensor_interval seconds.
+        """
+
+        while not self._stop.wait(self.sensor_interval):
+            valch = random.randint(1, DEF_CHANNELS)
+            valii = random.randrange(DEF_CONTROL_DEVICES)
+            device = self.state.control_devices[valch][valii]
+            self.state.set_control_device(valch, valii, 1 - device["os"], random.randint(0, 1000))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Local DALION simulator.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Response latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency jitter in seconds.")
+    parser.add_argument("--max-connections", type=int, default=DEF_MAX_CONNECTIONS)
+    parser.add_argument("--max-url-length", type=int, default=DEF_MAX_URL_LENGTH)
+    parser.add_argument("--lamps", type=int, default=DEF_LAMPS, help="Lamps per channel.")
+    parser.add_argument("--sensor-interval", type=float, default=0.0,
+        help="Seconds between random control device changes, 0 to disable.")
+    parser.add_argument("--workers", type=int, default=DEF_WORKERS,
+        help="Requests processed at once, the others queue, 0 for no limit.")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    simulator = Simulator(args.host, args.port, args.latency, args.jitter,
+        args.max_connections, args.max_url_length, args.lamps, args.sensor_interval, args.verbose,
+        args.workers)
+    simulator.start()
+    print("DALION simulator on " + simulator.address)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    sys.exit()
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
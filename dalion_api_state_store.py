@@ -0,0 +1,655 @@
+"""
+dalion_api_state_store.py
+
+Columnar state store of the lamps of a fleet of DALIONs.
+Every numeric variable of device_variables.py is a dense array.array of
+raw values (nb10 scaled by 10, as sent to the DALION), one cell per
+gateway x channel (4) x lamp (64), with a validity mask telling the cells
+whose value is known. A second array holds the last values known on the
+lamps, so that the modified cells and the minimal set_device commands
+(every modified variable of a lamp in a single request, or group and
+broadcast writes with plan=True) are found column by column.
+
+Queries and updates work on a Selection, a mask of one byte 0/1 per
+cell. The comparisons map over the whole column and the masks are
+combined as integers, so the loops run in C instead of per-lamp dicts.
+
+Usage
+import dalion_api_state_store
+
+store = dalion_api_state_store.StateStore()
+store.load_record("192.168.0.210", 1, 0, record)
+bright = store.where("dval", ">", 50) & store.where("dvrh", ">", 3600 * 1000)
+for valip, valch, valii in bright:
+    print(valip, valch, valii)
+store.scale("dval", 0.5, store.channel(2))
+for valip, valch, valc, valii, values in store.commands():
+    await client.set_variables(valip, valch, valc, valii, values)
+store.mark_synced()
+
+Usage - Command line arguments
+dalion_api_state_store.py benchmark [--gateways n]
+dalion_api_state_store.py demo [--latency s]
+
+Examples:
+Compare the store against per-lamp dicts for 100 DALIONs.
+dalion_api_state_store.py benchmark --gateways 100
+
+Query, update and sync the lamps of a local simulator.
+dalion_api_state_store.py demo
+"""
+
+import re
+import time
+import array
+import random
+import asyncio
+import argparse
+import operator
+import itertools
+import tracemalloc
+
+import dalion_api_async_client
+import dalion_api_planner
+import dalion_api_simulator
+import dalion_api_tracing
+import device_variables
+
+
+DEF_CHANNELS = 4
+
+"""
+"" Channels of a DALION.
+"""
+
+DEF_LAMPS = 64
+
+"""
+"" Lamps of a channel.
+"""
+
+DEF_CELLS = DEF_CHANNELS * DEF_LAMPS
+
+"""
+"" Cells of a DALION in every column.
+"""
+
+DEF_TYPECODE = "i"
+
+"""
+"" array typecode of the columns, the raw values fit in 32 bits.
+"""
+
+DEF_READ_ONLY = ("dvsa", "dvrh", "dvbi")
+
+"""
+"" Variables measured by the lamps, never written.
+"""
+
+DEF_VARIABLES = tuple(valid for valid, descriptor in device_variables.registry.items()
+    if descriptor.ty in ("nb", "nb10", "se"))
+
+"""
+"" Numeric variables, a column each.
+"""
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+
+"""
+"" Comparison operators of where.
+"""
+
+
+def encode_raw(valid, valv):
+    """
+    Raw value of a variable, nb10 scaled by 10.
+    """
+
+    if device_variables.registry[valid].ty == 'nb10':
+        return int(round(float(valv) * 10))
+    return int(valv)
+
+
+def decode_raw(valid, raw):
+    """
+    Value of a raw variable, nb10 scaled by 1/10.
+    """
+
+    if device_variables.registry[valid].ty == 'nb10':
+        return raw / 10
+    return raw
+
+
+def _combine(mask, other, function):
+    """
+    Combine two masks of 0/1 bytes, the shorter one padded with 0.
+    """
+
+    length = max(len(mask), len(other))
+    value = function(int.from_bytes(mask, "little"), int.from_bytes(other, "little"))
+    return value.to_bytes(length, "little")
+
+
+def _pick(condition, value, other):
+    return value if condition else other
+
+
+class Selection:
+    """
+    Cells of a StateStore, one byte 0/1 per cell.
+    Combine with &, | and ~, iterate the (ip, channel, lamp) cells.
+    """
+
+    __slots__ = ("store", "mask")
+
+    def __init__(self, store, mask):
+        self.store = store
+        self.mask = bytes(mask)
+
+    def __and__(self, other):
+        return Selection(self.store, _combine(self.mask, other.mask, operator.and_))
+
+    def __or__(self, other):
+        return Selection(self.store, _combine(self.mask, other.mask, operator.or_))
+
+    def __invert__(self):
+        return Selection(self.store, _combine(self.mask, b"\x01" * len(self.store), operator.xor))
+
+    def __len__(self):
+        return self.mask.count(1)
+
+    def __iter__(self):
+        return map(self.store.cell, self.indexes())
+
+    def __repr__(self):
+        return "Selection({} cells)".format(len(self))
+
+    def indexes(self):
+        """
+        Indexes of the selected cells, in order.
+        """
+
+        return list(itertools.compress(range(len(self.mask)), self.mask))
+
+    def runs(self):
+        """
+        (start, stop) of the runs of consecutive selected cells.
+        """
+
+        return [match.span() for match in re.finditer(b"\x01+", self.mask)]
+
+
+class StateStore:
+    """
+    Columns of the numeric variables of every lamp of the DALIONs.
+    values: id -> array of the raw values.
+    valid: id -> bytearray, 1 for the cells whose value is known.
+    synced, known: the last values known on the lamps and their validity.
+    """
+
+    def __init__(self, variables=DEF_VARIABLES):
+        self.variables = tuple(variables)
+        # slot -> ip, ip -> slot
+        self.gateways = []
+        self._slots = {}
+        self.values = {valid: array.array(DEF_TYPECODE) for valid in self.variables}
+        self.valid = {valid: bytearray() for valid in self.variables}
+        self.synced = {valid: array.array(DEF_TYPECODE) for valid in self.variables}
+        self.known = {valid: bytearray() for valid in self.variables}
+
+    def __len__(self):
+        return len(self.gateways) * DEF_CELLS
+
+    def add_gateway(self, valip):
+        """
+        Add the cells of a DALION, returns its slot.
+        """
+
+        slot = self._slots.get(valip)
+        if slot is not None:
+            return slot
+        slot = len(self.gateways)
+        self.gateways.append(valip)
+        self._slots[valip] = slot
+        zeros = bytes(DEF_CELLS * array.array(DEF_TYPECODE).itemsize)
+        for valid in self.variables:
+            self.values[valid].frombytes(zeros)
+            self.synced[valid].frombytes(zeros)
+            self.valid[valid].extend(bytes(DEF_CELLS))
+            self.known[valid].extend(bytes(DEF_CELLS))
+        return slot
+
+    def index(self, valip, valch, valii):
+        """
+        Index of the cell of a lamp, the DALION is added if missing.
+        """
+
+        return self.add_gateway(valip) * DEF_CELLS + (int(valch) - 1) * DEF_LAMPS + int(valii)
+
+    def cell(self, index):
+        """
+        (ip, channel, lamp) of a cell index.
+        """
+
+        slot, rest = divmod(index, DEF_CELLS)
+        return (self.gateways[slot], rest // DEF_LAMPS + 1, rest % DEF_LAMPS)
+
+    def load(self, valip, valch, valii, values):
+        """
+        Store the values read from a lamp, dict id -> value.
+        """
+
+        index = self.index(valip, valch, valii)
+        for valid, valv in values.items():
+            if valid in self.values:
+                raw = encode_raw(valid, valv)
+                self.values[valid][index] = raw
+                self.synced[valid][index] = raw
+                self.valid[valid][index] = 1
+                self.known[valid][index] = 1
+
+    def load_record(self, valip, valch, valii, record):
+        """
+        Store a dalion_api_get_device.DeviceRecord.
+        """
+
+        self.load(valip, valch, valii, {valid: record[valid] for valid in self.variables
+            if valid in record})
+
+    def get(self, valip, valch, valii, valid):
+        """
+        Value of a variable of a lamp, None if unknown.
+        """
+
+        index = self.index(valip, valch, valii)
+        if not self.valid[valid][index]:
+            return None
+        return decode_raw(valid, self.values[valid][index])
+
+    def set(self, valip, valch, valii, valid, valv):
+        """
+        Change a variable of a lamp.
+        """
+
+        self._check(valid, valv)
+        index = self.index(valip, valch, valii)
+        self.values[valid][index] = encode_raw(valid, valv)
+        self.valid[valid][index] = 1
+
+    def _check(self, valid, valv):
+        """
+        Raise ValueError for a read-only variable or a value out of range.
+        """
+
+        if valid in DEF_READ_ONLY:
+            raise ValueError("Read-only variable: " + valid)
+        if not device_variables.registry[valid].validate(valv):
+            raise ValueError("Variable value is out of range: " + valid + " " + str(valv))
+
+    # Selections
+
+    def all(self):
+        """
+        Every cell.
+        """
+
+        return Selection(self, b"\x01" * len(self))
+
+    def gateway(self, valip):
+        """
+        Cells of a DALION.
+        """
+
+        mask = bytearray(len(self))
+        start = self._slots[valip] * DEF_CELLS
+        mask[start:start + DEF_CELLS] = b"\x01" * DEF_CELLS
+        return Selection(self, mask)
+
+    def channel(self, valch, valip=None):
+        """
+        Cells of a channel of a DALION, or of every DALION.
+        """
+
+        if valip is None:
+            block = bytearray(DEF_CELLS)
+            start = (int(valch) - 1) * DEF_LAMPS
+            block[start:start + DEF_LAMPS] = b"\x01" * DEF_LAMPS
+            return Selection(self, bytes(block) * len(self.gateways))
+        mask = bytearray(len(self))
+        start = self._slots[valip] * DEF_CELLS + (int(valch) - 1) * DEF_LAMPS
+        mask[start:start + DEF_LAMPS] = b"\x01" * DEF_LAMPS
+        return Selection(self, mask)
+
+    def known_cells(self, valid):
+        """
+        Cells whose variable is known.
+        """
+
+        return Selection(self, self.valid[valid])
+
+    def where(self, valid, op, valv):
+        """
+        Known cells whose variable compares to a value, e.g.
+        where("dval", ">", 50), the value in the unit of the variable.
+        """
+
+        compare = _OPERATORS[op]
+        raw = encode_raw(valid, valv)
+        mask = bytes(map(compare, self.values[valid], itertools.repeat(raw)))
+        return Selection(self, _combine(mask, self.valid[valid], operator.and_))
+
+    def dirty(self, valid=None):
+        """
+        Cells modified since the last values known on the lamps, of a
+        variable or of any variable.
+        """
+
+        mask = bytes(len(self))
+        for column in ((valid,) if valid is not None else self.variables):
+            changed = bytes(map(operator.ne, self.values[column], self.synced[column]))
+            # Changed or never known on the lamp, and known here
+            changed = _combine(changed, bytes(map(operator.not_, self.known[column])), operator.or_)
+            changed = _combine(changed, self.valid[column], operator.and_)
+            mask = _combine(mask, changed, operator.or_)
+        return Selection(self, mask)
+
+    # Updates
+
+    def update(self, valid, valv, selection):
+        """
+        Set a variable of the known cells of a selection.
+        Returns the number of cells changed.
+        """
+
+        self._check(valid, valv)
+        raw = array.array(DEF_TYPECODE, [encode_raw(valid, valv)])
+        column = self.values[valid]
+        selection = selection & self.known_cells(valid)
+        for start, stop in selection.runs():
+            column[start:stop] = raw * (stop - start)
+        return len(selection)
+
+    def scale(self, valid, factor, selection):
+        """
+        Multiply a variable of the known cells of a selection, clamped to
+        the range of the variable.
+        Returns the number of cells changed.
+        """
+
+        if valid in DEF_READ_ONLY:
+            raise ValueError("Read-only variable: " + valid)
+        descriptor = device_variables.registry[valid]
+        column = self.values[valid]
+        selection = selection & self.known_cells(valid)
+        for start, stop in selection.runs():
+            scaled = map(round, map(operator.mul, column[start:stop], itertools.repeat(factor)))
+            scaled = map(max, scaled, itertools.repeat(descriptor.minimum))
+            column[start:stop] = array.array(DEF_TYPECODE, map(min, scaled,
+                itertools.repeat(descriptor.maximum)))
+        return len(selection)
+
+    def mark_synced(self, selection=None):
+        """
+        Record that the values of a selection, or of every cell, are on the lamps.
+        """
+
+        for valid in self.variables:
+            if selection is None:
+                self.synced[valid] = array.array(DEF_TYPECODE, self.values[valid])
+                self.known[valid] = bytearray(self.valid[valid])
+                continue
+            values = self.values[valid]
+            synced = self.synced[valid]
+            valids = self.valid[valid]
+            known = self.known[valid]
+            for start, stop in selection.runs():
+                # The cells not known here keep their last values
+                synced[start:stop] = array.array(DEF_TYPECODE, map(_pick, valids[start:stop],
+                    values[start:stop], synced[start:stop]))
+                known[start:stop] = bytes(map(operator.or_, known[start:stop], valids[start:stop]))
+
+    # Commands
+
+    def commands(self, plan=False):
+        """
+        Minimal set_device commands of the modified cells, a list of
+        (ip, channel, destination, index, dict id -> value), every
+        modified variable of a lamp in a single command.
+        plan: Use group and broadcast writes where they replace lamp
+            writes, the cells not known are taken as no lamp.
+        """
+
+        lamps = {}
+        groups = []
+        for valid in self.variables:
+            if valid in DEF_READ_ONLY:
+                continue
+            indexes = self.dirty(valid).indexes()
+            if not indexes:
+                continue
+            if plan and (valid != "dvgr"):
+                indexes = self._plan(valid, indexes, groups)
+            values = self.values[valid]
+            for index in indexes:
+                lamps.setdefault(index, {})[valid] = decode_raw(valid, values[index])
+
+        commands = groups
+        for index in sorted(lamps):
+            valip, valch, valii = self.cell(index)
+            commands.append((valip, valch, 1, valii, lamps[index]))
+        return commands
+
+    def _plan(self, valid, indexes, commands):
+        """
+        Plan the writes of a variable per channel with dalion_api_planner,
+        append the broadcast and group commands.
+        Returns the indexes left to write to the lamps.
+        """
+
+        left = []
+        for block, cells in itertools.groupby(indexes, lambda index: index // DEF_LAMPS):
+            cells = list(cells)
+            start = block * DEF_LAMPS
+            valids = self.valid[valid][start:start + DEF_LAMPS]
+            dvgr_known = self.known["dvgr"][start:start + DEF_LAMPS]
+            # Group writes need the membership of every lamp of the channel
+            if any(ok and not member for ok, member in zip(valids, dvgr_known)):
+                left.extend(cells)
+                continue
+            values = self.values[valid]
+            desired = {index - start: values[index] for index in range(start, start + DEF_LAMPS)
+                if valids[index - start]}
+            current = {index - start: self.synced[valid][index]
+                for index in range(start, start + DEF_LAMPS) if self.known[valid][index]}
+            groups = {valii: self.synced["dvgr"][start + valii] for valii in desired}
+            valip, valch, _ = self.cell(start)
+            for valc, valii, raw in dalion_api_planner.plan_writes(desired, groups, current):
+                if valc == 1:
+                    left.append(start + valii)
+                else:
+                    commands.append((valip, valch, valc, valii, {valid: decode_raw(valid, raw)}))
+        return left
+
+    async def sync(self, client, plan=False, timeout=None):
+        """
+        Send the commands of the modified cells through an AsyncClient,
+        the broadcast and group writes one after the other, then the
+        lamps concurrently. The channels whose commands all succeeded
+        are marked synced.
+        Returns the list of (command, response or exception).
+        """
+
+        commands = self.commands(plan)
+        results = []
+        for command in commands:
+            if command[2] != 1:
+                try:
+                    results.append((command, await client.set_variables(*command, timeout=timeout)))
+                except Exception as exc:
+                    results.append((command, exc))
+        lamps = [command for command in commands if command[2] == 1]
+        responses = await asyncio.gather(*[client.set_variables(*command, timeout=timeout)
+            for command in lamps], return_exceptions=True)
+        results.extend(zip(lamps, responses))
+
+        failed = set()
+        for (valip, valch, _, _, _), result in results:
+            if isinstance(result, BaseException):
+                failed.add((valip, valch))
+        synced = bytearray(len(self))
+        for valip, valch, _, _, _ in commands:
+            if (valip, valch) not in failed:
+                start = self.index(valip, valch, 0)
+                synced[start:start + DEF_LAMPS] = b"\x01" * DEF_LAMPS
+        self.mark_synced(Selection(self, synced))
+        return results
+
+    def memory(self):
+        """
+        Bytes used by the columns.
+        """
+
+        return sum(len(column) * column.itemsize + len(self.valid[valid])
+            for valid in self.variables for column in (self.values[valid], self.synced[valid])) \
+            + sum(len(self.known[valid]) for valid in self.variables)
+
+    @classmethod
+    def from_topology(cls, topology):
+        """
+        Build from a dalion_api_inventory.TopologyIndex, dvsa and dvgr known.
+        """
+
+        store = cls()
+        for valip, channels in topology.gateways.items():
+            for valch, channel in channels.items():
+                for valsa, lamp in channel["lamps"].items():
+                    store.load(valip, valch, valsa, {"dvsa": lamp.get("dvsa", valsa),
+                        "dvgr": lamp.get("dvgr", 0)})
+        return store
+
+
+def benchmark(gateways):
+    """
+    Compare the store against per-lamp dicts: memory, a query and a
+    bulk update of every DALION.
+    """
+
+    random.seed(0)
+    rows = []
+    for slot in range(gateways):
+        valip = "10.0.{}.{}".format(slot // 250, slot % 250 + 1)
+        for valch in range(1, DEF_CHANNELS + 1):
+            for valii in range(DEF_LAMPS):
+                rows.append((valip, valch, valii, {"dval": random.randint(0, 100),
+                    "dvpl": 100.0, "dvsl": 100.0, "dvnl": 0.1, "dvxl": 100.0, "dvfr": 7, "dvft": 0,
+                    "dvgr": 1 << (valii % 16), "dvsa": valii, "dvrh": random.randint(0, 20000000),
+                    "dvbi": 0}))
+
+    tracemalloc.start()
+    lamps = {(valip, valch, valii): dict(values) for valip, valch, valii, values in rows}
+    dict_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    store = StateStore()
+    for valip, valch, valii, values in rows:
+        store.load(valip, valch, valii, values)
+
+    start = time.perf_counter()
+    found = [key for key, values in lamps.items()
+        if (values["dval"] > 50) and (values["dvrh"] > 10000000)]
+    for key, values in lamps.items():
+        if key[1] == 2:
+            values["dval"] = min(max(round(values["dval"] * 0.5, 1), 0.0), 100.0)
+    dict_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    selection = store.where("dval", ">", 50) & store.where("dvrh", ">", 10000000)
+    store.scale("dval", 0.5, store.channel(2))
+    store_time = time.perf_counter() - start
+    assert len(selection) == len(found)
+
+    start = time.perf_counter()
+    commands = store.commands()
+    commands_time = time.perf_counter() - start
+
+    print("{} lamps".format(len(rows)))
+    print("dicts: {:8.1f} kB, query and update {:.4f} s".format(dict_memory / 1024, dict_time))
+    print("store: {:8.1f} kB, query and update {:.4f} s, {} commands in {:.4f} s".format(
+        store.memory() / 1024, store_time, len(commands), commands_time))
+
+
+async def run_demo(latency):
+    """
+    Load the lamps of a local simulator, query, update and sync them,
+    then verify.
+    """
+
+    random.seed(0)
+    with dalion_api_simulator.Simulator(latency=latency, max_connections=128) as simulator:
+        valip = simulator.address
+        for valii in range(DEF_LAMPS):
+            simulator.state.set_device(1, [valii], {"dval": random.choice([200, 400, 700, 900])})
+
+        async with dalion_api_async_client.AsyncClient() as client:
+            store = StateStore()
+            cells = [(valch, valii) for valch in (1, 2) for valii in range(DEF_LAMPS)]
+            records = await asyncio.gather(*[client.get_record(valip, valch, 1, valii)
+                for valch, valii in cells])
+            for (valch, valii), record in zip(cells, records):
+                store.load_record(valip, valch, valii, record)
+
+            bright = store.where("dval", ">", 50) & store.channel(1, valip)
+            print("{} lamps of the channel 1 above 50%".format(len(bright)))
+            store.scale("dval", 0.5, bright)
+            store.update("dval", 30, store.channel(2, valip))
+            print("{} lamps modified".format(len(store.dirty())))
+
+            commands = store.commands(plan=True)
+            for command in commands:
+                print(command)
+            start = time.perf_counter()
+            results = await store.sync(client, plan=True)
+            elapsed = time.perf_counter() - start
+
+            records = await asyncio.gather(*[client.get_record(valip, valch, 1, valii)
+                for valch, valii in cells])
+            wrong = sum(1 for (valch, valii), record in zip(cells, records)
+                if record.dval != store.get(valip, valch, valii, "dval"))
+
+    errors = sum(1 for _, result in results if isinstance(result, BaseException))
+    print("{} commands sent in {:.3f} s, {} errors, {} lamps wrong, {} modified left".format(
+        len(results), elapsed, errors, wrong, len(store.dirty())))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Columnar state store of the lamps.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_benchmark = commands.add_parser("benchmark", help="Compare against per-lamp dicts.")
+    parser_benchmark.add_argument("--gateways", type=int, default=100)
+
+    parser_demo = commands.add_parser("demo", help="Query, update and sync a simulator.")
+    parser_demo.add_argument("--latency", type=float, default=0.0,
+        help="Simulator latency in seconds.")
+
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.gateways)
+    else:
+        asyncio.run(run_demo(args.latency))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
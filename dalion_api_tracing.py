@@ -0,0 +1,415 @@
+"""
+dalion_api_tracing.py
+
+Tracing hooks and opt-in profiling of the request pipeline.
+The phases of a request emit spans to the hooks added with add_hook:
+valid_arguments, prepare_url, send_request and parse_response, in the
+scripts, the shared transport and the AsyncClient. A span carries the
+correlation id of the batch it ran in (dalion_api_batch, playbook
+replays, reconcile cycles), set with batch() and inherited by the asyncio
+tasks, and the id of its parent span. A phase called within the same
+phase, e.g. a URL builder delegating to another, is part of the outer span.
+Without hooks a traced function costs one extra call and test.
+
+DALION_PROFILE=file runs a script under cProfile and tracemalloc and
+writes a report file: time per phase, the functions by cumulative time
+and the top allocations. DALION_TRACE=file writes every span as a JSON line.
+
+Usage
+import dalion_api_tracing
+
+summary = dalion_api_tracing.PhaseSummary()
+dalion_api_tracing.add_hook(summary)
+with dalion_api_tracing.batch():
+    ...
+print(summary.report())
+
+Usage - Environment
+DALION_PROFILE=report.txt dalion_api_batch.py commands.jsonl
+DALION_TRACE=spans.jsonl dalion_api_set_device.py --batch commands.jsonl
+
+Examples:
+Find where the time of a bulk job goes.
+DALION_PROFILE=report.txt dalion_api_set_device.py --batch commands.jsonl
+"""
+
+import io
+import os
+import json
+import inspect
+import logging
+import time
+import pstats
+import cProfile
+import functools
+import itertools
+import threading
+import contextlib
+import contextvars
+import tracemalloc
+
+
+DEF_PROFILE_ENVIRONMENT = "DALION_PROFILE"
+
+"""
+"" Environment variable giving the report file of a profiled run.
+"""
+
+DEF_TRACE_ENVIRONMENT = "DALION_TRACE"
+
+"""
+"" Environment variable giving the JSON lines file of the spans of a run.
+"""
+
+DEF_REPORT_LINES = 30
+
+"""
+"" Functions and allocations listed in a profile report.
+"""
+
+DEF_TRACEMALLOC_FRAMES = 1
+
+"""
+"" Frames stored per allocation by tracemalloc.
+"""
+
+
+_hooks = []
+
+"""
+"" Callbacks receiving every finished Span, none when tracing is off.
+"""
+
+_correlation = contextvars.ContextVar("dalion_correlation_id", default=None)
+
+"""
+"" Correlation id of the current batch.
+"""
+
+_current = contextvars.ContextVar("dalion_span", default=None)
+
+"""
+"" Current Span.
+"""
+
+_ids = itertools.count(1)
+
+"""
+"" Span and correlation ids of the process.
+"""
+
+_logger = logging.getLogger(__name__)
+
+"""
+"" Logger of the hook errors.
+"""
+
+
+class Span:
+    """
+    Timed phase of a request.
+    start and end are time.perf_counter() values, error the exception
+    type name if the phase raised.
+    """
+
+    __slots__ = ("name", "correlation_id", "span_id", "parent_id", "start", "end",
+        "attributes", "error")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.correlation_id = _correlation.get()
+        self.span_id = next(_ids)
+        parent = _current.get()
+        self.parent_id = None if parent is None else parent.span_id
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def __repr__(self):
+        return "Span({} {:.6f} s, correlation {})".format(self.name, self.duration,
+            self.correlation_id)
+
+    @property
+    def duration(self):
+        """
+        Seconds of the span, 0 while running.
+        """
+
+        return (self.end - self.start) if self.end is not None else 0.0
+
+    def to_dict(self):
+        """
+        Fields of the span.
+        """
+
+        return {
+            "name": self.name,
+            "correlation_id": self.correlation_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class _ActiveSpan:
+    """
+    Context manager of a span, emitted to the hooks on exit.
+    """
+
+    __slots__ = ("name", "attributes", "span", "token")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        self.span = Span(self.name, self.attributes)
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        span = self.span
+        span.end = time.perf_counter()
+        if exc_type is not None:
+            span.error = exc_type.__name__
+        _current.reset(self.token)
+        for hook in tuple(_hooks):
+            try:
+                hook(span)
+            except Exception:
+                # Tracing never breaks a request
+                _logger.exception("Tracing hook %r failed", hook)
+        return False
+
+
+class _NoSpan:
+    """
+    Context manager doing nothing, while tracing is off.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def add_hook(hook):
+    """
+    Call hook(span) for every finished span.
+    An exception of a hook is logged, the traced call is not affected.
+    """
+
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Stop calling hook.
+    """
+
+    _hooks.remove(hook)
+
+
+def enabled():
+    """
+    True while a hook is added.
+    """
+
+    return bool(_hooks)
+
+
+def span(name, **attributes):
+    """
+    Context manager timing a phase, a no-op while tracing is off.
+    """
+
+    if (not _hooks) or _within(name):
+        return _NO_SPAN
+    return _ActiveSpan(name, attributes)
+
+
+def _within(name):
+    """
+    True within a span of the phase name.
+    """
+
+    current = _current.get()
+    return (current is not None) and (current.name == name)
+
+
+def traced(name):
+    """
+    Decorator emitting a span named name for every call of a function
+    or coroutine function.
+    """
+
+    def decorator(function):
+        attributes = {"function": function.__module__ + "." + function.__qualname__}
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if (not _hooks) or _within(name):
+                    return await function(*args, **kwargs)
+                with _ActiveSpan(name, attributes):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if (not _hooks) or _within(name):
+                return function(*args, **kwargs)
+            with _ActiveSpan(name, attributes):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def batch(correlation_id=None):
+    """
+    Run a batch under a correlation id, a new one by default.
+    The asyncio tasks created inside inherit it. Yields the id.
+    """
+
+    if correlation_id is None:
+        correlation_id = "{:x}-{:x}".format(os.getpid(), next(_ids))
+    token = _correlation.set(correlation_id)
+    try:
+        yield correlation_id
+    finally:
+        _correlation.reset(token)
+
+
+def correlation_id():
+    """
+    Correlation id of the current batch, None outside a batch.
+    """
+
+    return _correlation.get()
+
+
+class PhaseSummary:
+    """
+    Hook counting the spans and their time per phase.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [count, total, maximum, errors]
+        self.phases = {}
+
+    def __call__(self, span):
+        with self._lock:
+            phase = self.phases.get(span.name)
+            if phase is None:
+                phase = [0, 0.0, 0.0, 0]
+                self.phases[span.name] = phase
+            phase[0] += 1
+            phase[1] += span.duration
+            phase[2] = max(phase[2], span.duration)
+            phase[3] += span.error is not None
+
+    def report(self):
+        """
+        Table of the phases by total time.
+        """
+
+        lines = ["{:16} {:>8} {:>12} {:>12} {:>12} {:>7}".format("phase", "count", "total s",
+            "mean ms", "max ms", "errors")]
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1][1])
+        for name, (count, total, maximum, errors) in phases:
+            lines.append("{:16} {:8} {:12.6f} {:12.4f} {:12.4f} {:7}".format(name, count, total,
+                total / count * 1000, maximum * 1000, errors))
+        return "\n".join(lines)
+
+
+class SpanLog:
+    """
+    Hook writing every span as a JSON line to a file.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._output = open(path, "w", encoding="utf-8")
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            self._output.write(line)
+
+    def close(self):
+        """
+        Close the file.
+        """
+
+        with self._lock:
+            self._output.close()
+
+
+def write_report(path, summary, profile, snapshot, peak):
+    """
+    Write the report of a profiled run.
+    """
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats("cumulative").print_stats(DEF_REPORT_LINES)
+
+    with open(path, "w", encoding="utf-8") as output:
+        output.write("Phases\n\n" + summary.report() + "\n\n")
+        output.write("cProfile, by cumulative time\n" + stream.getvalue() + "\n")
+        output.write("tracemalloc, peak {:.1f} kB, top allocations\n\n".format(peak / 1024))
+        for statistic in snapshot.statistics("lineno")[:DEF_REPORT_LINES]:
+            output.write(str(statistic) + "\n")
+
+
+def run(main, *args, **kwargs):
+    """
+    Run the main function of a script, traced and profiled as requested
+    by DALION_TRACE and DALION_PROFILE.
+    """
+
+    profile_path = os.environ.get(DEF_PROFILE_ENVIRONMENT)
+    trace_path = os.environ.get(DEF_TRACE_ENVIRONMENT)
+    if (not profile_path) and (not trace_path):
+        return main(*args, **kwargs)
+
+    log = None
+    if trace_path:
+        log = SpanLog(trace_path)
+        add_hook(log)
+    summary = profile = None
+    if profile_path:
+        summary = PhaseSummary()
+        add_hook(summary)
+        tracemalloc.start(DEF_TRACEMALLOC_FRAMES)
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        return main(*args, **kwargs)
+    finally:
+        if profile is not None:
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            remove_hook(summary)
+            write_report(profile_path, summary, profile, snapshot, peak)
+        if log is not None:
+            remove_hook(log)
+            log.close()
@@ -0,0 +1,463 @@
+"""
+dalion_api_transition.py
+
+Client-side fades and colour transitions.
+Transitions longer than the DALI fade table (dvft/dvfr) allows are
+streamed as interpolated dval (set_device) or cvalue (set_colour) updates
+at a target frame rate per target. Every transition shares one scheduler
+and each target has at most one request in flight: the frames computed
+while the DALION is busy replace each other and only the latest one is
+sent, so a slow DALION drops stale frames instead of queueing them.
+The achieved frames per second are reported by stats().
+
+Usage
+import asyncio
+import dalion_api_async_client
+import dalion_api_transition
+
+async def run():
+    async with dalion_api_async_client.AsyncClient() as client:
+        engine = dalion_api_transition.TransitionEngine(client)
+        fade = engine.fade("192.168.0.210", 1, 1, 0, 0, 100, 60.0)
+        sweep = engine.colour("192.168.0.210", 1, 1, 1, "d8ac", 32, {"tc": 153}, {"tc": 370}, 60.0)
+        await engine.wait()
+        print(engine.stats())
+
+asyncio.run(run())
+
+Usage - Command line arguments
+dalion_api_transition.py fade ip channel destination index start end duration [--fps n]
+dalion_api_transition.py colour ip channel destination index cid ctype start end duration [--fps n]
+dalion_api_transition.py benchmark [--count n] [--latency s] [--fps n] [--duration s]
+
+start/end: Level in percent for fade, JSON object of cvalue fields for colour.
+--easing: linear or smooth.
+
+Examples:
+Fade lamp 0 of the channel 1 from 0% to 100% in 2 minutes.
+dalion_api_transition.py fade 192.168.0.210 1 1 0 0 100 120
+
+Sweep the colour temperature of group 2 of the channel 1 in 30 s.
+dalion_api_transition.py colour 192.168.0.210 1 2 2 d8ac 32 '{"tc": 153}' '{"tc": 370}' 30
+
+Run 64 fades against a local simulator answering in 20 ms.
+dalion_api_transition.py benchmark --count 64 --latency 0.02
+"""
+
+import json
+import time
+import heapq
+import asyncio
+import argparse
+import itertools
+
+import dalion_api_async_client
+import dalion_api_simulator
+import dalion_api_tracing
+
+
+DEF_FPS = 20.0
+
+"""
+"" Default target frame rate per target.
+"""
+
+DEF_EASINGS = {
+    "linear": lambda progress: progress,
+    "smooth": lambda progress: progress * progress * (3 - 2 * progress)
+}
+
+"""
+"" Easing functions of the progress 0-1.
+"""
+
+
+class Transition:
+    """
+    Transition of the level or the colour of a lamp, group or channel.
+    done is a future resolved with the transition once its final frame
+    is sent or it is replaced by another transition of the same target.
+    """
+
+    def __init__(self, key, start, end, duration, fps, easing):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.fps = fps
+        self.easing = DEF_EASINGS[easing]
+        self.started = None
+        self.finished = None
+        self.replaced = False
+        self.last_value = None
+        self.frames = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.error = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    def value(self, progress):
+        """
+        Value at a progress 0-1.
+        """
+
+        progress = self.easing(progress)
+        if self.key[0] == "level":
+            return round(self.start + (self.end - self.start) * progress, 1)
+        return {field: int(round(self.start[field] + (self.end[field] - self.start[field]) * progress))
+            for field in self.end}
+
+    async def send(self, client, value):
+        """
+        Send a frame.
+        """
+
+        kind, valip, valch, valc, valii = self.key[:5]
+        if kind == "level":
+            await client.set_device(valip, valch, valc, valii, "dval", value)
+        else:
+            valcid, valctype = self.key[5:]
+            await client.set_colour(valip, valch, valc, valii, valcid, valctype, value)
+
+    def stats(self):
+        """
+        Frames computed, sent, dropped, errors and the achieved frames per second.
+        """
+
+        end = self.finished if self.finished is not None else time.monotonic()
+        elapsed = end - self.started if self.started is not None else 0.0
+        return {
+            "frames": self.frames,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "fps": self.sent / elapsed if elapsed > 0 else 0.0
+        }
+
+
+class _Target:
+    """
+    Request state of a target: whether a frame is in flight and the
+    latest frame waiting for it.
+    """
+
+    __slots__ = ("transition", "sending", "pending")
+
+    def __init__(self, transition):
+        self.transition = transition
+        self.sending = False
+        self.pending = None
+
+
+class TransitionEngine:
+    """
+    Shared scheduler of many transitions.
+    """
+
+    def __init__(self, client, fps=DEF_FPS):
+        self.client = client
+        self.fps = fps
+        self._targets = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._active = set()
+        self._completed = {"transitions": 0, "frames": 0, "sent": 0, "dropped": 0, "errors": 0,
+            "fps": 0.0}
+        self._first_start = None
+        self._last_finish = None
+
+    def fade(self, valip, valch, valc, valii, start, end, duration, fps=None, easing="linear"):
+        """
+        Fade the level (dval) of a lamp, group or channel from start to end
+        percent in duration seconds.
+        """
+
+        key = ("level", valip, int(valch), int(valc), int(valii))
+        return self._start(Transition(key, float(start), float(end), duration,
+            fps or self.fps, easing))
+
+    def colour(self, valip, valch, valc, valii, valcid, valctype, start, end, duration,
+            fps=None, easing="linear"):
+        """
+        Change the colour of a lamp, group or channel from the start to the
+        end cvalue fields in duration seconds, e.g. {"tc": 153} to {"tc": 370}.
+        """
+
+        if set(start) != set(end):
+            raise ValueError("start and end must have the same cvalue fields")
+        key = ("colour", valip, int(valch), int(valc), int(valii), valcid, int(valctype))
+        return self._start(Transition(key, dict(start), dict(end), duration,
+            fps or self.fps, easing))
+
+    async def wait(self):
+        """
+        Wait for every transition to complete.
+        """
+
+        while self._active:
+            await asyncio.gather(*[transition.done for transition in list(self._active)])
+
+    def stop(self):
+        """
+        Stop every transition, the levels stay where they are.
+        The frames waiting for an in-flight frame are dropped.
+        """
+
+        for target in self._targets.values():
+            if target.pending is not None:
+                target.pending[0].dropped += 1
+                target.pending = None
+            self._finish(target.transition)
+        self._heap.clear()
+        self._targets.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        """
+        Statistics of the completed and running transitions: frames
+        computed, sent, dropped, errors, the achieved frames per second of
+        the engine and the mean per transition.
+        """
+
+        stats = dict(self._completed)
+        for transition in self._active:
+            values = transition.stats()
+            stats["transitions"] += 1
+            for name in ("frames", "sent", "dropped", "errors", "fps"):
+                stats[name] += values[name]
+        stats["active"] = len(self._active)
+        fps = stats.pop("fps")
+        stats["fps_mean"] = fps / stats["transitions"] if stats["transitions"] else 0.0
+        end = self._last_finish if not self._active else time.monotonic()
+        elapsed = end - self._first_start if self._first_start is not None else 0.0
+        stats["fps"] = stats["sent"] / elapsed if elapsed > 0 else 0.0
+        return stats
+
+    def _start(self, transition):
+        """
+        Schedule a transition, replacing the one of the same target.
+        """
+
+        now = time.monotonic()
+        transition.started = now
+        if not self._active:
+            self._first_start = now
+        self._active.add(transition)
+        target = self._targets.get(transition.key)
+        if target is None:
+            target = _Target(transition)
+            self._targets[transition.key] = target
+        else:
+            target.transition.replaced = True
+            self._finish(target.transition)
+            target.transition = transition
+
+        heapq.heappush(self._heap, (now, next(self._sequence), transition))
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()
+        return transition
+
+    async def _run(self):
+        """
+        Compute the due frames of every transition until none is left.
+        """
+
+        try:
+            while self._heap:
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                now = time.monotonic()
+                while self._heap and (self._heap[0][0] <= now):
+                    due, _, transition = heapq.heappop(self._heap)
+                    if transition.replaced:
+                        continue
+                    if self._frame(transition, now):
+                        # The next frame on schedule, or one period from now when late
+                        due = max(due + 1 / transition.fps, now)
+                        heapq.heappush(self._heap, (due, next(self._sequence), transition))
+        finally:
+            # stop() may have started a new loop meanwhile
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    def _frame(self, transition, now):
+        """
+        Compute and submit a frame, returns False after the final frame.
+        """
+
+        if transition.duration > 0:
+            progress = min(1.0, (now - transition.started) / transition.duration)
+        else:
+            progress = 1.0
+        value = transition.value(progress)
+        final = progress >= 1.0
+        transition.frames += 1
+        if value != transition.last_value:
+            transition.last_value = value
+            self._submit(self._targets[transition.key], transition, value)
+        if final:
+            transition.finished = now
+            target = self._targets[transition.key]
+            if not target.sending:
+                self._complete(target)
+        return not final
+
+    def _submit(self, target, transition, value):
+        """
+        Send a frame, or keep it as the latest one while a frame is in flight.
+        """
+
+        if target.sending:
+            if target.pending is not None:
+                target.pending[0].dropped += 1
+            target.pending = (transition, value)
+            return
+        target.sending = True
+        asyncio.ensure_future(self._send(target, transition, value))
+
+    async def _send(self, target, transition, value):
+        """
+        Send a frame, then the latest frame computed meanwhile.
+        """
+
+        while True:
+            try:
+                await transition.send(self.client, value)
+                transition.sent += 1
+            except Exception as exc:
+                transition.errors += 1
+                transition.error = exc
+            if target.pending is None:
+                break
+            transition, value = target.pending
+            target.pending = None
+        target.sending = False
+        self._complete(target)
+
+    def _complete(self, target):
+        """
+        Remove a target once its transition sent its final frame.
+        """
+
+        transition = target.transition
+        if (transition.finished is None) or target.sending:
+            return
+        self._finish(transition)
+        if self._targets.get(transition.key) is target:
+            del self._targets[transition.key]
+
+    def _finish(self, transition):
+        """
+        Resolve the done future of a transition and add it to the statistics.
+        """
+
+        if transition.finished is None:
+            transition.finished = time.monotonic()
+        if transition.done.done():
+            return
+        self._active.discard(transition)
+        self._last_finish = time.monotonic()
+        values = transition.stats()
+        self._completed["transitions"] += 1
+        for name in ("frames", "sent", "dropped", "errors", "fps"):
+            self._completed[name] += values[name]
+        transition.done.set_result(transition)
+
+
+async def run_transition(kind, args):
+    """
+    Run a fade or a colour transition and print its statistics.
+    """
+
+    async with dalion_api_async_client.AsyncClient() as client:
+        engine = TransitionEngine(client, args.fps)
+        if kind == "fade":
+            transition = engine.fade(args.ip, args.channel, args.destination, args.index,
+                args.start, args.end, args.duration, easing=args.easing)
+        else:
+            transition = engine.colour(args.ip, args.channel, args.destination, args.index,
+                args.cid, args.ctype, json.loads(args.start), json.loads(args.end), args.duration,
+                easing=args.easing)
+        await engine.wait()
+    print(json.dumps(transition.stats()))
+    if transition.error is not None:
+        print("error:", transition.error)
+
+
+async def run_benchmark(count, latency, fps, duration):
+    """
+    Fade count lamps at once against a local simulator.
+    """
+
+    with dalion_api_simulator.Simulator(latency=latency, max_connections=count * 2 + 16) as simulator:
+        async with dalion_api_async_client.AsyncClient(max_gateway_concurrency=count) as client:
+            engine = TransitionEngine(client, fps)
+            for number in range(count):
+                engine.fade(simulator.address, 1 + (number // 64) % 4, 1, number % 64, 0, 100, duration)
+            await engine.wait()
+            stats = engine.stats()
+
+    print("{} fades of {} s at {} fps, DALION latency {} s".format(count, duration, fps, latency))
+    print("{} frames, {} sent, {} dropped, {} errors".format(
+        stats["frames"], stats["sent"], stats["dropped"], stats["errors"]))
+    print("{:.1f} fps in total, {:.1f} fps per fade".format(stats["fps"], stats["fps_mean"]))
+
+
+def main():
+    """
+    main
+    """
+
+    parser = argparse.ArgumentParser(description="Client-side fades and colour transitions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for kind in ("fade", "colour"):
+        parser_kind = commands.add_parser(kind)
+        parser_kind.add_argument("ip")
+        parser_kind.add_argument("channel", type=int)
+        parser_kind.add_argument("destination", type=int)
+        parser_kind.add_argument("index", type=int)
+        if kind == "colour":
+            parser_kind.add_argument("cid")
+            parser_kind.add_argument("ctype", type=int)
+            parser_kind.add_argument("start")
+            parser_kind.add_argument("end")
+        else:
+            parser_kind.add_argument("start", type=float)
+            parser_kind.add_argument("end", type=float)
+        parser_kind.add_argument("duration", type=float)
+        parser_kind.add_argument("--fps", type=float, default=DEF_FPS)
+        parser_kind.add_argument("--easing", choices=sorted(DEF_EASINGS), default="linear")
+
+    parser_benchmark = commands.add_parser("benchmark", help="Fades against a local simulator.")
+    parser_benchmark.add_argument("--count", type=int, default=64, help="Number of lamps.")
+    parser_benchmark.add_argument("--latency", type=float, default=0.02,
+        help="Simulator latency in seconds.")
+    parser_benchmark.add_argument("--fps", type=float, default=DEF_FPS)
+    parser_benchmark.add_argument("--duration", type=float, default=2.0)
+
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        asyncio.run(run_benchmark(args.count, args.latency, args.fps, args.duration))
+    else:
+        asyncio.run(run_transition(args.command, args))
+
+
+if __name__ == '__main__':
+    dalion_api_tracing.run(main)
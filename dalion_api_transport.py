@@ -0,0 +1,252 @@
+"""
+dalion_api_transport.py
+
+Shared HTTP transport used by the DALION API scripts.
+Keeps a pool of persistent HTTP/1.1 connections per DALION so that
+consecutive requests to the same DALION reuse the same TCP connection
+instead of paying a new handshake for every command.
+The round-trip, bytes received, errors and retries of every request are
+recorded by dalion_api_metrics.
+
+Usage
+import dalion_api_transport
+response = dalion_api_transport.send_request(url)
+
+Configuration
+dalion_api_transport.configure(pool_size=4, idle_timeout=30.0, timeout=10.0)
+
+pool_size: Maximum number of connections per DALION.
+idle_timeout: Seconds after which an unused connection is closed.
+timeout: Seconds a connect or a read may block before socket.timeout is
+    raised, so that a hung DALION does not block a script forever.
+    send_request(url, timeout) overrides it for one request.
+"""
+
+import collections
+import http.client
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+import dalion_api_metrics
+import dalion_api_tracing
+
+
+DEF_POOL_SIZE = 4
+
+"""
+"" Default maximum number of connections per DALION.
+"""
+
+DEF_IDLE_TIMEOUT = 30.0
+
+"""
+"" Default idle time in seconds before a pooled connection is closed.
+"""
+
+DEF_TIMEOUT = 10.0
+
+"""
+"" Default timeout in seconds of a connect or a read.
+"""
+
+
+class ConnectionPool:
+    """
+    Pool of persistent HTTP connections to one DALION.
+    """
+
+    def __init__(self, host, port, pool_size=DEF_POOL_SIZE, idle_timeout=DEF_IDLE_TIMEOUT,
+            timeout=DEF_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = collections.deque()
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Get an idle connection or open a new one.
+        Blocks while pool_size connections are in use.
+        """
+
+        with self._cond:
+            while True:
+                self._evict()
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                    return conn, True
+                if self._count < self.pool_size:
+                    self._count += 1
+                    break
+                self._cond.wait()
+
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, conn, reusable=True):
+        """
+        Return a connection to the pool, or close it.
+        """
+
+        with self._cond:
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+                self._count -= 1
+            self._cond.notify()
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                conn.close()
+                self._count -= 1
+            self._cond.notify_all()
+
+    def _evict(self):
+        """
+        Close the connections idle for longer than idle_timeout.
+        The oldest connections are at the left of the deque.
+        """
+
+        limit = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < limit:
+            conn, _ = self._idle.popleft()
+            conn.close()
+            self._count -= 1
+
+
+class Transport:
+    """
+    Set of connection pools, one per DALION.
+    """
+
+    def __init__(self, pool_size=DEF_POOL_SIZE, idle_timeout=DEF_IDLE_TIMEOUT, timeout=DEF_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, host, port):
+        """
+        Get the connection pool of a DALION.
+        """
+
+        key = (host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(host, port, self.pool_size, self.idle_timeout, self.timeout)
+                self._pools[key] = pool
+        return pool
+
+    def request(self, url, timeout=None):
+        """
+        Send the HTTP GET request and return the response body.
+        timeout overrides the timeout of the transport for this request.
+        """
+
+        split = urllib.parse.urlsplit(url)
+        path = split.path
+        if split.query:
+            path += "?" + split.query
+        pool = self.pool(split.hostname, split.port or 80)
+        labels = dalion_api_metrics.url_labels(url)
+        dalion_api_metrics.set_last_labels(labels)
+
+        start = time.perf_counter()
+        retried = False
+        while True:
+            conn, reused = pool.acquire()
+            conn.timeout = self.timeout if timeout is None else timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionError) as exc:
+                pool.release(conn, False)
+                # A reused connection may have been closed by the DALION
+                # while idle, as the other idle ones: close them and retry
+                # once on a new connection.
+                if reused and not retried:
+                    retried = True
+                    pool.close()
+                    dalion_api_metrics.increment("dalion_retries_total", labels)
+                    continue
+                dalion_api_metrics.error(labels, exc)
+                raise
+            except Exception as exc:
+                pool.release(conn, False)
+                dalion_api_metrics.error(labels, exc)
+                raise
+            pool.release(conn, not response.will_close)
+            break
+        dalion_api_metrics.observe("dalion_request_seconds", labels, time.perf_counter() - start)
+        dalion_api_metrics.observe("dalion_response_bytes", labels, len(body))
+
+        if response.status >= 400:
+            exc = urllib.error.HTTPError(url, response.status, response.reason,
+                response.headers, None)
+            dalion_api_metrics.error(labels, exc)
+            raise exc
+
+        return body
+
+    def close(self):
+        """
+        Close every pooled connection.
+        """
+
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+
+_transport = Transport()
+
+"""
+"" Transport shared by the scripts.
+"""
+
+
+def configure(pool_size=DEF_POOL_SIZE, idle_timeout=DEF_IDLE_TIMEOUT, timeout=DEF_TIMEOUT):
+    """
+    Replace the shared transport with a new configuration.
+    """
+
+    global _transport
+
+    old = _transport
+    _transport = Transport(pool_size, idle_timeout, timeout)
+    old.close()
+
+
+@dalion_api_tracing.traced("send_request")
+def send_request(url, timeout=None):
+    """
+    Send the HTTP GET request through the shared transport.
+    """
+
+    return _transport.request(url, timeout)
+
+
+def close():
+    """
+    Close the connections of the shared transport.
+    """
+
+    _transport.close()
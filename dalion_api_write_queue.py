@@ -0,0 +1,159 @@
+"""
+dalion_api_write_queue.py
+
+Last-write-wins queue in front of the set_device and set_level requests.
+While a write to a target (DALION, channel, lamp/group/channel, variable id)
+is in flight, newer writes to the same target replace the pending one
+instead of piling up, so only the latest value is sent next.
+
+Usage
+import dalion_api_write_queue
+
+queue = dalion_api_write_queue.WriteQueue()
+for value in range(0, 101):
+    queue.submit_level("192.168.0.210", 1, 1, 0, value)
+queue.flush()
+print(queue.stats())
+queue.close()
+"""
+
+import threading
+import concurrent.futures
+
+import dalion_api_set_device
+import dalion_api_set_level
+import dalion_api_transport
+import device_variables
+
+
+DEF_MAX_WORKERS = 8
+
+"""
+"" Default number of writes sent concurrently.
+"""
+
+
+class WriteQueue:
+    """
+    Per-target coalescing queue of set_device writes.
+    """
+
+    def __init__(self, max_workers=DEF_MAX_WORKERS, send=dalion_api_transport.send_request):
+        self._send = send
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._cond = threading.Condition()
+        # Targets with a write in flight
+        self._in_flight = set()
+        # Target -> (prepare, args, futures) of the next write
+        self._pending = {}
+
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def submit(self, valip, valch, valc, valii, valid, valv):
+        """
+        Queue a set_device write.
+        Returns a future resolved with the response of the write that
+        carried this value or a newer one.
+        """
+
+        variable = device_variables.find_variable(valid)
+        key = device_variables.target_key(valip, valch, valc, valii) + (valid,)
+        args = (valip, str(valch), valc, str(valii), valv, variable)
+        return self._submit(key, dalion_api_set_device.prepare_url, args)
+
+    def submit_level(self, valip, valch, valc, valii, valv):
+        """
+        Queue a set_level write of the light intensity in percent.
+        """
+
+        key = device_variables.target_key(valip, valch, valc, valii) + ('dval',)
+        args = (valip, str(valch), valc, str(valii), valv)
+        return self._submit(key, dalion_api_set_level.prepare_url, args)
+
+    def _submit(self, key, prepare, args):
+        """
+        Send the write now, or replace the pending write of the target.
+        """
+
+        future = concurrent.futures.Future()
+        with self._cond:
+            self.submitted += 1
+            if key not in self._in_flight:
+                self._in_flight.add(key)
+                self._executor.submit(self._run, key, prepare, args, [future])
+                return future
+
+            pending = self._pending.get(key)
+            if pending is None:
+                futures = [future]
+            else:
+                # The pending write is replaced, its callers get the result
+                # of the newer write.
+                self.coalesced += 1
+                futures = pending[2]
+                futures.append(future)
+            self._pending[key] = (prepare, args, futures)
+        return future
+
+    def _run(self, key, prepare, args, futures):
+        """
+        Send a write, then the pending write of the same target if any.
+        """
+
+        while True:
+            try:
+                url = prepare(*args)
+                response = self._send(url)
+            except Exception as exc:
+                with self._cond:
+                    self.failed += 1
+                for future in futures:
+                    future.set_exception(exc)
+            else:
+                with self._cond:
+                    self.sent += 1
+                for future in futures:
+                    future.set_result(response)
+
+            with self._cond:
+                pending = self._pending.pop(key, None)
+                if pending is None:
+                    self._in_flight.discard(key)
+                    self._cond.notify_all()
+                    return
+            prepare, args, futures = pending
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued write has been sent.
+        Returns False on timeout.
+        """
+
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._in_flight, timeout)
+
+    def close(self):
+        """
+        Send the queued writes and stop the workers.
+        """
+
+        self.flush()
+        self._executor.shutdown()
+
+    def stats(self):
+        """
+        Get the counters of the queue.
+        """
+
+        with self._cond:
+            return {
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "failed": self.failed,
+                "pending": len(self._pending),
+                "in_flight": len(self._in_flight)
+            }
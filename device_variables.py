@@ -186,3 +186,194 @@ device_variables = [
     "st": "1"
    }
 ]
+
+
+
+class VariableDescriptor:
+    """
+    Precompiled validator, encoder and decoder of a device variable.
+    The minimum, maximum and options are converted once.
+    """
+
+    __slots__ = ("variable", "id", "ty", "tx", "minimum", "maximum", "options",
+        "validate", "encode", "decode")
+
+    def __init__(self, variable):
+        self.variable = variable
+        self.id = variable['id']
+        self.ty = variable['ty']
+        self.tx = variable['tx']
+        self.minimum = int(variable['mi']) if 'mi' in variable else None
+        self.maximum = int(variable['ma']) if 'ma' in variable else None
+        self.options = frozenset(int(op['va']) for op in variable.get('op', ()))
+
+        self.decode = decoder(self.ty)
+        if self.ty == 'nb':
+            self.validate = self._validate_nb
+            self.encode = _encode_raw
+        elif self.ty == 'nb10':
+            self.validate = self._validate_nb10
+            self.encode = _encode_nb10
+        elif self.ty == 'se':
+            self.validate = self._validate_se
+            self.encode = _encode_raw
+        else:
+            self.validate = _validate_any
+            self.encode = _encode_raw
+
+    def _validate_nb(self, valv):
+        """
+        Valid a number in [minimum, maximum].
+        """
+
+        try:
+            valv = int(valv)
+        except (TypeError, ValueError):
+            return False
+        return self.minimum <= valv <= self.maximum
+
+    def _validate_nb10(self, valv):
+        """
+        Valid a number scaled by 10 in [minimum, maximum].
+        """
+
+        try:
+            valv = float(valv) * 10
+        except (TypeError, ValueError):
+            return False
+        return self.minimum <= valv <= self.maximum
+
+    def _validate_se(self, valv):
+        """
+        Valid an option value.
+        """
+
+        try:
+            return int(valv) in self.options
+        except (TypeError, ValueError):
+            return False
+
+
+def _validate_any(valv):
+    """
+    Valid any value, e.g. a text.
+    """
+
+    return True
+
+
+def _encode_raw(valv):
+    """
+    Encode a value as is.
+    """
+
+    return valv
+
+
+def _encode_nb10(valv):
+    """
+    Encode a number scaled by 10.
+    """
+
+    return str(float(valv) * 10)
+
+
+def _decode_raw(va):
+    """
+    Decode a value as is.
+    """
+
+    return va
+
+
+def _decode_int(va):
+    """
+    Decode a number or an option value as int, a value that does not
+    convert, e.g. a MASK, as is.
+    """
+
+    try:
+        return int(va)
+    except (TypeError, ValueError):
+        return va
+
+
+def _decode_nb10(va):
+    """
+    Decode a number scaled by 10 as float, a value that does not convert as is.
+    """
+
+    try:
+        return float(va) / 10
+    except (TypeError, ValueError):
+        return va
+
+
+def _decode_tx(va):
+    """
+    Decode a text.
+    """
+
+    return str(va)
+
+
+_decoders = {'nb': _decode_int, 'nb10': _decode_nb10, 'se': _decode_int, 'tx': _decode_tx}
+
+"""
+"" Decoder per variable type.
+"""
+
+
+def decoder(ty):
+    """
+    Get the decoder of a variable type: nb and se to int, nb10 to float
+    scaled by 1/10, tx to str, the other types as is.
+    """
+
+    return _decoders.get(ty, _decode_raw)
+
+
+registry = {variable['id']: VariableDescriptor(variable) for variable in device_variables}
+
+"""
+"" Descriptor per variable id.
+"""
+
+
+def find_variable(valid):
+    """
+    Find the device variable for valid.
+    """
+
+    descriptor = registry.get(valid)
+    if descriptor is None:
+        raise ValueError("Unknown variable id: " + str(valid))
+    return descriptor.variable
+
+
+def validate_commands(commands):
+    """
+    Valid many (valid, valv) commands.
+    Returns the list of results, False for an unknown variable id.
+    """
+
+    results = []
+    get = registry.get
+    for valid, valv in commands:
+        descriptor = get(valid)
+        results.append((descriptor is not None) and descriptor.validate(valv))
+    return results
+
+
+def target_key(valip, valch, valc, valii):
+    """
+    Key of a lamp (destination 1), group (2) or channel, the index of a
+    channel is -1. Shared by the read cache, the write queue and the
+    reconciler.
+    """
+
+    valc = int(valc)
+    if valc not in (1, 2):
+        # Channel
+        return (valip, int(valch), valc, -1)
+    return (valip, int(valch), valc, int(valii))